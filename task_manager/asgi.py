@@ -9,8 +9,22 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'task_manager.settings')
 
-application = get_asgi_application()
+# As get_asgi_application(), with a handler streaming the async views
+django.setup(set_prefix=False)
+
+from tasks import sse  # noqa: E402, needs the apps loaded
+from tasks.asyncviews import StreamingASGIHandler  # noqa: E402
+
+django_application = StreamingASGIHandler()
+
+
+async def application(scope, receive, send):
+    # The task event stream is long lived, so it is served outside Django
+    if scope["type"] == "http" and scope["path"] == sse.EVENTS_PATH:
+        await sse.application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -49,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "tasks.timing.RequestTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -62,7 +63,8 @@ ROOT_URLCONF = "task_manager.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # DjangoTemplates, timing renders for tasks.timing
+        "BACKEND": "tasks.timing.TimedDjangoTemplates",
         "DIRS": ["templates"],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -142,11 +144,98 @@ LOGOUT_REDIRECT_URL = "/"
 
 CELERY_BROKER_URL =  env('CELERY_BROKER_URL')
 CELERY_RESULT_BACKEND = CELERY_BROKER_URL
+CELERY_TASK_ALWAYS_EAGER = env.bool('CELERY_TASK_ALWAYS_EAGER', default=False)
+CELERY_TASK_EAGER_PROPAGATES = CELERY_TASK_ALWAYS_EAGER
 
 STATIC_ROOT = BASE_DIR / "staticfiles"
 
+# e.g. locmemcache:// or filecache:///var/tmp/task_manager. The Celery task
+# metrics (tasks.celerymetrics) reach /metrics from the workers through it, so
+# they need one the processes share, redis or memcached for an atomic incr
+CACHES = {"default": env.cache("CACHE_URL", default="locmemcache://")}
+
 EMAIL_HOST = "smtp.gmail.com"
 EMAIL_PORT = "587"
 EMAIL_HOST_USER = env('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
 EMAIL_USE_TLS = True
+
+# Keyset pagination, see tasks.pagination
+TASKS_PAGE_SIZE = 4
+# Rendered task pages and the API's ETag/Last-Modified, see tasks.cache. Both
+# trust a user's cache version to change with their tasks, which a locmem
+# cache only sees for its own process: they are off unless the cache is one
+# the web and Celery processes share, or TASKS_PAGE_CACHE says otherwise
+TASKS_PAGE_CACHE = env.bool(
+    "TASKS_PAGE_CACHE",
+    default=CACHES["default"]["BACKEND"] != "django.core.cache.backends.locmem.LocMemCache",
+)
+TASKS_PAGE_CACHE_TIMEOUT = 600
+TASKS_API_PAGE_SIZE = 50
+TASKS_API_MAX_PAGE_SIZE = 500
+# Threads the async API views (tasks.asyncviews) run their queries on, and
+# so the most database connections they hold at once per process
+ASYNC_API_THREADS = env.int('ASYNC_API_THREADS', default=10)
+# Task change events, streamed by tasks.sse. TASK_EVENTS_BROKER is
+# tasks.events.InProcessBroker for a single server process with eager Celery
+# only, or tasks.events.RedisBroker (at TASK_EVENTS_REDIS_URL), which any
+# deployment with more Celery or server processes needs: events published by
+# workers never reach in process subscribers. The last TASK_EVENTS_REPLAY
+# events per user are kept for clients resuming with Last-Event-ID (in
+# process, for the TASK_EVENTS_REPLAY_USERS users that subscribed last), and
+# a client falling TASK_EVENTS_QUEUE_SIZE events behind is disconnected
+TASK_EVENTS_BROKER = env('TASK_EVENTS_BROKER', default='tasks.events.InProcessBroker')
+TASK_EVENTS_REDIS_URL = env('TASK_EVENTS_REDIS_URL', default=CELERY_BROKER_URL)
+TASK_EVENTS_REPLAY = 1000
+TASK_EVENTS_REPLAY_USERS = 1000
+TASK_EVENTS_QUEUE_SIZE = 100
+TASK_EVENTS_HEARTBEAT_SECONDS = 15
+# Most tasks one bulk create, update or delete request may carry
+TASKS_BULK_MAX_ITEMS = 500
+# Most changes one /api/v1/sync/ response carries, clients page through more
+TASKS_SYNC_MAX_CHANGES = 500
+# The days /api/v1/stats/ covers when not given a start, and the most it
+# covers at once
+TASK_STATS_DEFAULT_DAYS = 30
+TASK_STATS_MAX_DAYS = 3660
+
+# Request timings, see tasks.timing. Every request is timed, and the
+# REQUEST_TIMING_SAMPLE_RATE share of them broken down into SQL, templates
+# and view, with a Server-Timing header unless REQUEST_TIMING_HEADER is off.
+# /metrics answers requests from METRICS_ALLOWED_IPS only
+REQUEST_TIMING_SAMPLE_RATE = env.float('REQUEST_TIMING_SAMPLE_RATE', default=1.0)
+REQUEST_TIMING_HEADER = env.bool('REQUEST_TIMING_HEADER', default=True)
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
+# History retention, see tasks.retention
+HISTORY_COMPACT_AFTER_DAYS = 30
+HISTORY_ARCHIVE_AFTER_DAYS = 365
+HISTORY_RETENTION_BATCH_SIZE = 500
+
+# Soft deleted tasks are deleted for good, with their history, once they have
+# been deleted for TASK_PURGE_AFTER_DAYS, see tasks.retention.purge_deleted_tasks.
+# Batches are TASK_PURGE_PAUSE_SECONDS apart and a run stops starting new ones
+# after TASK_PURGE_MAX_SECONDS, the next run picks up the rest
+TASK_PURGE_AFTER_DAYS = 30
+TASK_PURGE_BATCH_SIZE = 200
+TASK_PURGE_PAUSE_SECONDS = 0.1
+TASK_PURGE_MAX_SECONDS = 600
+
+# Daily email reports, see tasks.tasks.send_email_reminder. Each run looks
+# EMAIL_REMINDER_LOOKAHEAD_SECONDS ahead and schedules the reports due by then.
+# The rate limit is per worker, in Celery's "<count>/<s|m|h>" form, None for
+# no limit
+EMAIL_REMINDER_LOOKAHEAD_SECONDS = 300
+EMAIL_REMINDER_CHUNK_SIZE = 200
+EMAIL_REMINDER_RATE_LIMIT = env('EMAIL_REMINDER_RATE_LIMIT', default=None)
+REMINDER_CLAIM_RETENTION_DAYS = 7
+
+# Email outbox delivery, see tasks.outbox. A failed message is retried after
+# EMAIL_OUTBOX_BACKOFF_SECONDS, doubling on every attempt, and is marked dead
+# after EMAIL_OUTBOX_MAX_ATTEMPTS. A leased batch is handed to another worker
+# if it has not been delivered within EMAIL_OUTBOX_LEASE_SECONDS
+EMAIL_OUTBOX_BATCH_SIZE = 100
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_BACKOFF_SECONDS = 60
+EMAIL_OUTBOX_LEASE_SECONDS = 300
+EMAIL_OUTBOX_RETENTION_DAYS = 7
@@ -19,6 +19,7 @@ from django.contrib.auth.views import LogoutView
 from django.urls import path
 from tasks.views import *
 from tasks.apiviews import *
+from tasks import asyncviews
 from rest_framework_nested.routers import SimpleRouter, NestedSimpleRouter
 
 router = SimpleRouter()
@@ -31,6 +32,14 @@ urlpatterns = (
         path("", RedirectRootToTasks.as_view()),
         path("admin/", admin.site.urls),
         path("taskapi", TaskListAPI.as_view()),
+        path("api/v1/sync/", TaskSyncAPI.as_view()),
+        path("api/v1/stats/daily/", DailyStatsAPI.as_view()),
+        path("api/v1/stats/summary/", SummaryStatsAPI.as_view()),
+        # The same API as async views, for ASGI deployments
+        path("async/taskapi", asyncviews.task_stream),
+        path("api/async/v1/task/", asyncviews.task_list),
+        path("api/async/v1/task/<pk>/", asyncviews.task_detail),
+        path("api/async/v1/task/<task_pk>/history/", asyncviews.history_list),
         path("tasks/", GenericTaskView.as_view()),
         path("user/signup/", UserCreateView.as_view()),
         path("user/login/", UserLoginView.as_view()),
@@ -43,6 +52,7 @@ urlpatterns = (
         path("complete_task/<pk>/", GenericCompleteTaskView.as_view()),
         path("all_tasks/", GenericAllTasksView.as_view()),
         path("settings/<pk>/", EmailSettingsView.as_view()),
+        path("metrics", MetricsView.as_view()),
         # path("sample/", send_email_view),
     ]
     + router.urls
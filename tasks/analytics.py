@@ -0,0 +1,210 @@
+"""
+Per user stats on status changes over any date range, for the dashboards
+behind /api/v1/stats/, from daily rollups of History.
+
+A DailyTaskRollup row holds what one user's status changes on one day added
+up to: tasks completed, closed and reopened, and per status the stints in
+it that ended that day and how many days they lasted. A stint starts at the
+task's previous status change, so the first one, from the task's creation,
+is not counted: History doesn't record creations.
+
+The rollup_task_history job rolls up each finished day once, reading only
+that day's History rows, and the backfill_task_rollups command does the
+same for days already there. How far they have got is kept in
+RollupProgress rather than read off the rollups, which idle days have none
+of; writers of History for past days, like tasks.dataset, move it back
+with rollups_stale_from(). Stats add up the rollups of the range, a row
+per day at most, and a live rollup of the days the job hasn't got to yet,
+normally only today.
+"""
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from tasks.models import (
+    ROLLUP_FIELDS,
+    STATUS_DAYS_FIELDS,
+    STATUS_STINT_FIELDS,
+    DailyTaskRollup,
+    History,
+    HistoryArchive,
+    RollupProgress,
+)
+
+OPEN_STATUSES = {"PENDING", "IN_PROGRESS"}
+CLOSED_STATUSES = {"COMPLETED", "CANCELLED"}
+
+
+def transitions(start, end, user_id=None):
+    """
+    (user id, date, prev_status, updated_status, date of the task's
+    previous change or None) for the live and archived History rows of the
+    days from start up to end, of one user or all of them
+    """
+    previous = (
+        History.objects.filter(task_changed=OuterRef("task_changed"), id__lt=OuterRef("id"))
+        .order_by("-id")
+        .values("changed_date")[:1]
+    )
+    # Archived rows are older than any live row of their task
+    archived = (
+        HistoryArchive.objects.filter(task_id=OuterRef("task_changed"))
+        .order_by("-id")
+        .values("changed_date")[:1]
+    )
+    live = History.objects.filter(
+        changed_date__gte=start, changed_date__lt=end, task_changed__user__isnull=False
+    )
+    if user_id is not None:
+        live = live.filter(task_changed__user=user_id)
+    yield from live.annotate(
+        previous_date=Coalesce(Subquery(previous), Subquery(archived))
+    ).values_list(
+        "task_changed__user", "changed_date", "prev_status", "updated_status", "previous_date"
+    ).iterator()
+
+    previous = (
+        HistoryArchive.objects.filter(task_id=OuterRef("task_id"), id__lt=OuterRef("id"))
+        .order_by("-id")
+        .values("changed_date")[:1]
+    )
+    old = HistoryArchive.objects.filter(
+        changed_date__gte=start, changed_date__lt=end, user__isnull=False
+    )
+    if user_id is not None:
+        old = old.filter(user=user_id)
+    yield from old.annotate(previous_date=Subquery(previous)).values_list(
+        "user", "changed_date", "prev_status", "updated_status", "previous_date"
+    ).iterator()
+
+
+def roll_up(rows):
+    """Add transitions() rows up into a Counter per (user id, date)"""
+    rollups = defaultdict(Counter)
+    for user_id, date, prev_status, updated_status, previous_date in rows:
+        rollup = rollups[user_id, date]
+        if updated_status == "COMPLETED":
+            rollup["completed"] += 1
+        if prev_status in OPEN_STATUSES and updated_status in CLOSED_STATUSES:
+            rollup["closed"] += 1
+        elif prev_status in CLOSED_STATUSES and updated_status in OPEN_STATUSES:
+            rollup["reopened"] += 1
+        if previous_date is not None:
+            rollup[STATUS_STINT_FIELDS[prev_status]] += 1
+            rollup[STATUS_DAYS_FIELDS[prev_status]] += (date - previous_date).days
+    return rollups
+
+
+def rollup_days(start, end):
+    """
+    Roll up the days from start up to end afresh, in one transaction.
+    Returns the number of DailyTaskRollup rows written
+    """
+    rollups = roll_up(transitions(start, end))
+    with transaction.atomic():
+        progress, _ = RollupProgress.objects.select_for_update().get_or_create(id=1)
+        DailyTaskRollup.objects.filter(date__gte=start, date__lt=end).delete()
+        DailyTaskRollup.objects.bulk_create(
+            (
+                DailyTaskRollup(user_id=user_id, date=date, **counts)
+                for (user_id, date), counts in rollups.items()
+            ),
+            batch_size=1000,
+        )
+        # Only days adjoining the ones rolled up already extend them
+        until = progress.rolled_up_until
+        if until is None:
+            first = first_history_date()
+            adjoins = first is None or start <= first
+        else:
+            adjoins = start <= until < end
+        if adjoins:
+            progress.rolled_up_until = end
+            progress.save(update_fields=["rolled_up_until"])
+    return len(rollups)
+
+
+def rolled_up_until():
+    """The first day not rolled up, or None if none is"""
+    progress = RollupProgress.objects.filter(id=1).first()
+    return progress and progress.rolled_up_until
+
+
+def rollups_stale_from(date):
+    """Have the days from date on rolled up again, History was written for them"""
+    RollupProgress.objects.filter(id=1, rolled_up_until__gt=date).update(rolled_up_until=date)
+
+
+def first_history_date():
+    dates = [
+        model.objects.aggregate(date=Min("changed_date"))["date"]
+        for model in (History, HistoryArchive)
+    ]
+    dates = [date for date in dates if date is not None]
+    return min(dates) if dates else None
+
+
+def rollup_history(start=None, end=None, chunk_days=31):
+    """
+    Roll up the finished days from start (by default the first one not
+    rolled up) up to end (today), chunk_days at a time. Returns the
+    number of days and of rows written
+    """
+    # Today's rollup would go stale, its stats are read live from History
+    today = timezone.now().date()
+    end = min(end or today, today)
+    start = start or rolled_up_until() or first_history_date() or end
+    report = {"days": 0, "rows": 0}
+    while start < end:
+        chunk_end = min(start + timedelta(days=chunk_days), end)
+        report["rows"] += rollup_days(start, chunk_end)
+        report["days"] += (chunk_end - start).days
+        start = chunk_end
+    return report
+
+
+def daily_stats(user_id, start, end):
+    """
+    The user's rollup counts for each day from start to end, both included,
+    from the rollups where there are some and History after that
+    """
+    days = {
+        start + timedelta(days=n): dict.fromkeys(ROLLUP_FIELDS, 0)
+        for n in range((end - start).days + 1)
+    }
+    live_from = max(rolled_up_until() or start, start)
+    rows = DailyTaskRollup.objects.filter(
+        user=user_id, date__gte=start, date__lt=live_from
+    ).values("date", *ROLLUP_FIELDS)
+    for row in rows:
+        days[row.pop("date")].update(row)
+    if live_from <= end:
+        live = roll_up(transitions(live_from, end + timedelta(days=1), user_id))
+        for (_, date), counts in live.items():
+            days[date].update(counts)
+    return days
+
+
+def summary_stats(days):
+    """Totals of daily_stats() days, with the time spent in each status"""
+    totals = Counter()
+    for counts in days.values():
+        totals.update(counts)
+    status_time = {}
+    for status, stints_field in STATUS_STINT_FIELDS.items():
+        stints, days_spent = totals[stints_field], totals[STATUS_DAYS_FIELDS[status]]
+        status_time[status] = {
+            "stints": stints,
+            "days": days_spent,
+            "average_days": round(days_spent / stints, 2) if stints else None,
+        }
+    return {
+        "completed": totals["completed"],
+        "closed": totals["closed"],
+        "reopened": totals["reopened"],
+        "status_time": status_time,
+    }
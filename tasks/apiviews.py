@@ -1,6 +1,31 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.serializers import ModelSerializer
+from rest_framework.serializers import (
+    BaseSerializer,
+    CharField,
+    DateField,
+    IntegerField,
+    ListField,
+    ListSerializer,
+    ModelSerializer,
+    Serializer,
+    ValidationError,
+)
+from rest_framework.decorators import action
+from tasks import analytics, bulk, search, sync
+from tasks.cache import enabled as page_cache_enabled, get_version
+from tasks.pagination import TaskCursorPagination
 from tasks.models import *
 from django.contrib.auth.models import User
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
@@ -19,11 +44,15 @@ from django.forms import DateInput
 
 class TaskFilter(FilterSet):
     title = CharFilter(lookup_expr="icontains")
+    q = CharFilter(method="filter_search")
 
     class Meta:
         model = Task
         fields = ("title", "description", "completed", "status")
 
+    def filter_search(self, queryset, name, value):
+        return search.filter_tasks(queryset, self.request.user.id, value)
+
 
 class UserSerializer(ModelSerializer):
     class Meta:
@@ -31,33 +60,514 @@ class UserSerializer(ModelSerializer):
         fields = ("first_name", "last_name", "username")
 
 
+USER_FIELDS = UserSerializer.Meta.fields
+TASK_FIELDS = ("title", "description", "completed", "priority", "status", "user")
+
+
 class TaskSerializer(ModelSerializer):
     user = UserSerializer(read_only=True)
+    priority = IntegerField(min_value=1)
 
     class Meta:
         model = Task
-        fields = ("title", "description", "completed", "priority", "status", "user")
+        fields = TASK_FIELDS
+
+
+class TaskReadSerializer(BaseSerializer):
+    """
+    Read only TaskSerializer for list endpoints, same output without the
+    per-field machinery. Tasks need their user loaded with select_related()
+    """
+
+    def to_representation(self, task):
+        user = task.user
+        return {
+            "title": task.title,
+            "description": task.description,
+            "completed": task.completed,
+            "priority": task.priority,
+            "status": task.status,
+            "user": user and {field: getattr(user, field) for field in USER_FIELDS},
+        }
+
+
+class TaskBulkListSerializer(ListSerializer):
+    """
+    Validates a list payload for the bulk endpoint. Items are only checked,
+    tasks.bulk writes them all at once
+    """
+
+    def validate(self, data):
+        if not data:
+            raise ValidationError("Provide at least one task")
+        if len(data) > settings.TASKS_BULK_MAX_ITEMS:
+            raise ValidationError(
+                f"At most {settings.TASKS_BULK_MAX_ITEMS} tasks per request"
+            )
+        return data
+
+
+class TaskBulkUpdateListSerializer(TaskBulkListSerializer):
+    def validate(self, data):
+        data = super().validate(data)
+        if not all("id" in item for item in data):
+            raise ValidationError("Every task needs an id")
+        validate_task_ids(self.context["request"].user, [item["id"] for item in data])
+        return data
+
+
+class TaskBulkSerializer(TaskSerializer):
+    class Meta(TaskSerializer.Meta):
+        list_serializer_class = TaskBulkListSerializer
+
+
+class TaskBulkUpdateSerializer(TaskSerializer):
+    id = IntegerField()
+
+    class Meta(TaskSerializer.Meta):
+        fields = ("id", *TASK_FIELDS)
+        list_serializer_class = TaskBulkUpdateListSerializer
+
+
+class TaskBulkDeleteSerializer(Serializer):
+    ids = ListField(child=IntegerField(), allow_empty=False)
+
+    def validate_ids(self, ids):
+        if len(ids) > settings.TASKS_BULK_MAX_ITEMS:
+            raise ValidationError(f"At most {settings.TASKS_BULK_MAX_ITEMS} tasks per request")
+        validate_task_ids(self.context["request"].user, ids)
+        return ids
+
+
+def validate_task_ids(user, ids):
+    if len(set(ids)) != len(ids):
+        raise ValidationError("Task ids must not repeat")
+    tasks = Task.objects.filter(user=user, deleted=False, id__in=ids)
+    missing = set(ids) - set(tasks.values_list("id", flat=True))
+    if missing:
+        raise ValidationError(f"Unknown tasks: {sorted(missing)}")
+
+
+class TaskMoveSerializer(Serializer):
+    id = IntegerField()
+    priority = IntegerField(min_value=1)
+
+
+class TaskReorderSerializer(Serializer):
+    ids = ListField(child=IntegerField(), required=False, allow_empty=False)
+    moves = ListField(child=TaskMoveSerializer(), required=False, allow_empty=False)
+
+    def validate(self, data):
+        if ("ids" in data) == ("moves" in data):
+            raise ValidationError("Provide either an ordered list of ids or a list of moves")
+        user = self.context["request"].user
+        if "ids" in data:
+            ids = data["ids"]
+            tasks = Task.objects.filter(user=user, deleted=False)
+        else:
+            ids = [move["id"] for move in data["moves"]]
+            tasks = Task.objects.filter(user=user, deleted=False, completed=False)
+        if "ids" in data and len(set(ids)) != len(ids):
+            raise ValidationError("Task ids must not repeat")
+        missing = set(ids) - set(tasks.filter(id__in=ids).values_list("id", flat=True))
+        if missing:
+            raise ValidationError(f"Unknown tasks: {sorted(missing)}")
+        return data
+
+
+class TaskSearchSerializer(Serializer):
+    q = CharField()
+    limit = IntegerField(min_value=1, max_value=100, default=20)
+
+    def validate_q(self, value):
+        if not search.terms(value):
+            raise ValidationError("Search for at least one word")
+        return value
+
+
+class TaskSyncSerializer(Serializer):
+    since = CharField(default=sync.FULL_SYNC)
+    limit = IntegerField(min_value=1, default=settings.TASKS_SYNC_MAX_CHANGES)
+
+    def validate_since(self, value):
+        try:
+            sync.parse_cursor(value)
+        except ValueError:
+            raise ValidationError("Not a sync cursor")
+        return value
+
+    def validate_limit(self, value):
+        return min(value, settings.TASKS_SYNC_MAX_CHANGES)
+
+
+class StatsRangeSerializer(Serializer):
+    """?start= and ?end= dates of a stats range, both included"""
+
+    start = DateField(required=False)
+    end = DateField(required=False)
+
+    def validate(self, data):
+        end = data.get("end") or timezone.now().date()
+        start = data.get("start") or end - timedelta(days=settings.TASK_STATS_DEFAULT_DAYS - 1)
+        if start > end:
+            raise ValidationError("start must not be after end")
+        if (end - start).days >= settings.TASK_STATS_MAX_DAYS:
+            raise ValidationError(f"Ask for at most {settings.TASK_STATS_MAX_DAYS} days")
+        return {"start": start, "end": end}
+
+
+class ConditionalGetMixin:
+    """
+    Weak ETag and Last-Modified validators on list and retrieve, taken from
+    the user's task cache version (see tasks.cache). A client that already
+    has the current response gets a 304 before any query or serializer runs.
+    Left out while the page cache is off, as the versions can't be trusted
+    """
+
+    def get_validators(self, request):
+        version = get_version(request.user.id)
+        representation = (
+            f"{request.user.id}:{version}:{request.get_full_path()}:"
+            f"{request.accepted_media_type}"
+        )
+        etag = f'W/"{hashlib.md5(representation.encode()).hexdigest()}"'
+        return etag, version // 10**9
+
+    def conditional(self, handler, request, *args, **kwargs):
+        if not page_cache_enabled():
+            return handler(request, *args, **kwargs)
+        etag, last_modified = self.get_validators(request)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response["ETag"] = etag
+            response["Last-Modified"] = http_date(last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
 
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
 
-class TaskViewSet(ModelViewSet):
+
+class TaskViewSet(ConditionalGetMixin, ModelViewSet):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
     permission_classes = (IsAuthenticated,)
     filter_backends = (DjangoFilterBackend,)
     filterset_class = TaskFilter
+    pagination_class = TaskCursorPagination
 
     def get_queryset(self):
-        return Task.objects.filter(user=self.request.user, deleted=False)
+        return (
+            Task.objects.filter(user=self.request.user, deleted=False)
+            .select_related("user")
+            .order_by("rank", "id")
+        )
+
+    def get_serializer_class(self):
+        if self.action == "list":
+            return TaskReadSerializer
+        return TaskSerializer
+
+    def get_object(self):
+        task = super().get_object()
+        number_priorities([task])
+        return task
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def perform_update(self, serializer):
+        # Completing or reopening a task puts it on the other list where its
+        # rank places it, so it is numbered afresh there
+        number_priorities([serializer.save()])
+
+    @action(detail=False, methods=["post"])
+    def reorder(self, request):
+        serializer = TaskReorderSerializer(
+            data=request.data, context=self.get_serializer_context()
+        )
+        serializer.is_valid(raise_exception=True)
+        if "ids" in serializer.validated_data:
+            reorder_tasks(request.user.id, serializer.validated_data["ids"])
+            return Response({"ids": serializer.validated_data["ids"]})
+        moves = [
+            (move["id"], move["priority"])
+            for move in serializer.validated_data["moves"]
+        ]
+        return Response({"ids": move_tasks(request.user.id, moves)})
+
+    @action(detail=False, methods=["post", "patch", "delete"])
+    def bulk(self, request):
+        """
+        Create (POST a list of tasks), update (PATCH a list of partial tasks
+        with their ids) or delete (DELETE {"ids": [...]}) many tasks at once.
+        Nothing is written unless every item is valid
+        """
+        context = self.get_serializer_context()
+        if request.method == "DELETE":
+            serializer = TaskBulkDeleteSerializer(data=request.data, context=context)
+            serializer.is_valid(raise_exception=True)
+            ids = serializer.validated_data["ids"]
+            bulk.delete_tasks(request.user, ids)
+            return Response({"results": [{"id": task_id, "deleted": True} for task_id in ids]})
+
+        if request.method == "POST":
+            serializer = TaskBulkSerializer(data=request.data, many=True, context=context)
+            serializer.is_valid(raise_exception=True)
+            tasks = bulk.create_tasks(request.user, serializer.validated_data)
+            status = 201
+        else:
+            serializer = TaskBulkUpdateSerializer(
+                data=request.data, many=True, partial=True, context=context
+            )
+            serializer.is_valid(raise_exception=True)
+            tasks = bulk.update_tasks(request.user, serializer.validated_data)
+            # Priorities of tasks that weren't moved shifted with the others
+            ids = [task.id for task in tasks]
+            tasks = Task.objects.filter(id__in=ids).select_related("user")
+            tasks = {task.id: task for task in number_priorities(list(tasks))}
+            tasks = [tasks[task_id] for task_id in ids]
+            status = 200
+        results = [{"id": task.id, **TaskReadSerializer(task).data} for task in tasks]
+        return Response({"results": results}, status=status)
+
+    @action(detail=False, methods=["get"], url_path="search")
+    def search(self, request):
+        return self.conditional(self.search_results, request)
+
+    def search_results(self, request):
+        serializer = TaskSearchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        ids = search.search(request.user.id, **serializer.validated_data)
+        tasks = Task.objects.filter(id__in=ids, user=request.user, deleted=False)
+        tasks = {task.id: task for task in number_priorities(list(tasks.select_related("user")))}
+        results = [tasks[task_id] for task_id in ids if task_id in tasks]
+        return Response({"results": TaskReadSerializer(results, many=True).data})
+
+
+class NDJSONRenderer(BaseRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Only used for error responses, task lists are streamed by the view
+        return dumps(data).encode() + b"\n"
+
+
+def dumps(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def iter_task_list(chunk_size):
+    """
+    (task, user) dicts for every task, shaped like TaskSerializer's output.
+    Tasks come from one joined query read in chunks, ordered by user and rank
+    so priorities can be counted on the way
+    """
+    tasks = (
+        Task.objects.filter(deleted=False)
+        .order_by("user", "rank", "id")
+        .values_list(
+            "title",
+            "description",
+            "completed",
+            "status",
+            "user",
+            "user__first_name",
+            "user__last_name",
+            "user__username",
+        )
+    )
+    current_user, priorities = object(), None
+    for row in tasks.iterator(chunk_size=chunk_size):
+        title, description, completed, status, user_id = row[:5]
+        if user_id != current_user:
+            current_user, priorities = user_id, [0, 0]
+        priorities[completed] += 1
+        user = None
+        if user_id is not None:
+            user = dict(zip(("first_name", "last_name", "username"), row[5:]))
+        task = {
+            "title": title,
+            "description": description,
+            "completed": completed,
+            "priority": priorities[completed],
+            "status": status,
+            "user": user,
+        }
+        yield task, user_id
+
 
 class TaskListAPI(APIView):
+    """
+    Every task, streamed so memory use does not grow with the table.
+    JSON by default, one task per line with ?format=ndjson. With
+    ?sideload=users each task refers to its user by id and the users are
+    listed once, under "users" (in NDJSON, on a line of their own before
+    their first task)
+    """
+
+    renderer_classes = (JSONRenderer, NDJSONRenderer)
+    chunk_size = 2000
+
+    def get(self, request):
+        sideload = request.query_params.get("sideload") == "users"
+        tasks = iter_task_list(self.chunk_size)
+        if request.accepted_renderer.format == "ndjson":
+            content = self.stream_ndjson(tasks, sideload)
+        else:
+            content = self.stream_json(tasks, sideload)
+        return StreamingHttpResponse(
+            self.buffered(content), content_type=request.accepted_renderer.media_type
+        )
+
+    def buffered(self, lines):
+        """Join lines into chunk_size sized writes"""
+        buffer = []
+        for line in lines:
+            buffer.append(line)
+            if len(buffer) >= self.chunk_size:
+                yield "".join(buffer)
+                buffer = []
+        yield "".join(buffer)
+
+    def stream_json(self, tasks, sideload):
+        yield "{"
+        if sideload:
+            users = (
+                User.objects.filter(
+                    Exists(Task.objects.filter(user=OuterRef("pk"), deleted=False))
+                )
+                .order_by("id")
+                .values_list("id", "first_name", "last_name", "username")
+            )
+            yield '"users":{'
+            separator = ""
+            for user_id, *names in users.iterator(chunk_size=self.chunk_size):
+                user = dict(zip(("first_name", "last_name", "username"), names))
+                yield f'{separator}"{user_id}":' + dumps(user)
+                separator = ","
+            yield "},"
+        yield '"tasks":['
+        separator = ""
+        for task, user_id in tasks:
+            if sideload:
+                task["user"] = user_id
+            yield separator + dumps(task)
+            separator = ","
+        yield "]}"
+
+    def stream_ndjson(self, tasks, sideload):
+        current_user = None
+        for task, user_id in tasks:
+            if sideload:
+                if user_id is not None and user_id != current_user:
+                    # Tasks arrive grouped by user, so each user is sent once
+                    yield dumps({"users": {user_id: task["user"]}}) + "\n"
+                    current_user = user_id
+                task["user"] = user_id
+            yield dumps(task) + "\n"
+
+
+class TaskSyncAPI(APIView):
+    """
+    The user's tasks changed since the ?since= cursor (see tasks.sync), with
+    the cursor to pass next time. "changed" holds tasks as they are now,
+    with their rank instead of a priority: a move shifts the priorities of
+    tasks that did not change, so clients order each list by rank and id.
+    "deleted" holds the ids of tasks deleted or given to another user since,
+    to be dropped before "changed" is applied (a task can come back). With
+    "reset" the client must drop its copy first, and while "more" is set it
+    should sync again straight away
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        serializer = TaskSyncSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        changes = sync.changes_since(
+            request.user.id,
+            serializer.validated_data["since"],
+            serializer.validated_data["limit"],
+        )
+        changed = [
+            {
+                "id": task.id,
+                "title": task.title,
+                "description": task.description,
+                "completed": task.completed,
+                "status": task.status,
+                "rank": task.rank,
+            }
+            for task in changes["tasks"]
+            if not task.deleted
+        ]
+        deleted = changes["removed"] + [task.id for task in changes["tasks"] if task.deleted]
+        return Response(
+            {
+                "cursor": changes["cursor"],
+                "more": changes["more"],
+                "reset": changes["reset"],
+                "changed": changed,
+                "deleted": deleted,
+            }
+        )
+
+
+class StatsAPI(APIView):
+    """
+    Stats on the user's status changes from ?start= to ?end= (by default the
+    last TASK_STATS_DEFAULT_DAYS days), read from the daily rollups of
+    tasks.analytics
+    """
+
+    permission_classes = (IsAuthenticated,)
+
     def get(self, request):
-        tasks = Task.objects.filter(deleted=False)
-        data = TaskSerializer(tasks, many=True).data
-        return Response({"tasks": data})
+        serializer = StatsRangeSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        days = analytics.daily_stats(request.user.id, **serializer.validated_data)
+        return Response(
+            {
+                "start": serializer.validated_data["start"],
+                "end": serializer.validated_data["end"],
+                **self.stats(days),
+            }
+        )
+
+
+class DailyStatsAPI(StatsAPI):
+    """Tasks completed, closed and reopened on each day"""
+
+    def stats(self, days):
+        return {
+            "days": [
+                {
+                    "date": date,
+                    "completed": counts["completed"],
+                    "closed": counts["closed"],
+                    "reopened": counts["reopened"],
+                }
+                for date, counts in days.items()
+            ]
+        }
+
+
+class SummaryStatsAPI(StatsAPI):
+    """
+    Tasks completed, closed and reopened over the range, and the days spent
+    in each status by the stints that ended in it
+    """
+
+    def stats(self, days):
+        return analytics.summary_stats(days)
 
 
 class HistoryFilter(FilterSet):
@@ -76,7 +586,42 @@ class HistorySerializer(ModelSerializer):
         fields = "__all__"
 
 
+class HistoryReadSerializer(BaseSerializer):
+    """
+    Read only HistorySerializer over rows from HistoryQuerySet.list_values(),
+    same output from one query however many rows there are, and one more for
+    the priorities of their tasks, given as context["priorities"] from
+    task_priorities()
+    """
+
+    def to_representation(self, row):
+        task = None
+        if row["task_changed"] is not None:
+            user = None
+            if row["task_changed__user"] is not None:
+                user = {
+                    field: row[f"task_changed__user__{field}"] for field in USER_FIELDS
+                }
+            task = {
+                "title": row["task_changed__title"],
+                "description": row["task_changed__description"],
+                "completed": row["task_changed__completed"],
+                "priority": self.context["priorities"].get(row["task_changed"]),
+                "status": row["task_changed__status"],
+                "user": user,
+            }
+        return {
+            "id": row["id"],
+            "task_changed": task,
+            "prev_status": row["prev_status"],
+            "updated_status": row["updated_status"],
+            "changed_date": row["changed_date"].isoformat(),
+            "transitions": row["transitions"],
+        }
+
+
 class HistoryViewSet(
+    ConditionalGetMixin,
     mixins.RetrieveModelMixin,
     mixins.DestroyModelMixin,
     mixins.ListModelMixin,
@@ -89,4 +634,31 @@ class HistoryViewSet(
     filterset_class = HistoryFilter
 
     def get_queryset(self):
-        return History.objects.filter(task_changed__pk=self.kwargs["task_pk"], task_changed__user = self.request.user)
+        return History.objects.filter(
+            task_changed__pk=self.kwargs["task_pk"], task_changed__user=self.request.user
+        ).select_related("task_changed__user")
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(self.list_rows, request, *args, **kwargs)
+
+    def list_rows(self, request, *args, **kwargs):
+        rows = self.filter_queryset(self.get_queryset()).order_by("id").list_values()
+        page = self.paginate_queryset(rows)
+        if page is None:
+            rows = list(rows)
+        else:
+            rows = list(page)
+        priorities = task_priorities(
+            (
+                row["task_changed"],
+                row["task_changed__user"],
+                row["task_changed__completed"],
+                row["task_changed__rank"],
+            )
+            for row in {row["task_changed"]: row for row in rows}.values()
+            if row["task_changed"] is not None and not row["task_changed__deleted"]
+        )
+        serializer = HistoryReadSerializer(rows, many=True, context={"priorities": priorities})
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
@@ -1,6 +1,31 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+
+
+def install_search_triggers(sender, using, **kwargs):
+    from django.db import connections
+
+    from tasks import search
+
+    search.install_triggers(connections[using])
 
 
 class TasksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tasks'
+
+    def ready(self):
+        from celery.signals import before_task_publish, task_postrun, task_prerun
+        from django.core import checks
+
+        from tasks import cache, celerymetrics, timing
+
+        checks.register(cache.check)
+
+        post_migrate.connect(install_search_triggers, sender=self)
+        # Before any connection opens, so every one gets the query timer
+        connection_created.connect(timing.install)
+        before_task_publish.connect(celerymetrics.stamp_published)
+        task_prerun.connect(celerymetrics.task_started)
+        task_postrun.connect(celerymetrics.task_finished)
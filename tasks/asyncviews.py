@@ -0,0 +1,145 @@
+"""
+Async versions of the read endpoints of the task API, for running the app
+under ASGI, e.g. `gunicorn task_manager.asgi -k uvicorn.workers.UvicornWorker`.
+
+Django 4.0 has no async ORM yet (aget(), acount() and aiterator() arrive in
+4.1), so the blocking part of each request, authentication, queries and
+rendering, runs as one call on a thread pool of ASYNC_API_THREADS threads,
+through the same DRF views as the sync endpoints. The event loop only reads
+requests and writes responses, and the pool caps the database connections
+the process holds however many clients are waiting.
+
+Django 4.0 iterates streaming responses on the event loop, where the
+queries behind them can't run. A streamed response is produced on one pool
+thread instead, and StreamingASGIHandler (task_manager.asgi) sends its
+chunks as they come, so neither the loop nor memory waits on the whole of it.
+"""
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+from django.http import StreamingHttpResponse
+
+from tasks.apiviews import HistoryViewSet, TaskListAPI, TaskViewSet
+
+executor = ThreadPoolExecutor(settings.ASYNC_API_THREADS, thread_name_prefix="async-api")
+
+_END = object()
+
+
+class ExecutorStreamingHttpResponse(StreamingHttpResponse):
+    """
+    A streaming response whose content is produced on a pool thread when
+    chunks() is iterated. The thread hands chunks over through a queue of
+    queue_size, so a slow client holds the thread back rather than have the
+    response buffered, and the stream's queries all run on the connection
+    of that one thread. Iterated synchronously, as by the test client, it is
+    produced in the calling thread
+    """
+
+    queue_size = 4
+
+    def __init__(self, response, context):
+        super().__init__(
+            response.streaming_content, status=response.status_code, headers=response.headers
+        )
+        self.context = context
+
+    async def chunks(self):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.queue_size)
+        stopped = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def produce():
+            try:
+                for chunk in self.streaming_content:
+                    if stopped.is_set():
+                        break
+                    put(chunk)
+            finally:
+                close_old_connections()
+                put(_END)
+
+        producer = loop.run_in_executor(executor, partial(self.context.run, produce))
+        chunk = None
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is _END:
+                    break
+                yield chunk
+        finally:
+            # The client went away: let the producer finish its put and stop
+            stopped.set()
+            while chunk is not _END:
+                chunk = await queue.get()
+            await producer
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """ASGIHandler sending ExecutorStreamingHttpResponses as they are produced"""
+
+    async def send_response(self, response, send):
+        if not isinstance(response, ExecutorStreamingHttpResponse):
+            return await super().send_response(response, send)
+        # Headers and cookies as ASGIHandler.send_response encodes them
+        headers = [
+            (
+                header.encode("ascii") if isinstance(header, str) else header,
+                value.encode("latin1") if isinstance(value, str) else value,
+            )
+            for header, value in response.items()
+        ]
+        headers.extend(
+            (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            for cookie in response.cookies.values()
+        )
+        await send(
+            {"type": "http.response.start", "status": response.status_code, "headers": headers}
+        )
+        async for part in response.chunks():
+            for chunk, _ in self.chunk_bytes(part):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body"})
+        await asyncio.get_running_loop().run_in_executor(executor, response.close)
+
+
+def call_view(view, request, **kwargs):
+    """Run a sync view to a response on a pool thread, a streamed one still unread"""
+    close_old_connections()
+    try:
+        response = view(request, **kwargs)
+        if hasattr(response, "render"):
+            response.render()
+        return response
+    finally:
+        close_old_connections()
+
+
+def async_view(view):
+    async def handler(request, **kwargs):
+        loop = asyncio.get_running_loop()
+        # In the request's context, for tasks.timing to credit the queries to it
+        context = contextvars.copy_context()
+        response = await loop.run_in_executor(
+            executor, partial(context.run, call_view, view, request, **kwargs)
+        )
+        if response.streaming:
+            response = ExecutorStreamingHttpResponse(response, context)
+        return response
+
+    return handler
+
+
+task_list = async_view(TaskViewSet.as_view({"get": "list"}))
+task_detail = async_view(TaskViewSet.as_view({"get": "retrieve"}))
+history_list = async_view(HistoryViewSet.as_view({"get": "list"}))
+task_stream = async_view(TaskListAPI.as_view())
@@ -0,0 +1,583 @@
+"""
+Benchmarks for the slow paths of the app, run with `python manage.py benchmark`.
+Every benchmark works on its own throwaway user inside a transaction that is
+rolled back afterwards, so it can be pointed at a real database.
+"""
+import asyncio
+import resource
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+from django.db.backends.signals import connection_created
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.core import mail
+from django.test import Client, RequestFactory, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from tasks.models import (
+    RANK_GAP,
+    STATUS_CHOICES,
+    ChangeSequence,
+    EmailSettings,
+    History,
+    Task,
+)
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback
+    except Rollback:
+        pass
+
+
+@contextmanager
+def measure(results, name):
+    """Record wall time and query count of the block under results[name]"""
+    # The query log is a bounded deque, setup may have filled it already
+    connection.queries_log.clear()
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+    results[name] = {"seconds": round(elapsed, 4), "queries": len(queries)}
+
+
+def make_user(name="benchmark"):
+    return User.objects.create_user(username=name, email=f"{name}@example.com")
+
+
+def make_tasks(user, count, **kwargs):
+    return Task.objects.bulk_create(
+        Task(
+            title=f"Benchmark task {i}",
+            description="Generated for benchmarking",
+            rank=i * RANK_GAP,
+            user=user,
+            **kwargs,
+        )
+        for i in range(1, count + 1)
+    )
+
+
+@benchmark("reorder")
+def reorder(size):
+    """Reverse a list of `size` tasks with one reorder call vs one PATCH per task"""
+    from tasks.apiviews import TaskViewSet
+
+    factory = APIRequestFactory()
+    results = {}
+
+    with rolled_back():
+        user = make_user()
+        ids = [task.id for task in reversed(make_tasks(user, size))]
+        view = TaskViewSet.as_view({"post": "reorder"})
+        request = factory.post("/api/v1/task/reorder/", {"ids": ids}, format="json")
+        force_authenticate(request, user)
+        with measure(results, "reorder"):
+            view(request)
+
+    with rolled_back():
+        user = make_user()
+        ids = [task.id for task in reversed(make_tasks(user, size))]
+        view = TaskViewSet.as_view({"patch": "partial_update"})
+        with measure(results, "patch"):
+            for priority, task_id in enumerate(ids, start=1):
+                request = factory.patch(
+                    f"/api/v1/task/{task_id}/", {"priority": priority}, format="json"
+                )
+                force_authenticate(request, user)
+                view(request, pk=task_id)
+
+    return results
+
+
+@benchmark("taskapi")
+def taskapi(size):
+    """
+    Stream /taskapi over `size` tasks spread across 100 users, in each format.
+    Python memory is the tracemalloc peak while the response is consumed;
+    maxrss is the process high-water mark so far and never goes down
+    """
+    client = Client(HTTP_HOST="127.0.0.1")
+    results = {}
+
+    with rolled_back():
+        users = [make_user(f"benchmark{i}") for i in range(100)]
+        for i, user in enumerate(users):
+            make_tasks(user, size // len(users) + (i < size % len(users)))
+
+        for name, params in (
+            ("json", {}),
+            ("json_sideload", {"sideload": "users"}),
+            ("ndjson", {"format": "ndjson"}),
+        ):
+            tracemalloc.start()
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = client.get("/taskapi", params)
+                chunks = iter(response.streaming_content)
+                received = len(next(chunks))
+                first_byte = time.perf_counter() - start
+                received += sum(len(chunk) for chunk in chunks)
+                elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = {
+                "first_byte_seconds": round(first_byte, 4),
+                "seconds": round(elapsed, 4),
+                "queries": len(queries),
+                "bytes": received,
+                "peak_python_kb": peak // 1024,
+                "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+
+    return results
+
+
+@benchmark("email_reminder")
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+def email_reminder(size):
+    """
+    Send the daily report to `size` due users with 10 tasks each. The chunks
+    send_email_reminder would dispatch are run here one after the other, then
+    the outbox is drained
+    """
+    from tasks import outbox
+    from tasks.tasks import due_email_settings, send_email_reports
+
+    results = {}
+    with rolled_back():
+        users = User.objects.bulk_create(
+            User(username=f"benchmark{i}", email=f"benchmark{i}@example.com")
+            for i in range(size)
+        )
+        for user in users:
+            make_tasks(user, 10)
+        now = timezone.now()
+        EmailSettings.objects.bulk_create(
+            EmailSettings(user=user, email_time=now, email_date=now, next_send_at=now)
+            for user in users
+        )
+        mail.outbox = []
+        chunk_size = settings.EMAIL_REMINDER_CHUNK_SIZE
+        with measure(results, "enqueue"):
+            ids = list(due_email_settings().order_by("id").values_list("id", flat=True))
+            for start in range(0, len(ids), chunk_size):
+                send_email_reports(ids[start : start + chunk_size])
+        results["enqueue"]["chunks"] = -(-len(ids) // chunk_size)
+        with measure(results, "deliver"):
+            report = outbox.deliver()
+        results["deliver"]["batches"] = report["batches"]
+        results["deliver"]["messages"] = len(mail.outbox)
+    return results
+
+
+@benchmark("page_cache")
+def page_cache(size, repeat=50):
+    """
+    Mean latency of the task pages of a user with `size` tasks, rendered
+    (cold, the user's cache version is bumped before every request) and
+    served from the page cache (hot)
+    """
+    from tasks.cache import bump_versions
+
+    results = {}
+    with rolled_back():
+        user = make_user()
+        tasks = make_tasks(user, size)
+        client = Client(HTTP_HOST="127.0.0.1")
+        client.force_login(user)
+        client.get("/user/login/")
+        for url in ("/tasks/", "/all_tasks/", f"/detail-task/{tasks[0].id}/"):
+            for name in ("cold", "hot"):
+                client.get(url)
+                measure_name = f"{url} {name}"
+                with measure(results, measure_name):
+                    for _ in range(repeat):
+                        if name == "cold":
+                            bump_versions([user.id])
+                        client.get(url)
+                result = results[measure_name]
+                result["ms_per_request"] = round(result.pop("seconds") * 1000 / repeat, 3)
+                result["queries_per_request"] = result.pop("queries") / repeat
+    return results
+
+
+SEARCH_WORDS = (
+    "invoice report meeting review deploy budget client design release backup "
+    "migrate schedule contract payroll audit refund survey launch hiring roadmap"
+).split()
+
+
+@benchmark("search")
+def search(size, repeat=20):
+    """
+    Mean latency of searching `size` tasks for a word with icontains vs the
+    full-text index, filtering the task list with ?q= and the ranked search
+    endpoint
+    """
+    from tasks import search as task_search
+
+    results = {}
+    with rolled_back():
+        user = make_user()
+        Task.objects.bulk_create(
+            (
+                Task(
+                    title=f"{SEARCH_WORDS[i % 20]} {SEARCH_WORDS[i * 7 % 19]} {i}",
+                    description=f"Notes on the {SEARCH_WORDS[i * 3 % 17]} for week {i}",
+                    rank=i * RANK_GAP,
+                    user=user,
+                )
+                for i in range(1, size + 1)
+            ),
+            batch_size=5000,
+        )
+        client = Client(HTTP_HOST="127.0.0.1")
+        client.force_login(user)
+        tasks = Task.objects.filter(user=user, deleted=False)
+        runs = {}
+        # A word in one task of 20, and one only the last task has
+        for word in ("payroll", str(size)):
+            runs[f"{word} icontains count"] = lambda word=word: tasks.filter(
+                title__icontains=word
+            ).count()
+            runs[f"{word} fts count"] = lambda word=word: task_search.filter_tasks(
+                tasks, user.id, word
+            ).count()
+            runs[f"{word} icontains list"] = lambda word=word: client.get(
+                "/api/v1/task/", {"title": word}
+            )
+            runs[f"{word} fts list"] = lambda word=word: client.get(
+                "/api/v1/task/", {"q": word}
+            )
+            runs[f"{word} fts search"] = lambda word=word: client.get(
+                "/api/v1/task/search/", {"q": word}
+            )
+        for name, run in runs.items():
+            run()
+            with measure(results, name):
+                for _ in range(repeat):
+                    run()
+            result = results[name]
+            result["ms_per_request"] = round(result.pop("seconds") * 1000 / repeat, 3)
+            result["queries_per_request"] = result.pop("queries") / repeat
+    return results
+
+
+@benchmark("bulk")
+def bulk(size):
+    """
+    Create, update and delete `size` tasks with one request per task vs one
+    bulk request
+    """
+    results = {}
+    for name in ("single", "bulk"):
+        with rolled_back():
+            user = make_user()
+            client = Client(HTTP_HOST="127.0.0.1")
+            client.force_login(user)
+            items = [
+                {"title": f"Imported {i}", "description": "Lorem", "priority": i}
+                for i in range(1, size + 1)
+            ]
+            with measure(results, f"{name} create"):
+                if name == "bulk":
+                    client.post("/api/v1/task/bulk/", items, content_type="application/json")
+                else:
+                    for item in items:
+                        client.post("/api/v1/task/", item, content_type="application/json")
+            ids = list(Task.objects.filter(user=user).values_list("id", flat=True))
+            changes = [{"id": task_id, "status": "IN_PROGRESS"} for task_id in ids]
+            with measure(results, f"{name} update"):
+                if name == "bulk":
+                    client.patch("/api/v1/task/bulk/", changes, content_type="application/json")
+                else:
+                    for change in changes:
+                        client.patch(
+                            f"/api/v1/task/{change['id']}/",
+                            change,
+                            content_type="application/json",
+                        )
+            with measure(results, f"{name} delete"):
+                if name == "bulk":
+                    client.delete(
+                        "/api/v1/task/bulk/", {"ids": ids}, content_type="application/json"
+                    )
+                else:
+                    for task_id in ids:
+                        client.delete(f"/api/v1/task/{task_id}/")
+    return results
+
+
+@benchmark("sync")
+def sync(size, changed=10):
+    """
+    Catching up on `changed` changes among `size` tasks by downloading the
+    whole task list vs with one delta sync
+    """
+    results = {}
+    with rolled_back():
+        user = make_user()
+        tasks = make_tasks(user, size)
+        # As numbered by the migration that added change_seq
+        Task.objects.filter(user=user).update(change_seq=F("id"))
+        ChangeSequence.objects.create(user=user, value=tasks[-1].id)
+        client = Client(HTTP_HOST="127.0.0.1")
+        client.force_login(user)
+        cursor = client.get("/api/v1/sync/", {"since": str(tasks[-1].id)}).json()["cursor"]
+        ids = [task.id for task in tasks[:: max(size // changed, 1)][:changed]]
+        Task.objects.filter(id__in=ids).tracked_update(status="IN_PROGRESS")
+
+        with measure(results, "full list"):
+            page = {"next": f"/api/v1/task/?page_size={settings.TASKS_API_MAX_PAGE_SIZE}"}
+            listed = 0
+            while page["next"]:
+                page = client.get(page["next"]).json()
+                listed += len(page["results"])
+        results["full list"]["tasks"] = listed
+        with measure(results, "sync"):
+            response = client.get("/api/v1/sync/", {"since": cursor}).json()
+        results["sync"]["tasks"] = len(response["changed"])
+    return results
+
+
+@benchmark("analytics")
+def analytics(size, days=365):
+    """
+    Stats over a year of one user's `size` History rows, aggregated from
+    History on demand vs read from the daily rollups, and what rolling up
+    one day costs
+    """
+    from tasks import analytics as task_analytics
+
+    results = {}
+    statuses = [status for status, _ in STATUS_CHOICES]
+    today = timezone.now().date()
+    start = today - timedelta(days=days)
+    with rolled_back():
+        user = make_user()
+        tasks = make_tasks(user, max(size // 20, 1))
+        per_day = -(-size // days)
+        made = 0
+        for day in range(days):
+            count = min(per_day, size - made)
+            rows = History.objects.bulk_create(
+                (
+                    History(
+                        prev_status=statuses[i % 4],
+                        updated_status=statuses[(i + 1) % 4],
+                        task_changed=tasks[i % len(tasks)],
+                    )
+                    for i in range(made, made + count)
+                ),
+                batch_size=5000,
+            )
+            # changed_date is auto_now, so it is set afterwards
+            History.objects.filter(id__gte=rows[0].id).update(
+                changed_date=start + timedelta(days=day)
+            )
+            made += count
+        client = Client(HTTP_HOST="127.0.0.1")
+        client.force_login(user)
+        params = {"start": str(start), "end": str(today - timedelta(days=1))}
+
+        with measure(results, "raw daily aggregate"):
+            list(
+                History.objects.filter(
+                    task_changed__user=user, changed_date__gte=start, changed_date__lt=today
+                )
+                .values("changed_date")
+                .annotate(completed=Count("id", filter=Q(updated_status="COMPLETED")))
+            )
+        with measure(results, "summary from history"):
+            client.get("/api/v1/stats/summary/", params)
+        with measure(results, "rollup one day"):
+            task_analytics.rollup_days(start, start + timedelta(days=1))
+        with measure(results, "rollup all days"):
+            task_analytics.rollup_history(start + timedelta(days=1), today)
+        with measure(results, "summary from rollups"):
+            client.get("/api/v1/stats/summary/", params)
+        with measure(results, "daily from rollups"):
+            client.get("/api/v1/stats/daily/", params)
+    return results
+
+
+async def asgi_get(application, path, headers):
+    """GET path from an ASGI application, as a server would. Returns the status"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(name.encode(), value.encode()) for name, value in headers.items()],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 80),
+    }
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await application(scope, receive, send)
+    return status[0]
+
+
+def wsgi_get(application, path, headers):
+    """GET path from a WSGI application. Returns the status"""
+    environ = RequestFactory().get(
+        path, **{f"HTTP_{name.upper().replace('-', '_')}": value for name, value in headers.items()}
+    ).environ
+    status = []
+    result = application(environ, lambda line, response_headers: status.append(int(line[:3])))
+    try:
+        b"".join(result)
+    finally:
+        result.close()
+    return status[0]
+
+
+@benchmark("concurrency")
+def concurrency(size, requests_per_client=5, wsgi_workers=9, tasks=50, db_latency=0.002):
+    """
+    Requests per second for `size` concurrent clients reading their task list
+    from the sync API on `wsgi_workers` sync workers (as gunicorn's default
+    worker class would serve it), and from the sync and the async API under
+    ASGI. Every query is made to take db_latency seconds longer, as over a
+    network. Everything runs in this process, so the numbers compare the
+    deployments with each other rather than predict production throughput.
+    The data is committed (the servers' threads have connections of their
+    own) and deleted afterwards
+    """
+    from django.core.asgi import get_asgi_application
+    from django.core.wsgi import get_wsgi_application
+
+    def slow_execute(execute, sql, params, many, context):
+        time.sleep(db_latency)
+        return execute(sql, params, many, context)
+
+    def add_latency(sender, connection, **kwargs):
+        connection.execute_wrappers.append(slow_execute)
+
+    user = make_user("benchmark-concurrency")
+    client = Client(HTTP_HOST="127.0.0.1")
+    connection_created.connect(add_latency)
+    try:
+        make_tasks(user, tasks)
+        client.force_login(user)
+        headers = {
+            "host": "127.0.0.1",
+            "cookie": f"{settings.SESSION_COOKIE_NAME}="
+            f"{client.cookies[settings.SESSION_COOKIE_NAME].value}",
+        }
+        total = size * requests_per_client
+        results = {}
+
+        wsgi = get_wsgi_application()
+        with ThreadPoolExecutor(wsgi_workers) as pool:
+            start = time.perf_counter()
+            statuses = list(
+                pool.map(lambda _: wsgi_get(wsgi, "/api/v1/task/", headers), range(total))
+            )
+            results["wsgi sync"] = (time.perf_counter() - start, statuses)
+
+        asgi = get_asgi_application()
+        for name, path in (("asgi sync", "/api/v1/task/"), ("asgi async", "/api/async/v1/task/")):
+
+            async def run_client():
+                return [await asgi_get(asgi, path, headers) for _ in range(requests_per_client)]
+
+            async def run_clients():
+                clients = await asyncio.gather(*(run_client() for _ in range(size)))
+                return [status for statuses in clients for status in statuses]
+
+            start = time.perf_counter()
+            statuses = asyncio.run(run_clients())
+            results[name] = (time.perf_counter() - start, statuses)
+
+        return {
+            name: {
+                "requests_per_second": round(total / seconds, 1),
+                "errors": sum(status != 200 for status in statuses),
+            }
+            for name, (seconds, statuses) in results.items()
+        }
+    finally:
+        connection_created.disconnect(add_latency)
+        client.logout()
+        user.delete()
+
+
+@benchmark("request_timing")
+def request_timing(size, repeat=200):
+    """
+    Mean latency of pages of a user with `size` tasks, without the request
+    timing middleware and template backend, with them sampling none of the
+    requests and with them timing every request in full
+    """
+    from tasks import timing
+
+    middleware = [name for name in settings.MIDDLEWARE if name != "tasks.timing.RequestTimingMiddleware"]
+    templates = [
+        {**engine, "BACKEND": "django.template.backends.django.DjangoTemplates"}
+        for engine in settings.TEMPLATES
+    ]
+    configurations = {
+        "off": {"MIDDLEWARE": middleware, "TEMPLATES": templates},
+        "sampling none": {"REQUEST_TIMING_SAMPLE_RATE": 0},
+        "sampling all": {"REQUEST_TIMING_SAMPLE_RATE": 1},
+    }
+    results = {}
+    with rolled_back():
+        user = make_user()
+        make_tasks(user, size)
+        for name, overrides in configurations.items():
+            with override_settings(**overrides):
+                client = Client(HTTP_HOST="127.0.0.1")
+                client.force_login(user)
+                for url in ("/api/v1/task/", "/all_tasks/"):
+                    client.get(url)
+                    measure_name = f"{url} {name}"
+                    with measure(results, measure_name):
+                        for _ in range(repeat):
+                            client.get(url)
+                    result = results[measure_name]
+                    result["ms_per_request"] = round(result.pop("seconds") * 1000 / repeat, 3)
+                    result["queries_per_request"] = result.pop("queries") / repeat
+    timing.reset()
+    return results
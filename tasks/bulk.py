@@ -0,0 +1,218 @@
+"""
+Create, update and delete many of a user's tasks at once, in one transaction
+and a fixed number of queries however many tasks there are.
+
+The results match a series of single saves: tasks given a priority are put
+there in the order they were given, History rows are written for status
+changes and TaskStats and the user's cache version are kept up to date.
+Deleting is a soft delete, as everywhere else.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from tasks import events
+from tasks.cache import bump_versions
+from tasks.models import (
+    RANK_GAP,
+    RANK_MIN_GAP,
+    History,
+    Task,
+    apply_stats_delta,
+    schedule_rebalance,
+    stamp_changes,
+    stats_delta,
+)
+
+
+def _spread(order, placed):
+    """
+    Give each run of placed tasks in order ranks evenly spaced between the
+    tasks around it. Returns whether every run fitted and whether the list is
+    getting crowded
+    """
+    crowded = False
+    start = 0
+    while start < len(order):
+        if id(order[start]) not in placed:
+            start += 1
+            continue
+        end = start
+        while end < len(order) and id(order[end]) in placed:
+            end += 1
+        before = order[start - 1].rank if start else None
+        after = order[end].rank if end < len(order) else None
+        count = end - start
+        if before is None and after is None:
+            ranks = [RANK_GAP * (n + 1) for n in range(count)]
+        elif before is None:
+            ranks = [after - RANK_GAP * (count - n) for n in range(count)]
+        elif after is None:
+            ranks = [before + RANK_GAP * (n + 1) for n in range(count)]
+        else:
+            step = (after - before) // (count + 1)
+            if step < 1:
+                return False, crowded
+            crowded = crowded or step < RANK_MIN_GAP
+            ranks = [before + step * (n + 1) for n in range(count)]
+        for task, rank in zip(order[start:end], ranks):
+            task.rank = rank
+        start = end
+    return True, crowded
+
+
+def place_tasks(user_id, placements, tasks=()):
+    """
+    Apply (task, priority) placements in order to the user's task lists, as
+    Task.place_at() would one save at a time, and rank each placed task
+    between its new neighbours. tasks are the unsaved versions of the user's
+    tasks being changed, new ones without a pk. Returns the other tasks whose
+    rank had to change, which only happens when a list ran out of room and
+    was spread out again
+    """
+    if not placements:
+        return []
+    current = {task.pk: task for task in tasks if task.pk is not None}
+    rows = (
+        Task.objects.filter(user=user_id, deleted=False)
+        .filter(
+            Q(completed__in={task.completed for task, _ in placements})
+            | Q(id__in=current)
+        )
+        .values_list("id", "rank", "completed")
+    )
+    given = {id(task) for task in tasks}
+    placed = {id(task) for task, _ in placements}
+    orders = {True: [], False: []}
+    candidates = [task for task in tasks if task.pk is None]
+    for task_id, rank, completed in rows:
+        task = current.get(task_id) or Task(id=task_id, rank=rank, completed=completed)
+        candidates.append(task)
+    for task in candidates:
+        if id(task) not in placed and not task.deleted:
+            orders[task.completed].append(task)
+    for order in orders.values():
+        order.sort(key=lambda task: (task.rank, task.pk))
+
+    for task, priority in placements:
+        order = orders[task.completed]
+        if task in order:
+            order.remove(task)
+        order.insert(priority - 1, task)
+
+    update_lst = []
+    for order in orders.values():
+        ranks = {id(task): task.rank for task in order}
+        fits, crowded = _spread(order, placed)
+        if not fits:
+            for position, task in enumerate(order, start=1):
+                task.rank = position * RANK_GAP
+        elif crowded:
+            schedule_rebalance(user_id)
+        for position, task in enumerate(order, start=1):
+            if id(task) in placed:
+                task.priority_ordinal = position
+            elif task.rank != ranks[id(task)] and id(task) not in given:
+                update_lst.append(task)
+    return update_lst
+
+
+def create_tasks(user, items):
+    """
+    Create tasks for user from validated TaskSerializer data, placing each
+    at its priority. Returns the new tasks, their priorities set
+    """
+    with transaction.atomic():
+        last = Task.objects.filter(user=user, deleted=False).aggregate(rank=Max("rank"))
+        last = last["rank"] or 0
+        tasks, placements = [], []
+        for item in items:
+            item = dict(item)
+            priority = item.pop("priority", None)
+            last += RANK_GAP
+            task = Task(user=user, rank=last, **item)
+            tasks.append(task)
+            if priority is not None:
+                placements.append((task, priority))
+        moved = place_tasks(user.id, placements, tasks)
+        stamp_changes(user.id, tasks + moved)
+        Task.objects.bulk_create(tasks)
+        Task.objects.bulk_update(moved, ["rank", "change_seq"])
+
+        delta = Counter()
+        for task in tasks:
+            task._loaded_values = task._field_values()
+            delta.update(stats_delta(None, task._loaded_values))
+        apply_stats_delta(user.id, delta)
+        bump_versions([user.id])
+        events.publish_changes(
+            (user.id, task.id, None, task._loaded_values) for task in tasks
+        )
+        events.publish([(user.id, "updated", {"id": task.id}) for task in moved])
+    return tasks
+
+
+def update_tasks(user, items):
+    """
+    Apply validated partial TaskSerializer data, each with the id of one of
+    user's tasks, in order. Returns the updated tasks
+    """
+    with transaction.atomic():
+        tasks = Task.objects.select_for_update().filter(
+            user=user, deleted=False, id__in=[item["id"] for item in items]
+        )
+        tasks = {task.id: task for task in tasks}
+        placements = []
+        for item in items:
+            item = dict(item)
+            task = tasks.get(item.pop("id"))
+            if task is None:
+                # Deleted since the items were validated
+                continue
+            priority = item.pop("priority", None)
+            for name, value in item.items():
+                setattr(task, name, value)
+            if priority is not None:
+                placements.append((task, priority))
+        moved = place_tasks(user.id, placements, tasks.values())
+
+        now = timezone.now()
+        changed = [task for task in tasks.values() if task.changed_fields()]
+        fields = {name for task in changed for name in task.changed_fields()}
+        for task in changed:
+            task.created_date = now
+        stamp_changes(user.id, changed + moved)
+        Task.objects.bulk_update(changed, [*fields, "created_date", "change_seq"])
+        Task.objects.bulk_update(moved, ["rank", "change_seq"])
+
+        History.objects.bulk_create(
+            History(
+                prev_status=task._loaded_values["status"],
+                updated_status=task.status,
+                task_changed=task,
+            )
+            for task in changed
+            if task.status != task._loaded_values["status"]
+        )
+        delta = Counter()
+        changes = []
+        for task in changed:
+            after = task._field_values()
+            delta.update(stats_delta(task._loaded_values, None))
+            delta.update(stats_delta(None, after))
+            changes.append((user.id, task.id, task._loaded_values, after))
+            task._loaded_values = after
+        apply_stats_delta(user.id, delta)
+        bump_versions([user.id])
+        events.publish_changes(changes)
+        events.publish([(user.id, "updated", {"id": task.id}) for task in moved])
+    return [tasks[item["id"]] for item in items if item["id"] in tasks]
+
+
+def delete_tasks(user, ids):
+    """Soft delete the user's tasks with the given ids. Returns how many"""
+    return Task.objects.filter(user=user, deleted=False, id__in=ids).tracked_update(
+        deleted=True
+    )
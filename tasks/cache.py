@@ -0,0 +1,99 @@
+"""
+Per-user cache versions for rendered task pages and API validators.
+
+Cached pages are keyed by their user's current version. Anything that
+changes a user's tasks bumps the version, so older pages are never looked up
+again and simply expire. Versions are bumped right away and again once the
+transaction commits, so a page rendered from data read before the commit
+can't be stored under the version that is current after it.
+
+A version is the time of the bump in nanoseconds, which makes it the time
+the user's tasks last changed as well. A version lost to eviction starts
+again from the current time, so it is never reused.
+
+Versions only work in a cache every process bumping them shares: with a
+locmem one, a gunicorn worker or Celery task changing the tasks leaves the
+other processes serving stale pages and 304s. The page cache and the API
+validators are off unless settings.TASKS_PAGE_CACHE, which defaults to
+whether the cache is shared, and check() warns when it is forced on locmem.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = "tasks:version:{}"
+PAGE_KEY = "tasks:page:{}:{}:{}"
+COUNTER_KEY = "tasks:page_cache:{}"
+LOCMEM_BACKEND = "django.core.cache.backends.locmem.LocMemCache"
+
+
+def enabled():
+    return settings.TASKS_PAGE_CACHE
+
+
+def check(app_configs=None, **kwargs):
+    """System check, registered in TasksConfig.ready"""
+    if enabled() and settings.CACHES["default"]["BACKEND"] == LOCMEM_BACKEND:
+        return [
+            checks.Warning(
+                "TASKS_PAGE_CACHE is on with a locmem cache, which each process "
+                "keeps for itself",
+                hint="With more than one process, set CACHE_URL to a shared "
+                "cache (redis or memcached), or leave TASKS_PAGE_CACHE off.",
+                id="tasks.W001",
+            )
+        ]
+    return []
+
+
+def get_version(user_id):
+    key = VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key, time.time_ns())
+    return version
+
+
+def _bump(user_ids):
+    version = time.time_ns()
+    cache.set_many({VERSION_KEY.format(user_id): version for user_id in user_ids}, None)
+
+
+def bump_versions(user_ids):
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if user_ids:
+        _bump(user_ids)
+        transaction.on_commit(lambda: _bump(user_ids))
+
+
+def page_cache_key(request):
+    """
+    The key for the page at request's URL as its user sees it now, or None
+    if the page can't be cached. The page holds a CSRF token, which is only
+    valid with the CSRF cookie it was rendered for, so the cookie is part of
+    the key. None as well while the page cache is off
+    """
+    csrf_cookie = request.COOKIES.get(settings.CSRF_COOKIE_NAME)
+    if not enabled() or request.method != "GET" or not request.user.is_authenticated or not csrf_cookie:
+        return None
+    user_id = request.user.id
+    digest = hashlib.md5(f"{request.get_full_path()}\n{csrf_cookie}".encode()).hexdigest()
+    return PAGE_KEY.format(user_id, get_version(user_id), digest)
+
+
+def count(result):
+    key = COUNTER_KEY.format(result)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def counters():
+    return {result: cache.get(COUNTER_KEY.format(result), 0) for result in ("hit", "miss")}
@@ -0,0 +1,176 @@
+"""
+Metrics of the Celery tasks in tasks.tasks, recorded from Celery's signals
+in whichever process runs them (a worker, or the caller in eager mode):
+
+- runs per task and final state (SUCCESS, FAILURE, RETRY);
+- how long each run took, from task_prerun to task_postrun;
+- how long it waited in the queue, from being published (stamped into a
+  header by before_task_publish) or, for a task with an ETA, from when it
+  was due, to starting;
+- the work each run did, as the task counts it with count();
+- how late report emails were sent after their users' email time, as the
+  outbox delivers them (see tasks.outbox).
+
+Values are kept in the cache, like the page cache counters, so that /metrics
+on a web process serves what the workers recorded. That takes a cache the
+processes share (CACHE_URL) with an atomic incr, which a redis or memcached
+one has; with the default locmem cache each process only sees its own.
+Histogram sums are kept in whole microseconds, since incr takes integers.
+"""
+import time
+from bisect import bisect_left
+from collections import Counter
+
+from celery import current_task
+from celery.utils.time import maybe_iso8601
+from django.core.cache import cache
+
+from task_manager.celery import app
+from tasks.timing import Histogram
+
+# Only the tasks of tasks.tasks are instrumented, so labels stay bounded
+TASK_PREFIX = "tasks.tasks."
+PUBLISHED_HEADER = "published_at"
+STATES = ("SUCCESS", "FAILURE", "RETRY")
+# What each task counts with count(), other names it passes are left out
+ITEMS = {
+    "tasks.tasks.send_email_reminder": ("reports", "chunks"),
+    "tasks.tasks.send_email_reports": ("reports", "skipped"),
+    "tasks.tasks.deliver_emails": ("sent", "failed"),
+    "tasks.tasks.rebalance_task_ranks": ("tasks",),
+    "tasks.tasks.apply_history_retention": (
+        "compacted", "archived", "purged", "claims_purged", "emails_purged",
+    ),
+    "tasks.tasks.purge_deleted_tasks": ("tasks", "history", "tombstones"),
+    "tasks.tasks.rollup_task_history": ("days", "rows"),
+}
+TASK_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+LAG_SECONDS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 3600, 21600, 86400)
+HISTOGRAMS = {
+    "duration": TASK_SECONDS_BUCKETS,
+    "queue_wait": TASK_SECONDS_BUCKETS,
+    "schedule_lag": LAG_SECONDS_BUCKETS,
+}
+KEY = "tasks:celery:{}"
+
+# perf_counter() at task_prerun, by task id
+_started = {}
+
+
+def _key(*parts):
+    return KEY.format(":".join(str(part) for part in parts))
+
+
+def _incr(key, delta=1):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, None):
+            cache.incr(key, delta)
+
+
+def _labels_key(labels):
+    return ",".join(value for _, value in labels)
+
+
+def _count(name, labels, delta=1):
+    _incr(_key(name, _labels_key(labels)), delta)
+
+
+def instrumented(name):
+    return name.startswith(TASK_PREFIX)
+
+
+def task_names():
+    return sorted(name for name in app.tasks if instrumented(name))
+
+
+def observe(name, labels, values):
+    """Add values to a histogram, in a cache incr per bucket they fall in"""
+    values = list(values)
+    if not values:
+        return
+    buckets = HISTOGRAMS[name]
+    labels_key = _labels_key(labels)
+    for index, count in Counter(bisect_left(buckets, value) for value in values).items():
+        _incr(_key(name, labels_key, index), count)
+    _incr(_key(name, labels_key, "count"), len(values))
+    _incr(_key(name, labels_key, "sum"), round(sum(values) * 1_000_000))
+
+
+def snapshot(name, label_sets):
+    """{labels: Histogram.snapshot()} of a histogram, for the label sets observed"""
+    buckets = HISTOGRAMS[name]
+    keys = {
+        labels: [
+            _key(name, _labels_key(labels), part)
+            for part in (*range(len(buckets) + 1), "sum", "count")
+        ]
+        for labels in label_sets
+    }
+    values = cache.get_many([key for label_keys in keys.values() for key in label_keys])
+    snapshots = {}
+    for labels, label_keys in keys.items():
+        *counts, total, count = (values.get(key, 0) for key in label_keys)
+        if not count:
+            continue
+        histogram = Histogram(buckets)
+        histogram.counts = counts
+        histogram.sum = total / 1_000_000
+        snapshots[labels] = histogram.snapshot()
+    return snapshots
+
+
+def counters(name, label_sets):
+    """{labels: value} of a counter"""
+    keys = {labels: _key(name, _labels_key(labels)) for labels in label_sets}
+    values = cache.get_many(list(keys.values()))
+    return {labels: values.get(key, 0) for labels, key in keys.items()}
+
+
+def count(**items):
+    """
+    Add to the work counters of the running task, e.g. count(sent=3). Does
+    nothing outside a task run, as when a task is called as a function
+    """
+    task = current_task
+    if task is None or task.request.called_directly or not instrumented(task.name):
+        return
+    for item in ITEMS.get(task.name, ()):
+        if items.get(item):
+            _count("items", (("task", task.name), ("item", item)), items[item])
+
+
+def stamp_published(sender=None, headers=None, **kwargs):
+    """before_task_publish receiver, stamping when the task was published"""
+    if headers is not None and instrumented(sender or ""):
+        headers[PUBLISHED_HEADER] = time.time()
+
+
+def _header(request, name):
+    # Worker requests have the message headers as attributes, eager ones
+    # the headers they were applied with
+    return getattr(request, name, None) or (request.headers or {}).get(name)
+
+
+def task_started(sender=None, task_id=None, task=None, **kwargs):
+    """task_prerun receiver"""
+    if not instrumented(task.name):
+        return
+    _started[task_id] = time.perf_counter()
+    published = _header(task.request, PUBLISHED_HEADER)
+    if published is None:
+        return
+    eta = maybe_iso8601(task.request.eta) if task.request.eta else None
+    since = max(published, eta.timestamp()) if eta else published
+    observe("queue_wait", (("task", task.name),), [max(time.time() - since, 0)])
+
+
+def task_finished(sender=None, task_id=None, task=None, state=None, **kwargs):
+    """task_postrun receiver"""
+    started = _started.pop(task_id, None)
+    if started is None:
+        return
+    observe("duration", (("task", task.name),), [time.perf_counter() - started])
+    if state in STATES:
+        _count("runs", (("task", task.name), ("state", state)))
@@ -0,0 +1,191 @@
+"""
+Synthetic datasets for benchmarks and load tests: users named
+"<prefix>-<n>" with their EmailSettings, tasks in every status and a chain
+of History rows per task, spread over the past days.
+
+Everything is written with bulk_create in batches, in one transaction, and
+kept consistent the way single saves would: tasks are ranked RANK_GAP apart,
+numbered in their owner's ChangeSequence and counted in TaskStats, and each
+task's History ends at its current status. The same arguments and seed give
+the same dataset, so runs against it can be compared.
+
+Rows refer to the ids bulk_create gives the rows they were created with,
+so only backends that return those are supported: PostgreSQL, MariaDB 10.5+
+and SQLite 3.35+.
+"""
+import random
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import NotSupportedError, connection, transaction
+from django.utils import timezone
+
+from tasks.analytics import rollups_stale_from
+from tasks.models import (
+    RANK_GAP,
+    STATUS_CHOICES,
+    ChangeSequence,
+    DailyTaskRollup,
+    EmailOutbox,
+    EmailSettings,
+    History,
+    HistoryArchive,
+    ReminderClaim,
+    Task,
+    TaskStats,
+    TaskTombstone,
+    stats_delta,
+)
+
+STATUSES = [status for status, _ in STATUS_CHOICES]
+# How often each status comes up, in STATUSES order
+STATUS_WEIGHTS = [40, 25, 25, 10]
+VERBS = ["Review", "Write", "Plan", "Fix", "Call", "Update", "Prepare", "Send", "Check", "Book"]
+NOUNS = [
+    "budget report", "release notes", "team meeting", "invoice", "dentist appointment",
+    "project roadmap", "quarterly review", "flight tickets", "onboarding guide", "backlog",
+]
+
+
+def dataset_users(prefix):
+    return User.objects.filter(username__startswith=f"{prefix}-")
+
+
+def _statuses(rng, status, count):
+    """count (prev_status, updated_status) pairs in order, ending at status"""
+    chain = [status]
+    for _ in range(count):
+        chain.append(rng.choice([other for other in STATUSES if other != chain[-1]]))
+    chain.reverse()
+    return list(zip(chain, chain[1:]))
+
+
+def _create_tasks(rng, tasks, history, days, batch_size):
+    """Insert tasks, then history rows for them. Returns how many rows"""
+    Task.objects.bulk_create(tasks, batch_size=batch_size)
+    today = timezone.now().date()
+    rows, dates = [], []
+    for task in tasks:
+        changed = sorted(rng.randrange(days) for _ in range(history))
+        for (prev_status, updated_status), days_ago in zip(
+            _statuses(rng, task.status, history), reversed(changed)
+        ):
+            rows.append(
+                History(prev_status=prev_status, updated_status=updated_status, task_changed=task)
+            )
+            dates.append(today - timedelta(days=days_ago))
+    History.objects.bulk_create(rows, batch_size=batch_size)
+    # changed_date is auto_now, so it is set afterwards, a day at a time
+    days_rows = defaultdict(list)
+    for row, changed_date in zip(rows, dates):
+        days_rows[changed_date].append(row.id)
+    for changed_date, ids in days_rows.items():
+        History.objects.filter(id__in=ids).update(changed_date=changed_date)
+    if dates:
+        rollups_stale_from(min(dates))
+    return len(rows)
+
+
+def generate(users, tasks, history, prefix="synthetic", days=90, batch_size=1000, seed=0):
+    """
+    Create users with tasks each and history rows per task, over the last
+    days. Returns the number of users, tasks and history rows created
+    """
+    if not connection.features.can_return_rows_from_bulk_insert:
+        raise NotSupportedError("Datasets need a database returning the ids of bulk inserts")
+    rng = random.Random(seed)
+    # Hashing is slow on purpose, every user shares one password
+    password = make_password(prefix)
+    now = timezone.now()
+    report = Counter()
+    with transaction.atomic():
+        created = User.objects.bulk_create(
+            (
+                User(username=f"{prefix}-{n}", email=f"{prefix}-{n}@example.com", password=password)
+                for n in range(1, users + 1)
+            ),
+            batch_size=batch_size,
+        )
+        report["users"] = len(created)
+        EmailSettings.objects.bulk_create(
+            (
+                EmailSettings(user=user, email_time=now, email_date=now, next_send_at=now)
+                for user in created
+            ),
+            batch_size=batch_size,
+        )
+        ChangeSequence.objects.bulk_create(
+            (ChangeSequence(user=user, value=tasks) for user in created),
+            batch_size=batch_size,
+        )
+
+        stats, pending = [], []
+        for user in created:
+            counts = Counter()
+            for n in range(1, tasks + 1):
+                status = rng.choices(STATUSES, STATUS_WEIGHTS)[0]
+                task = Task(
+                    title=f"{rng.choice(VERBS)} {rng.choice(NOUNS)}",
+                    description=f"Generated task {n} of {user.username}",
+                    completed=status == "COMPLETED",
+                    status=status,
+                    rank=n * RANK_GAP,
+                    change_seq=n,
+                    user=user,
+                )
+                counts.update(stats_delta(None, task._field_values()))
+                pending.append(task)
+                if len(pending) >= batch_size:
+                    report["history"] += _create_tasks(rng, pending, history, days, batch_size)
+                    report["tasks"] += len(pending)
+                    pending = []
+            stats.append(TaskStats(user=user, **counts))
+        report["history"] += _create_tasks(rng, pending, history, days, batch_size)
+        report["tasks"] += len(pending)
+        TaskStats.objects.bulk_create(stats, batch_size=batch_size)
+    return dict(report)
+
+
+def _delete_tasks(user_ids, batch_size):
+    """Delete the users' tasks and their history in SQL, batch_size users a statement"""
+    quote = connection.ops.quote_name
+    history = quote(History._meta.db_table)
+    task_changed = quote(History._meta.get_field("task_changed").column)
+    tasks = quote(Task._meta.db_table)
+    task_id = quote(Task._meta.pk.column)
+    user = quote(Task._meta.get_field("user").column)
+    with connection.cursor() as cursor:
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start : start + batch_size]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(
+                f"DELETE FROM {history} WHERE {task_changed} IN "
+                f"(SELECT {task_id} FROM {tasks} WHERE {user} IN ({placeholders}))",
+                batch,
+            )
+            cursor.execute(f"DELETE FROM {tasks} WHERE {user} IN ({placeholders})", batch)
+
+
+def delete(prefix="synthetic", batch_size=500):
+    """Delete the users of a dataset with everything of theirs. Returns how many"""
+    users = dataset_users(prefix)
+    user_ids = list(users.values_list("id", flat=True))
+    emails = list(users.values_list("email", flat=True))
+    with transaction.atomic():
+        # Nothing of theirs outlives the users, so their tasks and history go
+        # in plain DELETEs, without the signals keeping stats, caches and
+        # sync clients up to date (a query or more per row). Which leaves
+        # every table those would have written, or the users' deletion
+        # cascaded to, to delete explicitly, in a statement each as well
+        _delete_tasks(user_ids, batch_size)
+        TaskTombstone.objects.filter(user_id__in=user_ids).delete()
+        for model in (
+            ChangeSequence, TaskStats, DailyTaskRollup, HistoryArchive, EmailSettings,
+            ReminderClaim,
+        ):
+            model.objects.filter(user__in=user_ids).delete()
+        EmailOutbox.objects.filter(to__in=emails).delete()
+        User.objects.filter(id__in=user_ids).delete()
+    return len(user_ids)
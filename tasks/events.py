@@ -0,0 +1,303 @@
+"""
+Task change events for the server-sent events stream (tasks.sse).
+
+Writes publish (user id, event, data) triples once their transaction
+commits, event being one of EVENTS. The broker named by TASK_EVENTS_BROKER
+hands them to the user's subscribers and keeps the last TASK_EVENTS_REPLAY
+of them per user, so a client that reconnects with the id of the last event
+it saw gets the ones it missed. If those are gone already it gets a "reset"
+event instead and should fetch its tasks afresh.
+
+Each subscriber has a queue of TASK_EVENTS_QUEUE_SIZE events. A client too
+slow to keep it from filling up is disconnected rather than buffered for,
+and catches up from the replay when it reconnects.
+
+InProcessBroker only reaches subscribers in the publishing process, which
+suits a single server process with Celery eager, and tests. Writes made by
+Celery workers (rebalancing, purges) or by other server processes never
+reach its subscribers, so any deployment with more than one process needs
+RedisBroker. That keeps each user's events in a Redis stream, so events
+published by any web or Celery process reach every server.
+
+InProcessBroker keeps replay only for users that subscribed in its
+process, the TASK_EVENTS_REPLAY_USERS who did so last, so processes without
+subscribers keep nothing. Its ids restart with the process, and a client
+coming back with an id past the latest one gets a "reset" too.
+"""
+import asyncio
+import json
+import threading
+from collections import OrderedDict, defaultdict, deque
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+EVENTS = ("created", "updated", "status_changed", "deleted")
+# The task fields events carry, besides the id
+EVENT_FIELDS = ("title", "description", "completed", "status")
+
+OVERFLOW = object()
+
+
+def task_event(task_id, before, after):
+    """
+    The (event, data) for a task going from the `before` to the `after`
+    state, dicts of field values (before is None for a new task, after for a
+    removed one), or None if nothing clients see changed
+    """
+    if before is None:
+        return "created", {"id": task_id, **{name: after[name] for name in EVENT_FIELDS if name in after}}
+    if after is None or (after.get("deleted") and not before.get("deleted")):
+        return "deleted", {"id": task_id}
+    changed = {
+        name: after[name]
+        for name in EVENT_FIELDS
+        if name in after and (name not in before or before[name] != after[name])
+    }
+    if "status" in changed:
+        return "status_changed", {"id": task_id, **changed}
+    if changed or after.get("rank", before.get("rank")) != before.get("rank"):
+        return "updated", {"id": task_id, **changed}
+    return None
+
+
+def publish(events):
+    """Publish (user id, event, data) triples once the transaction commits"""
+    events = [event for event in events if event[0] is not None]
+    if events:
+        transaction.on_commit(lambda: get_broker().publish(events))
+
+
+def publish_changes(changes):
+    """Publish the events for (user id, task id, before, after) changes"""
+    events = []
+    for user_id, task_id, before, after in changes:
+        event = task_event(task_id, before, after)
+        if event is not None:
+            events.append((user_id, *event))
+    publish(events)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    return import_string(settings.TASK_EVENTS_BROKER)()
+
+
+class Subscription:
+    """One client's queue of events, filled from any thread"""
+
+    def __init__(self, user_id, cursor, queue_size):
+        self.user_id = user_id
+        self.cursor = cursor
+        self.queue_size = queue_size
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.overflowed = False
+
+    def put(self, message):
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The loop is closed, the subscription is on its way out
+            pass
+
+    def _put(self, message):
+        if self.overflowed:
+            return
+        if self.queue.qsize() >= self.queue_size:
+            self.overflowed = True
+            message = OVERFLOW
+        self.queue.put_nowait(message)
+
+
+class InProcessBroker:
+    def __init__(self, replay=None, queue_size=None, replay_users=None):
+        self.replay = replay or settings.TASK_EVENTS_REPLAY
+        self.queue_size = queue_size or settings.TASK_EVENTS_QUEUE_SIZE
+        self.replay_users = replay_users or settings.TASK_EVENTS_REPLAY_USERS
+        self.lock = threading.Lock()
+        # Replay of the users that subscribed here, least recently first
+        self.history = OrderedDict()
+        self.last_ids = {}
+        self.subscriptions = defaultdict(set)
+
+    def parse_id(self, event_id):
+        return int(event_id)
+
+    def publish(self, events):
+        with self.lock:
+            for user_id, event, data in events:
+                if user_id not in self.history:
+                    # Nobody here to replay it to
+                    continue
+                self.last_ids[user_id] += 1
+                message = (str(self.last_ids[user_id]), event, data)
+                self.history[user_id].append(message)
+                self.deliver(user_id, message)
+
+    def deliver(self, user_id, message):
+        event_id = self.parse_id(message[0])
+        for subscription in self.subscriptions.get(user_id, ()):
+            if subscription.cursor is None or event_id > subscription.cursor:
+                subscription.cursor = event_id
+                subscription.put(message)
+
+    def track(self, user_id):
+        """Keep replay for user_id, dropping that of the least recent users past replay_users"""
+        if user_id in self.history:
+            self.history.move_to_end(user_id)
+            return
+        self.history[user_id] = deque(maxlen=self.replay)
+        self.last_ids[user_id] = 0
+        while len(self.history) > self.replay_users:
+            # Users with a live subscription keep theirs, ids mustn't restart under it
+            idle = next((other for other in self.history if other not in self.subscriptions), None)
+            if idle is None:
+                break
+            del self.history[idle], self.last_ids[idle]
+
+    def backlog(self, user_id, last_event_id):
+        """
+        The messages after last_event_id, or a reset message if some of them
+        are gone (or last_event_id is past the latest message, one of an
+        earlier process), and the id of the latest message
+        """
+        self.track(user_id)
+        history = self.history[user_id]
+        last_id = self.last_ids[user_id]
+        if last_event_id is None or last_event_id == last_id:
+            return [], last_id
+        if (
+            last_event_id > last_id
+            or not history
+            or self.parse_id(history[0][0]) > last_event_id + 1
+        ):
+            return [(str(last_id), "reset", {})], last_id
+        return [message for message in history if self.parse_id(message[0]) > last_event_id], last_id
+
+    def start(self, subscription, last_event_id):
+        """Attach subscription, returning the messages it missed"""
+        with self.lock:
+            backlog, subscription.cursor = self.backlog(subscription.user_id, last_event_id)
+            self.attach(subscription)
+        return backlog
+
+    def attach(self, subscription):
+        self.subscriptions[subscription.user_id].add(subscription)
+
+    def detach(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions[subscription.user_id]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+
+    async def subscribe(self, user_id, last_event_id=None, timeout=None):
+        """
+        Yield the user's (event id, event, data) messages after last_event_id
+        as they are published, and None after every `timeout` seconds without
+        any. Ends when the subscriber falls too far behind
+        """
+        try:
+            last_event_id = None if last_event_id is None else self.parse_id(last_event_id)
+        except ValueError:
+            last_event_id = None
+        subscription = Subscription(user_id, None, self.queue_size)
+        loop = asyncio.get_running_loop()
+        backlog = await loop.run_in_executor(None, self.start, subscription, last_event_id)
+        try:
+            for message in backlog:
+                yield message
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if message is OVERFLOW:
+                    return
+                yield message
+        finally:
+            self.detach(subscription)
+
+
+class RedisBroker(InProcessBroker):
+    """
+    Events in one Redis stream per user, capped at about TASK_EVENTS_REPLAY
+    entries. A listener thread per process reads the streams of the users
+    subscribed here and hands new entries to their subscriptions
+    """
+
+    key = "tasks:events:{}"
+
+    def __init__(self, url=None, **kwargs):
+        import redis
+
+        super().__init__(**kwargs)
+        self.redis = redis.Redis.from_url(url or settings.TASK_EVENTS_REDIS_URL)
+        self.listener = None
+
+    def parse_id(self, event_id):
+        if isinstance(event_id, bytes):
+            event_id = event_id.decode()
+        milliseconds, _, sequence = event_id.partition("-")
+        return int(milliseconds), int(sequence or 0)
+
+    def publish(self, events):
+        pipeline = self.redis.pipeline(transaction=False)
+        for user_id, event, data in events:
+            pipeline.xadd(
+                self.key.format(user_id),
+                {"event": event, "data": json.dumps(data)},
+                maxlen=self.replay,
+                approximate=True,
+            )
+        pipeline.execute()
+
+    def message(self, entry_id, fields):
+        return entry_id.decode(), fields[b"event"].decode(), json.loads(fields[b"data"])
+
+    def backlog(self, user_id, last_event_id):
+        key = self.key.format(user_id)
+        latest = self.redis.xrevrange(key, count=1)
+        if not latest:
+            # A client that saw events of a stream since gone starts over
+            return ([("0-0", "reset", {})] if last_event_id else []), (0, 0)
+        last_id = self.parse_id(latest[0][0])
+        if last_event_id is None or last_event_id == last_id:
+            return [], last_id
+        if last_event_id > last_id:
+            return [(latest[0][0].decode(), "reset", {})], last_id
+        first = self.parse_id(self.redis.xrange(key, count=1)[0][0])
+        if first > last_event_id and self.redis.xlen(key) >= self.replay:
+            # Trimmed, the ones right after last_event_id may be gone
+            return [(latest[0][0].decode(), "reset", {})], last_id
+        cursor = "{}-{}".format(*last_event_id)
+        entries = self.redis.xread({key: cursor}, count=self.replay)
+        return [self.message(*entry) for entry in entries[0][1]] if entries else [], last_id
+
+    def attach(self, subscription):
+        super().attach(subscription)
+        if self.listener is None or not self.listener.is_alive():
+            self.listener = threading.Thread(target=self.listen, daemon=True)
+            self.listener.start()
+
+    def listen(self):
+        while True:
+            with self.lock:
+                cursors = {
+                    self.key.format(user_id): "{}-{}".format(
+                        *min(subscription.cursor for subscription in subscriptions)
+                    )
+                    for user_id, subscriptions in self.subscriptions.items()
+                }
+                if not cursors:
+                    self.listener = None
+                    return
+            for key, entries in self.redis.xread(cursors, count=100, block=1000) or ():
+                user_id = int(key.decode().rpartition(":")[2])
+                with self.lock:
+                    for entry in entries:
+                        self.deliver(user_id, self.message(*entry))
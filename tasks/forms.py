@@ -1,6 +1,6 @@
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
 from django.core.exceptions import ValidationError
-from django.forms import ModelForm, EmailField, DateTimeField
+from django.forms import ModelForm, EmailField, DateTimeField, IntegerField
 from django.contrib.auth.models import User
 from tasks.models import Task, EmailSettings
 from datetime import datetime, timedelta
@@ -10,8 +10,12 @@ check_box_style = "h-6 w-6 rounded border-slate-100  shadow-inner border-none bg
 
 
 class TaskCreateForm(ModelForm):
+    priority = IntegerField()
+
     def __init__(self, *args, **kwargs):
         super(TaskCreateForm, self).__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.initial.setdefault("priority", self.instance.priority)
         for visible in self.visible_fields():
             try:
                 if visible.field.widget.input_type == "checkbox":
@@ -34,6 +38,11 @@ class TaskCreateForm(ModelForm):
             raise ValidationError("Prioriry must be greater than zero!")
         return priority
 
+    def save(self, commit=True):
+        if "priority" in self.changed_data:
+            self.instance.priority = self.cleaned_data["priority"]
+        return super().save(commit)
+
     class Meta:
         model = Task
         fields = ["title", "description", "priority", "completed", "status"]
@@ -0,0 +1,266 @@
+"""
+Latency and throughput of every route in the URLconf, measured in process.
+
+Each route is requested `requests` times at each concurrency level, by that
+many threads with a test Client each, as the users of a tasks.dataset
+dataset in turn. Routes with a GET are requested with one, the others (and
+those that need a query) as ROUTE_REQUESTS says. Every route gets a warm-up
+request first, so caches are as warm as on a running server.
+
+Results are JSON friendly: for each "<METHOD> /<route>" and concurrency,
+latency percentiles in milliseconds, requests per second, queries per
+request and the statuses returned. compare() lines two runs up, so a
+change can be checked against a baseline saved before it.
+"""
+import math
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.urls import get_resolver
+
+from tasks.dataset import dataset_users
+from tasks.models import EmailSettings, History, Task
+from tasks.timing import route_name
+
+# Routes requested with something other than a plain GET: a function of the
+# target giving the method and data, or None to leave the route out
+ROUTE_REQUESTS = {
+    # Would end the session the target's other requests share
+    "/user/logout/": None,
+    "/complete_task/<pk>/": lambda target: ("post", {}),
+    "/api/v1/task/search/": lambda target: ("get", {"q": "report"}),
+    "/api/v1/task/reorder/": lambda target: (
+        "post",
+        {"moves": [{"id": target["task"], "priority": 1}]},
+    ),
+    "/api/v1/task/bulk/": lambda target: (
+        "patch",
+        [{"id": target["task"], "title": "Load tested"}],
+    ),
+}
+# The target's object each route parameter names, where not its task
+ROUTE_PARAMS = {
+    "/settings/<pk>/": {"pk": "settings"},
+    "/complete_task/<pk>/": {"pk": "other_task"},
+    "/api/v1/task/<task_pk>/history/<pk>/": {"pk": "history"},
+}
+
+
+def routes(urlconf=None):
+    """The routes of the URLconf, included ones by their prefix only"""
+    for pattern in get_resolver(urlconf).url_patterns:
+        route = route_name(str(pattern.pattern))
+        if route not in ROUTE_REQUESTS or ROUTE_REQUESTS[route] is not None:
+            yield route
+
+
+def make_targets(prefix):
+    """
+    A target per dataset user with two pending tasks: the user, the first
+    of those with one of its history rows, the other and the settings
+    """
+    targets = []
+    for user in dataset_users(prefix).order_by("id"):
+        tasks = list(
+            Task.objects.filter(user=user, deleted=False, completed=False)
+            .order_by("rank")
+            .values_list("id", flat=True)[:2]
+        )
+        history = History.objects.filter(task_changed__in=tasks[:1]).values_list("id", flat=True)
+        email_settings = EmailSettings.objects.filter(user=user).values_list("id", flat=True)
+        if len(tasks) == 2 and history and email_settings:
+            targets.append(
+                {
+                    "user": user,
+                    "task": tasks[0],
+                    "other_task": tasks[1],
+                    "history": history[0],
+                    "settings": email_settings[0],
+                }
+            )
+    return targets
+
+
+def build_request(route, target):
+    """(method, path, data) requesting route as target"""
+    method, data = ("get", None)
+    if route in ROUTE_REQUESTS:
+        method, data = ROUTE_REQUESTS[route](target)
+    params = {"pk": "task", "task_pk": "task", **ROUTE_PARAMS.get(route, {})}
+    path = re.sub(
+        r"<(?:\w+:)?(\w+)>", lambda match: str(target[params[match.group(1)]]), route
+    )
+    return method, path, data
+
+
+class QueryCounter:
+    """
+    An execute wrapper counting the queries of the connections it is put on:
+    this thread's and those opened while it is installed, which covers the
+    pool threads the async views query from as long as they connect during
+    the run (they do in a fresh process)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def add(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    @contextmanager
+    def installed(self):
+        connection.execute_wrappers.append(self)
+        connection_created.connect(self.add)
+        try:
+            yield self
+        finally:
+            connection_created.disconnect(self.add)
+            connection.execute_wrappers.remove(self)
+
+
+def send(client, method, path, data):
+    """Make a request, returning (seconds, status)"""
+    kwargs = {"content_type": "application/json"} if path.startswith("/api/") else {}
+    start = time.perf_counter()
+    response = getattr(client, method)(path, data, **kwargs)
+    if response.streaming:
+        b"".join(response.streaming_content)
+    return time.perf_counter() - start, response.status_code
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+def summarize(samples, seconds, queries):
+    latencies = sorted(elapsed for elapsed, _ in samples)
+    statuses = Counter(str(status) for _, status in samples)
+    return {
+        "requests": len(samples),
+        "errors": sum(count for status, count in statuses.items() if int(status) >= 400),
+        "statuses": dict(sorted(statuses.items())),
+        **{
+            f"p{percent}_ms": round(percentile(latencies, percent) * 1000, 2)
+            for percent in (50, 95, 99)
+        },
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+        "requests_per_second": round(len(samples) / seconds, 1),
+        "queries": round(queries / len(samples), 1),
+    }
+
+
+def run_route(route, targets, sessions, requests, concurrency, counter):
+    """Request route `requests` times from `concurrency` threads"""
+    plan = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        # A server error is a result like any other status
+        client = Client(HTTP_HOST="127.0.0.1", raise_request_exception=False)
+        samples = []
+        try:
+            while True:
+                with lock:
+                    n = next(plan, None)
+                if n is None:
+                    return samples
+                target = targets[n % len(targets)]
+                client.cookies[settings.SESSION_COOKIE_NAME] = sessions[n % len(targets)]
+                samples.append(send(client, *build_request(route, target)))
+        finally:
+            if concurrency > 1:
+                # Threads of the pool don't go through request_finished
+                connection.close()
+
+    queries = counter.count
+    start = time.perf_counter()
+    if concurrency == 1:
+        # In this thread, so uncommitted data (in tests) is seen too
+        samples = worker()
+    else:
+        with ThreadPoolExecutor(concurrency) as pool:
+            futures = [pool.submit(worker) for _ in range(concurrency)]
+            samples = [sample for future in futures for sample in future.result()]
+    return summarize(samples, time.perf_counter() - start, counter.count - queries)
+
+
+def run(prefix, requests=100, concurrency=(1,), only=None):
+    """
+    Load test the routes whose "<METHOD> /<route>" contains one of `only`
+    (all of them by default) as the users of the dataset with prefix.
+    Levels above 1 need the dataset committed, their threads have
+    connections of their own
+    """
+    targets = make_targets(prefix)
+    if not targets:
+        raise ValueError(f"No user of the {prefix!r} dataset has two pending tasks with history")
+    clients = []
+    for target in targets:
+        client = Client(HTTP_HOST="127.0.0.1")
+        client.force_login(target["user"])
+        clients.append(client)
+    sessions = [client.cookies[settings.SESSION_COOKIE_NAME].value for client in clients]
+    results = {}
+    try:
+        with QueryCounter().installed() as counter:
+            for route in routes():
+                method, path, data = build_request(route, targets[0])
+                name = f"{method.upper()} {route}"
+                if only and not any(part in name for part in only):
+                    continue
+                send(clients[0], method, path, data)
+                results[name] = {
+                    str(level): run_route(route, targets, sessions, requests, level, counter)
+                    for level in concurrency
+                }
+    finally:
+        for client in clients:
+            client.logout()
+    return results
+
+
+def compare(baseline, results, max_regression=None, min_ms=1.0):
+    """
+    Lines comparing results with a baseline run, and those of them that
+    regressed: p95 latency up by more than max_regression percent (and
+    min_ms), or more queries per request
+    """
+    lines, regressions = [], []
+    for name, levels in results.items():
+        for level, current in levels.items():
+            before = baseline.get(name, {}).get(level)
+            if before is None:
+                lines.append(f"{name} @{level}: new")
+                continue
+            slowdown = current["p95_ms"] - before["p95_ms"]
+            change = slowdown / before["p95_ms"] * 100 if before["p95_ms"] else 0
+            line = (
+                f"{name} @{level}: p95 {before['p95_ms']} -> {current['p95_ms']} ms ({change:+.0f}%), "
+                f"queries {before['queries']} -> {current['queries']}"
+            )
+            lines.append(line)
+            slower = (
+                max_regression is not None
+                and change > max_regression
+                and slowdown > min_ms
+            )
+            if slower or current["queries"] > before["queries"]:
+                regressions.append(line)
+    for name in baseline.keys() - results.keys():
+        lines.append(f"{name}: gone")
+    return lines, regressions
@@ -0,0 +1,25 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from tasks.analytics import first_history_date, rollup_history
+
+
+class Command(BaseCommand):
+    help = (
+        "Roll up the History of every finished day from --start (the first day "
+        "with history) up to --end (today) afresh, for /api/v1/stats/"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", type=date.fromisoformat, help="YYYY-MM-DD")
+        parser.add_argument("--end", type=date.fromisoformat, help="YYYY-MM-DD, not included")
+        parser.add_argument("--chunk-days", type=int, default=31)
+
+    def handle(self, *args, **options):
+        start = options["start"] or first_history_date()
+        if start is None:
+            self.stdout.write("No history to roll up")
+            return
+        report = rollup_history(start, options["end"], chunk_days=options["chunk_days"])
+        self.stdout.write("Rolled up {days} days into {rows} rows".format(**report))
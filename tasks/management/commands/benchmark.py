@@ -0,0 +1,24 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tasks.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Run a benchmark against the configured database and print the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(BENCHMARKS))
+        parser.add_argument(
+            "--sizes", nargs="+", type=int, default=[100, 1000, 10000]
+        )
+
+    def handle(self, *args, **options):
+        results = {}
+        for size in options["sizes"]:
+            if size <= 0:
+                raise CommandError("Sizes must be positive")
+            results[size] = BENCHMARKS[options["name"]](size)
+            self.stderr.write(f"{options['name']} {size}: {results[size]}")
+        self.stdout.write(json.dumps({options["name"]: results}, indent=2))
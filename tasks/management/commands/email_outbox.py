@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from tasks import outbox
+from tasks.metrics import collect
+
+
+class Command(BaseCommand):
+    help = "Show the email outbox metrics, optionally deliver due emails or requeue dead ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--deliver", action="store_true")
+        parser.add_argument("--requeue-dead", action="store_true")
+
+    def handle(self, *args, **options):
+        if options["requeue_dead"]:
+            self.stdout.write(f"Requeued {outbox.requeue_dead()} dead emails")
+        if options["deliver"]:
+            report = outbox.deliver()
+            self.stdout.write("Delivered {sent}, failed {failed} in {seconds}s".format(**report))
+        for name, kind, documentation, samples in collect():
+            if not name.startswith("email_outbox_"):
+                continue
+            for labels, value in samples.items():
+                label = ",".join(f"{key}={label_value}" for key, label_value in labels)
+                self.stdout.write(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tasks import dataset
+
+
+class Command(BaseCommand):
+    help = (
+        "Create --users users named <prefix>-<n> with --tasks tasks each and "
+        "--history history rows per task, for benchmarks and load tests"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10)
+        parser.add_argument("--tasks", type=int, default=100, help="per user")
+        parser.add_argument("--history", type=int, default=3, help="per task")
+        parser.add_argument("--days", type=int, default=90, help="of history, up to today")
+        parser.add_argument("--prefix", default="synthetic")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--delete", action="store_true", help="delete the dataset with this prefix instead"
+        )
+
+    def handle(self, *args, **options):
+        prefix = options["prefix"]
+        if options["delete"]:
+            count = dataset.delete(prefix)
+            self.stdout.write(f"Deleted {count} users and their tasks")
+            return
+        if dataset.dataset_users(prefix).exists():
+            raise CommandError(f"There is a {prefix!r} dataset already, delete it first")
+        if min(options["users"], options["tasks"], options["days"], options["batch_size"]) < 1:
+            raise CommandError("--users, --tasks, --days and --batch-size must be positive")
+        if options["history"] < 0:
+            raise CommandError("--history must not be negative")
+        report = dataset.generate(
+            options["users"],
+            options["tasks"],
+            options["history"],
+            prefix=prefix,
+            days=options["days"],
+            batch_size=options["batch_size"],
+            seed=options["seed"],
+        )
+        self.stdout.write(
+            "Created {users} users, {tasks} tasks and {history} history rows".format(**report)
+        )
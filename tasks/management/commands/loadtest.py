@@ -0,0 +1,91 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tasks import dataset, loadtest
+from tasks.models import History, Task
+
+
+class Command(BaseCommand):
+    help = (
+        "Request every route of the app in process at each --concurrency level and "
+        "print latency percentiles, throughput and queries per request as JSON. "
+        "Runs as the users of the --prefix dataset, generated for the run (and "
+        "deleted after it) unless there is one already"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--prefix", default="loadtest")
+        parser.add_argument("--users", type=int, default=10)
+        parser.add_argument("--tasks", type=int, default=100, help="per user")
+        parser.add_argument("--history", type=int, default=3, help="per task")
+        parser.add_argument("--requests", type=int, default=100, help="per route and level")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+        parser.add_argument(
+            "--route", nargs="+", dest="only", help="only routes containing one of these"
+        )
+        parser.add_argument("--output", help="also save the results to this file")
+        parser.add_argument("--baseline", help="results file to compare with")
+        parser.add_argument(
+            "--max-regression",
+            type=float,
+            help="fail if a p95 latency grew by more than this percent, or queries grew",
+        )
+
+    def handle(self, *args, **options):
+        if options["requests"] < 1 or min(options["concurrency"]) < 1:
+            raise CommandError("--requests and --concurrency must be positive")
+        if options["max_regression"] is not None and not options["baseline"]:
+            raise CommandError("--max-regression needs a --baseline")
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as file:
+                baseline = json.load(file)
+
+        prefix = options["prefix"]
+        generated = not dataset.dataset_users(prefix).exists()
+        if generated:
+            if options["tasks"] < 2 or options["history"] < 1:
+                raise CommandError("The dataset needs --tasks 2 and --history 1 at least")
+            dataset.generate(options["users"], options["tasks"], options["history"], prefix=prefix)
+        try:
+            users = dataset.dataset_users(prefix)
+            report = {
+                "database": connection.vendor,
+                "dataset": {
+                    "users": users.count(),
+                    "tasks": Task.objects.filter(user__in=users).count(),
+                    "history": History.objects.filter(task_changed__user__in=users).count(),
+                },
+                "requests": options["requests"],
+                "routes": loadtest.run(
+                    prefix,
+                    requests=options["requests"],
+                    concurrency=options["concurrency"],
+                    only=options["only"],
+                ),
+            }
+        except ValueError as error:
+            raise CommandError(error)
+        finally:
+            if generated:
+                dataset.delete(prefix)
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output + "\n")
+        self.stdout.write(output)
+        if baseline is None:
+            return
+        lines, regressions = loadtest.compare(
+            baseline["routes"], report["routes"], options["max_regression"]
+        )
+        for line in lines:
+            self.stderr.write(line)
+        if options["max_regression"] is not None and regressions:
+            raise CommandError(
+                f"{len(regressions)} regression(s) against {options['baseline']}:\n"
+                + "\n".join(regressions)
+            )
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from tasks.retention import apply_retention
+
+
+class Command(BaseCommand):
+    help = "Compact, archive and purge History rows (defaults come from settings)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--compact-after", type=int, help="days")
+        parser.add_argument("--archive-after", type=int, help="days")
+        parser.add_argument("--batch-size", type=int)
+
+    def handle(self, *args, **options):
+        report = apply_retention(
+            compact_after_days=options["compact_after"],
+            archive_after_days=options["archive_after"],
+            batch_size=options["batch_size"],
+        )
+        self.stdout.write(
+            "Compacted {compacted}, archived {archived} and purged {purged} "
+            "history rows, purged {claims_purged} reminder claims and "
+            "{emails_purged} sent emails in {seconds}s".format(**report)
+        )
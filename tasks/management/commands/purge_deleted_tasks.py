@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from tasks.retention import purge_tasks
+
+
+class Command(BaseCommand):
+    help = "Delete tasks soft deleted long ago for good, with their history (defaults come from settings)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--after", type=int, help="days")
+        parser.add_argument("--batch-size", type=int)
+        parser.add_argument("--pause", type=float, help="seconds between batches")
+        parser.add_argument("--max-seconds", type=float)
+
+    def handle(self, *args, **options):
+        report = purge_tasks(
+            after_days=options["after"],
+            batch_size=options["batch_size"],
+            pause=options["pause"],
+            max_seconds=options["max_seconds"],
+        )
+        self.stdout.write(
+            "Purged {tasks} tasks and {history} history rows in {batches} batches "
+            "in {seconds}s, and {tombstones} tombstones".format(**report)
+        )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from tasks.models import reconcile_task_stats
+
+
+class Command(BaseCommand):
+    help = "Recount every user's TaskStats from their tasks and fix any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, nargs="+", dest="user_ids")
+
+    def handle(self, *args, **options):
+        repaired = reconcile_task_stats(options["user_ids"])
+        self.stdout.write(f"Repaired task stats for {repaired} user(s)")
@@ -0,0 +1,203 @@
+"""
+Metrics for monitoring. A metric is a function registered with @metric that
+returns its current value, or a {labels: value} dict where labels is a tuple
+of (name, value) pairs. Values are read when collected, from the database or
+the cache where they have to agree across web and worker processes.
+
+The values of a histogram are Histogram.snapshot()s (see tasks.timing).
+Request timings are kept per process, so /metrics serves those of the
+process that answers the scrape, while Celery task metrics are kept in the
+cache (see tasks.celerymetrics). render() formats everything for Prometheus.
+"""
+from datetime import timedelta
+
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from tasks import cache as page_cache
+from tasks import celerymetrics
+from tasks import timing
+from tasks.models import OUTBOX_STATUS_CHOICES, EmailOutbox
+
+METRICS = {}
+
+
+def metric(name, kind, documentation):
+    def register(func):
+        METRICS[name] = (kind, documentation, func)
+        return func
+
+    return register
+
+
+def collect():
+    """Yield (name, kind, documentation, {labels: value}) for every metric"""
+    for name, (kind, documentation, func) in METRICS.items():
+        samples = func()
+        if not isinstance(samples, dict):
+            samples = {(): samples}
+        yield name, kind, documentation, samples
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _sample(name, labels, value):
+    if not labels:
+        return f"{name} {value}"
+    label = ",".join(f'{key}="{_escape(label_value)}"' for key, label_value in labels)
+    return f"{name}{{{label}}} {value}"
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for name, kind, documentation, samples in collect():
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples.items():
+            if kind != "histogram":
+                lines.append(_sample(name, labels, value))
+                continue
+            buckets, total, count = value
+            for bound, observations in buckets:
+                le = "+Inf" if bound == float("inf") else str(float(bound))
+                lines.append(_sample(f"{name}_bucket", (*labels, ("le", le)), observations))
+            lines.append(_sample(f"{name}_sum", labels, round(total, 6)))
+            lines.append(_sample(f"{name}_count", labels, count))
+    return "\n".join(lines) + "\n"
+
+
+@metric("email_outbox_messages", "gauge", "Emails in the outbox by status")
+def email_outbox_messages():
+    counts = dict(
+        EmailOutbox.objects.order_by().values_list("status").annotate(Count("id"))
+    )
+    return {
+        (("status", status),): counts.get(status, 0)
+        for status, _ in OUTBOX_STATUS_CHOICES
+    }
+
+
+@metric(
+    "email_outbox_oldest_pending_seconds",
+    "gauge",
+    "Age of the oldest email waiting to be sent",
+)
+def email_outbox_oldest_pending_seconds():
+    oldest = EmailOutbox.objects.filter(status="PENDING").aggregate(
+        oldest=Min("created_date")
+    )["oldest"]
+    if oldest is None:
+        return 0
+    return round((timezone.now() - oldest).total_seconds(), 3)
+
+
+@metric("email_outbox_sent_last_minute", "gauge", "Emails delivered in the last minute")
+def email_outbox_sent_last_minute():
+    since = timezone.now() - timedelta(minutes=1)
+    return EmailOutbox.objects.filter(status="SENT", sent_date__gte=since).count()
+
+
+@metric(
+    "task_page_cache_requests_total",
+    "counter",
+    "Task page requests served from (hit) or rendered into (miss) the page cache",
+)
+def task_page_cache_requests_total():
+    return {
+        (("result", result),): value for result, value in page_cache.counters().items()
+    }
+
+
+@metric("http_request_duration_seconds", "histogram", "Time to respond to requests")
+def http_request_duration_seconds():
+    return timing.snapshot("duration")
+
+
+@metric(
+    "http_request_view_seconds",
+    "histogram",
+    "Time sampled requests spent in their view, templates rendered after it left out",
+)
+def http_request_view_seconds():
+    return timing.snapshot("view")
+
+
+@metric("http_request_sql_seconds", "histogram", "Time sampled requests spent on SQL")
+def http_request_sql_seconds():
+    return timing.snapshot("sql")
+
+
+@metric("http_request_queries", "histogram", "Queries per sampled request")
+def http_request_queries():
+    return timing.snapshot("queries")
+
+
+@metric(
+    "http_request_template_seconds",
+    "histogram",
+    "Time sampled requests spent rendering templates",
+)
+def http_request_template_seconds():
+    return timing.snapshot("template")
+
+
+@metric(
+    "celery_task_runs_total",
+    "counter",
+    "Runs of the Celery tasks by the state they ended in",
+)
+def celery_task_runs_total():
+    return celerymetrics.counters(
+        "runs",
+        [
+            (("task", name), ("state", state))
+            for name in celerymetrics.task_names()
+            for state in celerymetrics.STATES
+        ],
+    )
+
+
+@metric(
+    "celery_task_items_total",
+    "counter",
+    "Work done by the Celery tasks, as each of them counts it",
+)
+def celery_task_items_total():
+    return celerymetrics.counters(
+        "items",
+        [
+            (("task", name), ("item", item))
+            for name in celerymetrics.task_names()
+            for item in celerymetrics.ITEMS.get(name, ())
+        ],
+    )
+
+
+@metric("celery_task_duration_seconds", "histogram", "Time the Celery tasks took to run")
+def celery_task_duration_seconds():
+    return celerymetrics.snapshot(
+        "duration", [(("task", name),) for name in celerymetrics.task_names()]
+    )
+
+
+@metric(
+    "celery_task_queue_wait_seconds",
+    "histogram",
+    "Time Celery tasks waited to start after they were published, or due",
+)
+def celery_task_queue_wait_seconds():
+    return celerymetrics.snapshot(
+        "queue_wait", [(("task", name),) for name in celerymetrics.task_names()]
+    )
+
+
+@metric(
+    "email_report_schedule_lag_seconds",
+    "histogram",
+    "How late report emails were sent after their users' email time",
+)
+def email_report_schedule_lag_seconds():
+    return celerymetrics.snapshot("schedule_lag", [()])
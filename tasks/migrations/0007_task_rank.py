@@ -0,0 +1,70 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:31
+
+from django.db import migrations, models
+
+# tasks.models.RANK_GAP at the time of writing
+RANK_GAP = 1 << 20
+BATCH_SIZE = 2000
+
+
+def backfill_rank(apps, schema_editor):
+    Task = apps.get_model("tasks", "Task")
+    tasks = Task.objects.order_by("user_id", "priority", "id").only(
+        "id", "user_id", "priority"
+    )
+    update_lst, user_id, position = [], None, 0
+    for task in tasks.iterator(chunk_size=BATCH_SIZE):
+        if task.user_id != user_id:
+            user_id, position = task.user_id, 0
+        position += 1
+        task.rank = position * RANK_GAP
+        update_lst.append(task)
+        if len(update_lst) >= BATCH_SIZE:
+            Task.objects.bulk_update(update_lst, ["rank"])
+            update_lst = []
+    Task.objects.bulk_update(update_lst, ["rank"])
+
+
+def restore_priority(apps, schema_editor):
+    Task = apps.get_model("tasks", "Task")
+    tasks = Task.objects.order_by("user_id", "rank", "id").only("id", "user_id", "rank")
+    update_lst, user_id, position = [], None, 0
+    for task in tasks.iterator(chunk_size=BATCH_SIZE):
+        if task.user_id != user_id:
+            user_id, position = task.user_id, 0
+        position += 1
+        task.priority = position
+        update_lst.append(task)
+        if len(update_lst) >= BATCH_SIZE:
+            Task.objects.bulk_update(update_lst, ["priority"])
+            update_lst = []
+    Task.objects.bulk_update(update_lst, ["priority"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0006_emailsettings_email_date_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='rank',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rank, restore_priority),
+        migrations.RemoveConstraint(
+            model_name='task',
+            name='priority_gt_0',
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='priority',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.RemoveField(
+            model_name='task',
+            name='priority',
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0008_history_retention'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['task_changed', 'changed_date'], name='history_task_date'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('completed', False), ('deleted', False)), fields=['user', 'rank', 'id'], name='task_pending_rank'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('completed', True), ('deleted', False)), fields=['user', 'rank', 'id'], name='task_completed_rank'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['user', 'rank', 'id'], name='task_user_rank'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('tasks', '0009_task_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='task_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('active_count', models.IntegerField(default=0)),
+                ('completed_count', models.IntegerField(default=0)),
+                ('status_pending', models.IntegerField(default=0)),
+                ('status_in_progress', models.IntegerField(default=0)),
+                ('status_completed', models.IntegerField(default=0)),
+                ('status_cancelled', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
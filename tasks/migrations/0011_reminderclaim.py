@@ -0,0 +1,30 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tasks', '0010_taskstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReminderClaim',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('report_date', models.DateField()),
+                ('claim', models.CharField(max_length=32)),
+                ('claimed_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='reminderclaim',
+            constraint=models.UniqueConstraint(fields=('user', 'report_date'), name='reminder_claim_user_day'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:58
+
+from datetime import datetime, timezone
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def backfill_next_send_at(apps, schema_editor):
+    EmailSettings = apps.get_model("tasks", "EmailSettings")
+    settings = EmailSettings.objects.filter(email_enable=True).only(
+        "id", "email_date", "email_time"
+    )
+    update_lst = []
+    for email in settings.iterator(chunk_size=BATCH_SIZE):
+        email.next_send_at = datetime.combine(
+            email.email_date, email.email_time, tzinfo=timezone.utc
+        )
+        update_lst.append(email)
+        if len(update_lst) >= BATCH_SIZE:
+            EmailSettings.objects.bulk_update(update_lst, ["next_send_at"])
+            update_lst = []
+    EmailSettings.objects.bulk_update(update_lst, ["next_send_at"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0012_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailsettings',
+            name='next_send_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_next_send_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='emailsettings',
+            index=models.Index(fields=['next_send_at'], name='email_next_send'),
+        ),
+    ]
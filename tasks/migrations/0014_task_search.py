@@ -0,0 +1,82 @@
+from django.db import migrations
+
+# The SQL as of this migration, frozen here rather than read from
+# tasks.search, which may change after it has run. The SQLite triggers are
+# reinstalled from tasks.search after every migrate as well.
+FTS_TABLE = "tasks_task_fts"
+SQLITE_ROW = (
+    "{row}.id, {row}.title, {row}.description, "
+    "CASE WHEN {row}.deleted THEN NULL ELSE 'u' || {row}.user_id END"
+)
+SQLITE_INSERT = (
+    f"INSERT INTO {FTS_TABLE}(rowid, title, description, owner) "
+    f"VALUES ({SQLITE_ROW.format(row='new')});"
+)
+SQLITE_DELETE = (
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description, owner) "
+    f"VALUES ('delete', {SQLITE_ROW.format(row='old')});"
+)
+SQLITE_TRIGGERS = (
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON tasks_task "
+    f"BEGIN {SQLITE_INSERT} END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON tasks_task "
+    f"BEGIN {SQLITE_DELETE} END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update "
+    f"AFTER UPDATE OF title, description, user_id, deleted ON tasks_task "
+    f"BEGIN {SQLITE_DELETE} {SQLITE_INSERT} END",
+)
+SQLITE_RANK = "bm25(10.0, 1.0, 0.0)"
+POSTGRES_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "title, description, owner, content='', tokenize='porter unicode61')"
+        )
+        schema_editor.execute(
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('rank', %s)",
+            [SQLITE_RANK],
+        )
+        schema_editor.execute(
+            f"INSERT INTO {FTS_TABLE}(rowid, title, description, owner) "
+            f"SELECT {SQLITE_ROW.format(row='tasks_task')} FROM tasks_task"
+        )
+        for sql in SQLITE_TRIGGERS:
+            schema_editor.execute(sql)
+    elif vendor == "postgresql":
+        # Not in the model state: Django 4.0 has no field for a generated
+        # column, see Task
+        schema_editor.execute(
+            "ALTER TABLE tasks_task ADD COLUMN search_vector tsvector "
+            f"GENERATED ALWAYS AS ({POSTGRES_VECTOR}) STORED"
+        )
+        schema_editor.execute(
+            "CREATE INDEX task_search ON tasks_task USING gin (search_vector)"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        for trigger in ("insert", "delete", "update"):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{trigger}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    elif vendor == "postgresql":
+        schema_editor.execute("ALTER TABLE tasks_task DROP COLUMN IF EXISTS search_vector")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0013_emailsettings_next_send_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
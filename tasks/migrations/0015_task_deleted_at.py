@@ -0,0 +1,30 @@
+# Generated by Django 4.0.1 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+def backfill_deleted_at(apps, schema_editor):
+    # created_date is the time of the last save, the closest there is to
+    # when the task was deleted
+    Task = apps.get_model("tasks", "Task")
+    Task.objects.filter(deleted=True).update(deleted_at=models.F("created_date"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0014_task_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_deleted_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('deleted', True)), fields=['id', 'deleted_at'], name='task_deleted'),
+        ),
+    ]
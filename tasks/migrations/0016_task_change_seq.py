@@ -0,0 +1,68 @@
+# Generated by Django 4.0.1 on 2026-10-18 12:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_change_seq(apps, schema_editor):
+    # Ids only grow, so they number existing tasks in a valid order
+    Task = apps.get_model("tasks", "Task")
+    ChangeSequence = apps.get_model("tasks", "ChangeSequence")
+    Task.objects.update(change_seq=models.F("id"))
+    latest = (
+        Task.objects.filter(user__isnull=False)
+        .values("user")
+        .annotate(value=models.Max("id"))
+        .order_by()
+    )
+    ChangeSequence.objects.bulk_create(
+        ChangeSequence(user_id=row["user"], value=row["value"]) for row in latest
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('tasks', '0015_task_deleted_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeSequence',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='change_sequence', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('value', models.BigIntegerField(default=0)),
+                ('reset_below', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TaskTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField()),
+                ('task_id', models.BigIntegerField()),
+                ('change_seq', models.BigIntegerField()),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_change_seq, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['user', 'change_seq'], name='task_change_seq'),
+        ),
+        migrations.AddIndex(
+            model_name='tasktombstone',
+            index=models.Index(fields=['user_id', 'change_seq'], name='tombstone_change_seq'),
+        ),
+        migrations.AddIndex(
+            model_name='tasktombstone',
+            index=models.Index(fields=['created_date'], name='tombstone_created'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.0.1 on 2026-10-18 12:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tasks', '0016_task_change_seq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTaskRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('completed', models.IntegerField(default=0)),
+                ('closed', models.IntegerField(default=0)),
+                ('reopened', models.IntegerField(default=0)),
+                ('stints_pending', models.IntegerField(default=0)),
+                ('stints_in_progress', models.IntegerField(default=0)),
+                ('stints_completed', models.IntegerField(default=0)),
+                ('stints_cancelled', models.IntegerField(default=0)),
+                ('days_pending', models.IntegerField(default=0)),
+                ('days_in_progress', models.IntegerField(default=0)),
+                ('days_completed', models.IntegerField(default=0)),
+                ('days_cancelled', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['changed_date'], name='history_date'),
+        ),
+        migrations.AddIndex(
+            model_name='historyarchive',
+            index=models.Index(fields=['changed_date'], name='history_archive_date'),
+        ),
+        migrations.AddField(
+            model_name='dailytaskrollup',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='dailytaskrollup',
+            index=models.Index(fields=['date'], name='rollup_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailytaskrollup',
+            constraint=models.UniqueConstraint(fields=('user', 'date'), name='rollup_user_date'),
+        ),
+    ]
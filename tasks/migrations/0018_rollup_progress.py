@@ -0,0 +1,32 @@
+# Generated by Django 4.0.1 on 2026-10-18 14:09
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def start_from_rollups(apps, schema_editor):
+    # Rollups were written a day at a time from the first day with history,
+    # so the days up to the last one with rollups are all rolled up
+    DailyTaskRollup = apps.get_model("tasks", "DailyTaskRollup")
+    RollupProgress = apps.get_model("tasks", "RollupProgress")
+    last = DailyTaskRollup.objects.aggregate(date=models.Max("date"))["date"]
+    RollupProgress.objects.create(id=1, rolled_up_until=last and last + timedelta(days=1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0017_daily_task_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rolled_up_until', models.DateField(null=True)),
+            ],
+        ),
+        migrations.RunPython(start_from_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0018_rollup_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailoutbox',
+            name='due_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
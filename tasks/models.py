@@ -1,10 +1,17 @@
-from django.db import models
+from collections import Counter, defaultdict
+
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import pre_save
+from django.db.models import Count, F, Max, Q, Window
+from django.db.models.functions import RowNumber
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
 from datetime import datetime
 
+from tasks import events
+from tasks.cache import bump_versions
+
 
 STATUS_CHOICES = (
     ("PENDING", "PENDING"),
@@ -13,6 +20,85 @@ STATUS_CHOICES = (
     ("CANCELLED", "CANCELLED"),
 )
 
+OUTBOX_STATUS_CHOICES = (
+    ("PENDING", "PENDING"),
+    ("SENT", "SENT"),
+    ("DEAD", "DEAD"),
+)
+
+# TaskStats column holding the number of pending tasks in each status
+STATUS_COUNT_FIELDS = {status: f"status_{status.lower()}" for status, _ in STATUS_CHOICES}
+
+# Tasks are ordered by a sparse rank rather than by a dense priority, so that
+# moving a task only rewrites that task's row. New ranks are spaced RANK_GAP
+# apart and a rebalance is scheduled once two neighbours are closer than
+# RANK_MIN_GAP.
+RANK_GAP = 1 << 20
+RANK_MIN_GAP = 1 << 4
+
+
+class TaskQuerySet(models.QuerySet):
+    def tracked_update(self, **kwargs):
+        """
+        QuerySet.update() for tasks. update() skips save() and its signals, so
+        this writes the History rows and TaskStats changes in bulk instead, and
+        bumps the owners' cache versions
+        """
+        kwargs.setdefault("created_date", timezone.now())
+        if "deleted" in kwargs:
+            kwargs.setdefault("deleted_at", kwargs["created_date"] if kwargs["deleted"] else None)
+        with transaction.atomic():
+            rows = list(
+                self.select_for_update().values(
+                    "id", "user", "deleted", "completed", "status"
+                )
+            )
+            count = self.update(**kwargs)
+
+            if "status" in kwargs:
+                History.objects.bulk_create(
+                    History(
+                        prev_status=row["status"],
+                        updated_status=kwargs["status"],
+                        task_changed_id=row["id"],
+                    )
+                    for row in rows
+                    if row["status"] != kwargs["status"]
+                )
+
+            deltas = defaultdict(Counter)
+            changes = []
+            stamped = defaultdict(list)
+            moved_from = defaultdict(list)
+            for row in rows:
+                after = {**row, **kwargs}
+                user_id = getattr(after["user"], "pk", after["user"])
+                deltas[row["user"]].update(stats_delta(row, None))
+                deltas[user_id].update(stats_delta(None, after))
+                stamped[user_id].append(Task(id=row["id"], user_id=user_id))
+                if user_id == row["user"]:
+                    changes.append((user_id, row["id"], row, after))
+                else:
+                    moved_from[row["user"]].append(row["id"])
+                    changes.append((row["user"], row["id"], row, None))
+                    changes.append((user_id, row["id"], None, after))
+            for user_id, delta in deltas.items():
+                apply_stats_delta(user_id, delta)
+            stamped.pop(None, None)
+            for user_id, tasks in stamped.items():
+                stamp_changes(user_id, tasks)
+            Task.objects.bulk_update(
+                [task for tasks in stamped.values() for task in tasks], ["change_seq"]
+            )
+            for user_id, task_ids in moved_from.items():
+                bury_tasks(user_id, task_ids)
+            events.publish_changes(changes)
+            bump_versions(
+                [row["user"] for row in rows]
+                + [getattr(kwargs.get("user"), "pk", kwargs.get("user"))]
+            )
+        return count
+
 
 class Task(models.Model):
     title = models.CharField(max_length=100)
@@ -20,26 +106,641 @@ class Task(models.Model):
     completed = models.BooleanField(default=False)
     created_date = models.DateTimeField(auto_now=True)
     deleted = models.BooleanField(default=False)
-    priority = models.IntegerField()
+    # When the task was soft deleted, purged for good after a grace period
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
+    rank = models.BigIntegerField(default=0)
+    # The number of the task's last change in its owner's ChangeSequence
+    change_seq = models.BigIntegerField(default=0, editable=False)
     status = models.CharField(
         max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0]
     )
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    # On PostgreSQL tasks_task also has a generated search_vector column,
+    # added by migration 0014 outside the model state: Django 4.0 has no field
+    # for a generated column, and would write to one if it were declared. It
+    # is only read, by raw SQL in tasks.search
+
+    objects = TaskQuerySet.as_manager()
 
     class Meta:
-        constraints = [
-            models.CheckConstraint(check=models.Q(priority__gt=0), name="priority_gt_0")
+        indexes = [
+            # One index per list a task can be on. The pending and completed
+            # ones also serve priorities and the progress counts.
+            models.Index(
+                fields=["user", "rank", "id"],
+                name="task_pending_rank",
+                condition=Q(deleted=False, completed=False),
+            ),
+            models.Index(
+                fields=["user", "rank", "id"],
+                name="task_completed_rank",
+                condition=Q(deleted=False, completed=True),
+            ),
+            models.Index(
+                fields=["user", "rank", "id"],
+                name="task_user_rank",
+                condition=Q(deleted=False),
+            ),
+            # Deleted tasks in purge order, so purging never reads live rows
+            models.Index(
+                fields=["id", "deleted_at"],
+                name="task_deleted",
+                condition=Q(deleted=True),
+            ),
+            # A user's changes since a sync cursor, deleted tasks included
+            models.Index(fields=["user", "change_seq"], name="task_change_seq"),
         ]
 
+    _requested_priority = None
+    # Field values as last loaded from or written to the database
+    _loaded_values = {}
+
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = instance._field_values()
+        return instance
+
+    def _field_values(self):
+        return {
+            field.attname: self.__dict__[field.attname]
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__
+        }
+
+    def changed_fields(self):
+        """Names of the loaded fields that differ from the database"""
+        return [
+            name
+            for name, value in self._field_values().items()
+            if name not in self._loaded_values or self._loaded_values[name] != value
+        ]
+
+    @property
+    def priority(self):
+        """
+        The requested priority, or the one numbered by a paginator,
+        place_at() or number_priorities(); None until then, this never
+        queries
+        """
+        if self._requested_priority is not None:
+            return self._requested_priority
+        return self.__dict__.get("priority_ordinal")
+
+    @priority.setter
+    def priority(self, value):
+        # The move itself happens on save(), see place_at()
+        self._requested_priority = value
+
+    def siblings(self):
+        return Task.objects.filter(
+            user=self.user_id, deleted=False, completed=self.completed
+        ).exclude(pk=self.pk)
+
+    def place_at(self, priority=None):
+        """
+        Give the task a rank between the tasks currently at priority - 1 and
+        priority, or after the last task if priority is None.
+        Only this task's rank changes, so no other rows are written.
+        """
+        siblings = self.siblings().order_by("rank", "id")
+        if priority is None or priority <= 0:
+            neighbours = []
+        else:
+            start = max(priority - 2, 0)
+            neighbours = list(siblings.values_list("rank", flat=True)[start:priority])
+        if priority == 1:
+            before, after = None, neighbours[0] if neighbours else None
+        elif neighbours:
+            before, after = neighbours[0], (neighbours[1:] or [None])[0]
+        else:
+            last = siblings.aggregate(rank=Max("rank"), count=Count("id"))
+            before, after, priority = last["rank"], None, last["count"] + 1
+
+        if before is None and after is None:
+            rank = RANK_GAP
+        elif before is None:
+            rank = after - RANK_GAP
+        elif after is None:
+            rank = before + RANK_GAP
+        else:
+            if after - before < 2:
+                # Out of room between the neighbours, spread the list out
+                # again and look them up afresh
+                rebalance_ranks(self.user_id)
+                return self.place_at(priority)
+            rank = (before + after) // 2
+            if after - before < RANK_MIN_GAP:
+                schedule_rebalance(self.user_id)
+
+        self.rank = rank
+        self.priority_ordinal = priority
+        self._requested_priority = None
+
+    def stamp_deleted_at(self):
+        if "deleted" not in self.__dict__:
+            return
+        deleted_at = self.__dict__.get("deleted_at")
+        if self.deleted and deleted_at is None:
+            self.deleted_at = timezone.now()
+        elif not self.deleted and deleted_at is not None:
+            self.deleted_at = None
+
+    def save(self, *args, **kwargs):
+        self.stamp_deleted_at()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "deleted" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "deleted_at"}
+        if self._requested_priority is not None:
+            self.place_at(self._requested_priority)
+        elif self._state.adding:
+            self.place_at()
+        if not (self._state.adding or args or kwargs.get("force_insert")):
+            if kwargs.get("update_fields") is None:
+                changed = self.changed_fields()
+                if not changed:
+                    return
+                kwargs["update_fields"] = changed + ["created_date"]
+        changes = self._stats_changes()
+        with transaction.atomic():
+            self._stamp_change(kwargs)
+            super().save(*args, **kwargs)
+            for user_id, delta in changes:
+                apply_stats_delta(user_id, delta)
+        self._loaded_values = self._field_values()
+
+    def _stamp_change(self, kwargs):
+        """Give the task the next number of its owner's change sequence"""
+        previous_user_id = self._loaded_values.get("user_id", self.user_id)
+        if not self._state.adding and previous_user_id != self.user_id:
+            bury_tasks(previous_user_id, [self.pk])
+        stamp_changes(self.user_id, [self])
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "change_seq"}
+
+    def _stats_changes(self):
+        """(user id, delta) pairs this save makes to TaskStats"""
+        after = self._field_values()
+        before = None if self._state.adding else {**after, **self._loaded_values}
+        if before is None or before["user_id"] == after["user_id"]:
+            changes = [(after["user_id"], stats_delta(before, after))]
+        else:
+            changes = [
+                (before["user_id"], stats_delta(before, None)),
+                (after["user_id"], stats_delta(None, after)),
+            ]
+        return [(user_id, delta) for user_id, delta in changes if any(delta.values())]
+
+
+def rebalance_ranks(user_id, batch_size=1000):
+    """
+    Spread a user's task ranks back out to RANK_GAP apart, keeping their order.
+    Returns the number of tasks whose rank changed
+    """
+    with transaction.atomic():
+        tasks = (
+            Task.objects.select_for_update()
+            .filter(user=user_id, deleted=False)
+            .order_by("rank", "id")
+            .only("id", "rank")
+        )
+        update_lst = []
+        for position, task in enumerate(tasks, start=1):
+            if task.rank != position * RANK_GAP:
+                task.rank = position * RANK_GAP
+                update_lst.append(task)
+        stamp_changes(user_id, update_lst)
+        Task.objects.bulk_update(update_lst, ["rank", "change_seq"], batch_size=batch_size)
+        if update_lst:
+            # Page links carry ranks in their cursors
+            bump_versions([user_id])
+    return len(update_lst)
+
+
+def _assign_ranks(user_id, tasks, ordered_ids):
+    """
+    Hand the ranks currently held by tasks back out in the order of
+    ordered_ids, so the set of ranks in use does not change
+    """
+    ranks = sorted(task.rank for task in tasks.values())
+    if len(set(ranks)) != len(ranks):
+        rebalance_ranks(user_id)
+        for task in Task.objects.filter(id__in=tasks).only("id", "rank"):
+            tasks[task.id].rank = task.rank
+        ranks = sorted(task.rank for task in tasks.values())
+
+    update_lst = []
+    for task_id, rank in zip(ordered_ids, ranks):
+        task = tasks[task_id]
+        if task.rank != rank:
+            task.rank = rank
+            update_lst.append(task)
+    stamp_changes(user_id, update_lst)
+    Task.objects.bulk_update(update_lst, ["rank", "change_seq"])
+    if update_lst:
+        bump_versions([user_id])
+        events.publish([(user_id, "updated", {"id": task.id}) for task in update_lst])
+    return update_lst
+
+
+def reorder_tasks(user_id, ids):
+    """
+    Put the given tasks in the order of ids, relative to each other. Tasks not
+    listed keep their place. Returns the tasks that were written
+    """
+    with transaction.atomic():
+        tasks = Task.objects.select_for_update().filter(
+            user=user_id, deleted=False, id__in=ids
+        )
+        tasks = {task.id: task for task in tasks.only("id", "rank")}
+        return _assign_ranks(user_id, tasks, [i for i in ids if i in tasks])
+
+
+def move_tasks(user_id, moves):
+    """
+    Apply a list of (task id, priority) moves to the user's pending tasks in
+    order, then write the final order at once. Moves of tasks no longer
+    pending by the time they are locked are skipped, as reorder_tasks skips
+    them. Returns the pending task ids in their new order
+    """
+    with transaction.atomic():
+        tasks = (
+            Task.objects.select_for_update()
+            .filter(user=user_id, deleted=False, completed=False)
+            .order_by("rank", "id")
+            .only("id", "rank")
+        )
+        tasks = {task.id: task for task in tasks}
+        order = list(tasks)
+        for task_id, priority in moves:
+            if task_id not in tasks:
+                continue
+            order.remove(task_id)
+            order.insert(priority - 1, task_id)
+        _assign_ranks(user_id, tasks, order)
+    return order
+
+
+def task_priorities(tasks):
+    """
+    {task id: priority} for the (id, user id, completed, rank) of tasks that
+    are not deleted, their 1..N position in the owner's pending (or
+    completed) list. Numbered by a RowNumber window in one query per list,
+    over the tasks ranked up to the last of them
+    """
+    lists = defaultdict(dict)
+    for task_id, user_id, completed, rank in tasks:
+        lists[user_id, completed][task_id] = rank
+    priorities = {}
+    for (user_id, completed), ranks in lists.items():
+        numbered = (
+            Task.objects.filter(
+                user=user_id, deleted=False, completed=completed, rank__lte=max(ranks.values())
+            )
+            .annotate(position=Window(RowNumber(), order_by=[F("rank").asc(), F("id").asc()]))
+            .values_list("id", "position")
+        )
+        priorities.update(
+            (task_id, position) for task_id, position in numbered if task_id in ranks
+        )
+    return priorities
+
+
+def number_priorities(tasks):
+    """Set the priority of each of tasks that is not deleted. Returns tasks"""
+    priorities = task_priorities(
+        (task.id, task.user_id, task.completed, task.rank) for task in tasks if not task.deleted
+    )
+    for task in tasks:
+        task.priority_ordinal = priorities.get(task.id)
+    return tasks
+
+
+class TaskStats(models.Model):
+    """
+    Per user task counts, so progress can be shown without counting tasks.
+    active_count and completed_count cover the user's tasks that are not
+    deleted, the status_* counts only the pending ones among those
+    """
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="task_stats"
+    )
+    active_count = models.IntegerField(default=0)
+    completed_count = models.IntegerField(default=0)
+    status_pending = models.IntegerField(default=0)
+    status_in_progress = models.IntegerField(default=0)
+    status_completed = models.IntegerField(default=0)
+    status_cancelled = models.IntegerField(default=0)
+
+    @classmethod
+    def for_user(cls, user):
+        try:
+            return cls.objects.get(user=user)
+        except cls.DoesNotExist:
+            reconcile_task_stats([user.id])
+            return cls.objects.get(user=user)
+
+
+STATS_FIELDS = ["active_count", "completed_count", *STATUS_COUNT_FIELDS.values()]
+
+
+def stats_delta(before, after):
+    """
+    How TaskStats counts change when a task goes from the `before` to the
+    `after` state, given as dicts with deleted, completed and status, or None
+    if the task does not exist on that side
+    """
+    delta = Counter()
+    for state, sign in ((after, 1), (before, -1)):
+        if state is None or state["deleted"]:
+            continue
+        if state["completed"]:
+            fields = ["active_count", "completed_count"]
+        else:
+            fields = ["active_count", STATUS_COUNT_FIELDS[state["status"]]]
+        delta.update({field: sign for field in fields})
+    return delta
+
+
+def apply_stats_delta(user_id, delta):
+    """
+    Add delta to the user's TaskStats. Users without a TaskStats row yet are
+    left alone, their row is counted from scratch when it is first read
+    """
+    delta = {field: value for field, value in delta.items() if value}
+    if user_id is None or not delta:
+        return
+    TaskStats.objects.filter(user=user_id).update(
+        **{field: F(field) + value for field, value in delta.items()}
+    )
+
+
+def reconcile_task_stats(user_ids=None):
+    """
+    Recount TaskStats for the given users (all users by default) from their
+    tasks. Returns the number of rows that were missing or wrong
+    """
+    users = User.objects.all()
+    if user_ids is not None:
+        users = users.filter(id__in=user_ids)
+    counts = (
+        Task.objects.filter(deleted=False, user__in=users)
+        .values("user")
+        .annotate(
+            active_count=Count("id"),
+            completed_count=Count("id", filter=Q(completed=True)),
+            **{
+                field: Count("id", filter=Q(completed=False, status=status))
+                for status, field in STATUS_COUNT_FIELDS.items()
+            },
+        )
+    )
+    counts = {row.pop("user"): row for row in counts}
+
+    with transaction.atomic():
+        stored = TaskStats.objects.select_for_update().filter(user__in=users)
+        stored = {stats.user_id: stats for stats in stored}
+        create_lst, update_lst = [], []
+        for user_id in users.values_list("id", flat=True):
+            actual = counts.get(user_id, dict.fromkeys(STATS_FIELDS, 0))
+            stats = stored.get(user_id)
+            if stats is None:
+                create_lst.append(TaskStats(user_id=user_id, **actual))
+            elif any(getattr(stats, field) != actual[field] for field in STATS_FIELDS):
+                for field in STATS_FIELDS:
+                    setattr(stats, field, actual[field])
+                update_lst.append(stats)
+        TaskStats.objects.bulk_create(create_lst, ignore_conflicts=True)
+        TaskStats.objects.bulk_update(update_lst, STATS_FIELDS)
+        bump_versions(stats.user_id for stats in update_lst)
+    return len(create_lst) + len(update_lst)
+
+
+class ChangeSequence(models.Model):
+    """
+    Numbers every change to a user's tasks, for tasks.sync. value is the
+    number of the last change. Clients whose copy is complete up to a number
+    lower than reset_below have missed changes there is no record of any
+    more, and start over
+    """
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="change_sequence"
+    )
+    value = models.BigIntegerField(default=0)
+    reset_below = models.BigIntegerField(default=0)
+
+
+def allocate_changes(user_id, count=1):
+    """
+    Take the next count numbers of the user's change sequence and return the
+    first, or None for tasks without a user. Call it inside the transaction
+    making the changes: it holds the user's row until the transaction ends,
+    so a user's changes become visible in the order of their numbers
+    """
+    if user_id is None or not count:
+        return None
+    for _ in range(2):
+        value = _take_changes(user_id, count)
+        if value is not None:
+            return value - count + 1
+        ChangeSequence.objects.bulk_create(
+            [ChangeSequence(user_id=user_id)], ignore_conflicts=True
+        )
+    raise ChangeSequence.DoesNotExist
+
+
+def _take_changes(user_id, count):
+    """Add count to the user's sequence, returning its new value if it has one"""
+    if connection.vendor in ("postgresql", "sqlite"):
+        # One statement, so a save doesn't cost a lookup on top of its write
+        table = connection.ops.quote_name(ChangeSequence._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET value = value + %s WHERE user_id = %s RETURNING value",
+                [count, user_id],
+            )
+            row = cursor.fetchone()
+        return row and row[0]
+    sequence = ChangeSequence.objects.filter(user=user_id)
+    if sequence.update(value=F("value") + count):
+        return sequence.values_list("value", flat=True).get()
+    return None
+
+
+def stamp_changes(user_id, tasks):
+    """Set change_seq on the user's tasks about to be written"""
+    first = allocate_changes(user_id, len(tasks))
+    if first is not None:
+        for number, task in enumerate(tasks, start=first):
+            task.change_seq = number
+
+
+def bury_tasks(user_id, task_ids):
+    """Record that the user's tasks are gone, deleted or given to another user"""
+    if user_id is None or not task_ids:
+        return
+    # Without a sequence (the user is being deleted, say) no client has
+    # synced the tasks, and creating one would outlive the user
+    last = _take_changes(user_id, len(task_ids))
+    if last is not None:
+        TaskTombstone.objects.bulk_create(
+            TaskTombstone(user_id=user_id, task_id=task_id, change_seq=number)
+            for number, task_id in enumerate(task_ids, start=last - len(task_ids) + 1)
+        )
+
+
+def expire_changes(user_id, through):
+    """
+    Make clients that have not synced the user's change number `through`
+    start over, once the record of that change is gone for good
+    """
+    ChangeSequence.objects.filter(user=user_id, reset_below__lt=through).update(
+        reset_below=through
+    )
+
+
+class TaskTombstone(models.Model):
+    """
+    A task gone from a user's tasks without a soft deleted row to show for
+    it, kept for tasks.sync until tasks.retention purges it
+    """
+
+    # Not a foreign key, tombstones are written while users are deleted too
+    user_id = models.IntegerField()
+    task_id = models.BigIntegerField()
+    change_seq = models.BigIntegerField()
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_id", "change_seq"], name="tombstone_change_seq"),
+            models.Index(fields=["created_date"], name="tombstone_created"),
+        ]
+
+
+def schedule_rebalance(user_id):
+    from tasks.tasks import rebalance_task_ranks
+
+    transaction.on_commit(lambda: rebalance_task_ranks.delay(user_id))
+
 
 class EmailSettings(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     email_time = models.TimeField(editable=True, default=timezone.now)
     email_date = models.DateField(default=timezone.now)
     email_enable = models.BooleanField(default=True)
+    # email_date at email_time (UTC), or None while reports are off. Kept in
+    # step by save() and by the report run, which moves both on by a day
+    next_send_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=["next_send_at"], name="email_next_send")]
+
+    def get_next_send_at(self):
+        if not self.email_enable:
+            return None
+        email_date, email_time = self.email_date, self.email_time
+        # The defaults are datetimes until the row is read back
+        if isinstance(email_date, datetime):
+            email_date = email_date.date()
+        if isinstance(email_time, datetime):
+            email_time = email_time.time()
+        return datetime.combine(email_date, email_time, tzinfo=timezone.utc)
+
+    def save(self, *args, **kwargs):
+        self.next_send_at = self.get_next_send_at()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "next_send_at"}
+        super().save(*args, **kwargs)
+
+
+class ReminderClaim(models.Model):
+    """
+    The daily report of one user for one day, claimed by the run that sends
+    it. The unique constraint makes claiming atomic, so overlapping or
+    retried runs send each report at most once
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    report_date = models.DateField()
+    claim = models.CharField(max_length=32)
+    claimed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "report_date"], name="reminder_claim_user_day"
+            ),
+        ]
+
+
+class EmailOutbox(models.Model):
+    """
+    An email waiting to be sent by tasks.outbox. Rows are written in the same
+    transaction as the change that decided to send them, and stay PENDING
+    until delivered or, after too many failed attempts, DEAD
+    """
+
+    to = models.EmailField()
+    from_email = models.CharField(max_length=254)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(
+        max_length=10, choices=OUTBOX_STATUS_CHOICES, default=OUTBOX_STATUS_CHOICES[0][0]
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    sent_date = models.DateTimeField(null=True, blank=True)
+    # When the message was due to go out, for those sent at a set time like
+    # the reports, so their lag can be measured once they are
+    due_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                name="outbox_pending_due",
+                condition=Q(status="PENDING"),
+            ),
+            models.Index(
+                fields=["sent_date"], name="outbox_sent", condition=Q(status="SENT")
+            ),
+        ]
+
+
+class HistoryQuerySet(models.QuerySet):
+    def list_values(self):
+        """
+        values() rows with the changed task and its user joined in, for
+        HistoryReadSerializer. Task priorities come from task_priorities()
+        over the rows' task_changed* columns
+        """
+        return self.values(
+            "id",
+            "prev_status",
+            "updated_status",
+            "changed_date",
+            "transitions",
+            "task_changed",
+            "task_changed__title",
+            "task_changed__description",
+            "task_changed__completed",
+            "task_changed__deleted",
+            "task_changed__rank",
+            "task_changed__status",
+            "task_changed__user",
+            "task_changed__user__first_name",
+            "task_changed__user__last_name",
+            "task_changed__user__username",
+        )
 
 
 class History(models.Model):
@@ -53,16 +754,166 @@ class History(models.Model):
     task_changed = models.ForeignKey(
         Task, on_delete=models.CASCADE, null=True, blank=True
     )
+    # More than one when older transitions were compacted into this row
+    transitions = models.PositiveIntegerField(default=1)
+
+    objects = HistoryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["task_changed", "changed_date"], name="history_task_date"
+            ),
+            # A day's rows, for the daily rollups (see tasks.analytics)
+            models.Index(fields=["changed_date"], name="history_date"),
+        ]
+
+
+class HistoryArchive(models.Model):
+    """History rows moved out of the History table by tasks.retention"""
+
+    prev_status = models.CharField(max_length=50, choices=STATUS_CHOICES)
+    updated_status = models.CharField(max_length=50, choices=STATUS_CHOICES)
+    changed_date = models.DateField()
+    transitions = models.PositiveIntegerField(default=1)
+    task_id = models.BigIntegerField(db_index=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    archived_date = models.DateField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["changed_date"], name="history_archive_date")]
+
+
+# DailyTaskRollup columns holding, per status, the number of stints in it
+# that ended on the day and the days they lasted
+STATUS_STINT_FIELDS = {status: f"stints_{status.lower()}" for status, _ in STATUS_CHOICES}
+STATUS_DAYS_FIELDS = {status: f"days_{status.lower()}" for status, _ in STATUS_CHOICES}
+
+
+class DailyTaskRollup(models.Model):
+    """
+    What one user's status changes on one day added up to, kept by
+    tasks.analytics so stats over a date range read a row per day instead
+    of the History rows
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    # Moved to COMPLETED
+    completed = models.IntegerField(default=0)
+    # Moved from PENDING or IN_PROGRESS to COMPLETED or CANCELLED
+    closed = models.IntegerField(default=0)
+    # Moved back from COMPLETED or CANCELLED to PENDING or IN_PROGRESS
+    reopened = models.IntegerField(default=0)
+    stints_pending = models.IntegerField(default=0)
+    stints_in_progress = models.IntegerField(default=0)
+    stints_completed = models.IntegerField(default=0)
+    stints_cancelled = models.IntegerField(default=0)
+    days_pending = models.IntegerField(default=0)
+    days_in_progress = models.IntegerField(default=0)
+    days_completed = models.IntegerField(default=0)
+    days_cancelled = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "date"], name="rollup_user_date"),
+        ]
+        indexes = [models.Index(fields=["date"], name="rollup_date")]
+
+
+class RollupProgress(models.Model):
+    """
+    How far tasks.analytics has rolled History up, in a single row: every day
+    before rolled_up_until has its DailyTaskRollup rows, days without any
+    status changes included. Only rollups adjoining it move it on, and
+    writing History for days before it moves it back
+    """
+
+    rolled_up_until = models.DateField(null=True)
+
+
+ROLLUP_FIELDS = [
+    "completed",
+    "closed",
+    "reopened",
+    *STATUS_STINT_FIELDS.values(),
+    *STATUS_DAYS_FIELDS.values(),
+]
 
 
 @receiver(pre_save, sender=Task)
 def generate_history(sender, instance, **kwargs):
-    if Task.objects.filter(pk=instance.id).exists():
-        prev_task = Task.objects.get(pk=instance.id)
-        if instance.status == prev_task.status:
-            return
-        History(
-            prev_status=prev_task.status,
-            updated_status=instance.status,
-            task_changed=instance,
-        ).save()
+    if instance.pk is None:
+        return
+    if "status" in instance._loaded_values:
+        prev_status = instance._loaded_values["status"]
+    else:
+        # Not loaded through the ORM (or status was deferred), ask the database
+        prev_status = (
+            Task.objects.filter(pk=instance.pk).values_list("status", flat=True).first()
+        )
+    if prev_status is None or instance.status == prev_status:
+        return
+    History(
+        prev_status=prev_status,
+        updated_status=instance.status,
+        task_changed=instance,
+    ).save()
+
+
+@receiver(post_delete, sender=Task)
+def remove_from_stats(sender, instance, **kwargs):
+    state = instance._field_values()
+    if {"deleted", "completed", "status"} <= state.keys():
+        apply_stats_delta(instance.user_id, stats_delta(state, None))
+
+
+@receiver(post_save, sender=Task)
+def publish_task_event(sender, instance, created, **kwargs):
+    after = instance._field_values()
+    if created:
+        changes = [(instance.user_id, instance.id, None, after)]
+    else:
+        before = {**after, **instance._loaded_values}
+        if before["user_id"] == after["user_id"]:
+            changes = [(instance.user_id, instance.id, before, after)]
+        else:
+            changes = [
+                (before["user_id"], instance.id, before, None),
+                (after["user_id"], instance.id, None, after),
+            ]
+    events.publish_changes(changes)
+
+
+@receiver(post_delete, sender=Task)
+def record_task_deleted(sender, instance, **kwargs):
+    if instance.__dict__.get("deleted", False) and "change_seq" in instance.__dict__:
+        # A purged soft deleted task, synced clients past its soft delete
+        # have dropped it already and the others have to start over
+        expire_changes(instance.user_id, instance.change_seq)
+    else:
+        bury_tasks(instance.user_id, [instance.pk])
+
+
+@receiver(post_delete, sender=Task)
+def publish_task_deleted(sender, instance, **kwargs):
+    # Soft deleted tasks were announced when they were deleted
+    if not instance.__dict__.get("deleted", False):
+        events.publish([(instance.user_id, "deleted", {"id": instance.id})])
+
+
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+def bump_task_cache(sender, instance, **kwargs):
+    bump_versions([instance.user_id, instance._loaded_values.get("user_id")])
+
+
+@receiver(post_save, sender=History)
+@receiver(post_delete, sender=History)
+def bump_history_cache(sender, instance, **kwargs):
+    if instance.task_changed_id is not None:
+        task = History.task_changed.field.get_cached_value(instance, None)
+        if task is None:
+            task = Task.objects.filter(pk=instance.task_changed_id).only("user").first()
+        if task is not None:
+            bump_versions([task.user_id])
@@ -0,0 +1,142 @@
+"""
+Email delivery through the EmailOutbox table. Senders enqueue() messages
+inside their own transaction, deliver() drains the table in batches over one
+connection per batch.
+
+A batch is leased by pushing its next_attempt_at past the lease, so
+concurrent workers take different batches and a batch abandoned by a worker
+that died is picked up again once the lease runs out. Messages are therefore
+delivered at least once.
+
+Messages enqueued with the time they were due are observed in the
+schedule_lag histogram of tasks.celerymetrics as they are sent, so it shows
+how late they reached the mail server rather than the outbox.
+"""
+import itertools
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from tasks import celerymetrics
+from tasks.models import EmailOutbox
+
+
+def enqueue(messages, due_at=None):
+    """
+    Add EmailMessages to the outbox, one row per recipient. due_at has when
+    each message was due to be sent, in the order of messages
+    """
+    due_at = due_at if due_at is not None else itertools.repeat(None)
+    return EmailOutbox.objects.bulk_create(
+        EmailOutbox(
+            to=to,
+            from_email=message.from_email,
+            subject=message.subject,
+            body=message.body,
+            due_at=due,
+        )
+        for message, due in zip(messages, due_at)
+        for to in message.to
+    )
+
+
+def lease_batch(batch_size):
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status="PENDING", next_attempt_at__lte=now)
+            .order_by("next_attempt_at", "id")[:batch_size]
+        )
+        EmailOutbox.objects.filter(id__in=[row.id for row in rows]).update(
+            next_attempt_at=now + timedelta(seconds=settings.EMAIL_OUTBOX_LEASE_SECONDS)
+        )
+    return rows
+
+
+def record_failure(row, error, now):
+    row.attempts += 1
+    row.last_error = f"{type(error).__name__}: {error}"[:1000]
+    if row.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        row.status = "DEAD"
+    else:
+        backoff = settings.EMAIL_OUTBOX_BACKOFF_SECONDS * 2 ** (row.attempts - 1)
+        row.next_attempt_at = now + timedelta(seconds=backoff)
+
+
+def save_results(sent, failed):
+    now = timezone.now()
+    EmailOutbox.objects.filter(id__in=[row.id for row in sent]).update(
+        status="SENT", sent_date=now, attempts=F("attempts") + 1, last_error=""
+    )
+    celerymetrics.observe(
+        "schedule_lag",
+        (),
+        (max((now - row.due_at).total_seconds(), 0) for row in sent if row.due_at),
+    )
+    EmailOutbox.objects.bulk_update(
+        failed, ["status", "attempts", "next_attempt_at", "last_error"]
+    )
+
+
+def deliver_batch(rows):
+    """
+    Send rows over one connection. Returns the number sent and failed. A
+    message failing for any reason counts as an attempt of its own, and
+    what was sent is saved even if the batch is cut short, so it isn't sent
+    again once the lease runs out
+    """
+    sent, failed = [], []
+    connection = get_connection()
+    try:
+        try:
+            connection.open()
+        except Exception as error:
+            failed = rows
+            for row in rows:
+                record_failure(row, error, timezone.now())
+        else:
+            with connection:
+                for row in rows:
+                    message = EmailMessage(
+                        row.subject, row.body, row.from_email, [row.to], connection=connection
+                    )
+                    try:
+                        message.send()
+                    except Exception as error:
+                        record_failure(row, error, timezone.now())
+                        failed.append(row)
+                    else:
+                        sent.append(row)
+    finally:
+        save_results(sent, failed)
+    return len(sent), len(failed)
+
+
+def deliver(batch_size=None, max_batches=None):
+    """Deliver due messages until none are left, and report what was done"""
+    batch_size = batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE
+    report = {"batches": 0, "sent": 0, "failed": 0}
+    start = time.perf_counter()
+    while max_batches is None or report["batches"] < max_batches:
+        rows = lease_batch(batch_size)
+        if not rows:
+            break
+        sent, failed = deliver_batch(rows)
+        report["batches"] += 1
+        report["sent"] += sent
+        report["failed"] += failed
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def requeue_dead():
+    """Give dead messages another round of attempts. Returns how many"""
+    return EmailOutbox.objects.filter(status="DEAD").update(
+        status="PENDING", attempts=0, next_attempt_at=timezone.now()
+    )
@@ -0,0 +1,228 @@
+"""
+Keyset pagination over task lists ordered by (rank, id).
+
+A page is fetched by seeking past the (rank, id) of the previous page's last
+task, so every page costs the same as the first. Cursors are opaque to
+clients; besides the seek position they carry the page number and how many
+pending/completed tasks come before the page, which is enough to number
+priorities without counting rows. They are signed, so those counts are the
+server's own rather than whatever a client puts in.
+"""
+import math
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from django.http import Http404
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from tasks.models import number_priorities
+
+
+CURSOR_SALT = "tasks.pagination"
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(position):
+    return signing.dumps(position, salt=CURSOR_SALT)
+
+
+def decode_cursor(cursor):
+    try:
+        position = signing.loads(cursor, salt=CURSOR_SALT)
+        rank, task_id, previous, number, before = (
+            position["r"],
+            position["i"],
+            position["d"],
+            position["p"],
+            position["o"],
+        )
+        values = (rank, task_id, number, *before)
+        if len(before) != 2 or not all(isinstance(value, int) for value in values):
+            raise InvalidCursor
+    except (signing.BadSignature, ValueError, KeyError, TypeError):
+        raise InvalidCursor
+    return rank, task_id, bool(previous), max(number, 1), before
+
+
+class KeysetPage:
+    def __init__(self, object_list, number, next_cursor, previous_cursor, paginator):
+        self.object_list = object_list
+        self.number = number
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.paginator = paginator
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset ordered by ("rank", "id"). With number_priorities the
+    queryset must be a whole task list of one user (no other filters), and each
+    task gets its priority from the cursor instead of from the database.
+    count is optional and only used for num_pages
+    """
+
+    def __init__(self, per_page, count=None, number_priorities=True):
+        self.per_page = per_page
+        self.count = count
+        self.number_priorities = number_priorities
+
+    @staticmethod
+    def seek(queryset, rank, task_id):
+        """The tasks of queryset after the one at (rank, task_id)"""
+        return queryset.filter(rank__gte=rank).filter(Q(rank__gt=rank) | Q(id__gt=task_id))
+
+    @property
+    def num_pages(self):
+        if self.count is None:
+            return None
+        return max(math.ceil(self.count / self.per_page), 1)
+
+    def page(self, queryset, cursor=None):
+        if cursor:
+            rank, task_id, previous, number, before = decode_cursor(cursor)
+        else:
+            rank = task_id = None
+            previous, number, before = False, 1, [0, 0]
+
+        if previous:
+            tasks = list(
+                queryset.filter(rank__lte=rank)
+                .filter(Q(rank__lt=rank) | Q(id__lt=task_id))
+                .order_by("-rank", "-id")[: self.per_page + 1]
+            )
+            has_previous = len(tasks) > self.per_page
+            tasks = tasks[: self.per_page][::-1]
+            # The task the cursor was taken at may be gone since
+            has_next = bool(tasks) and self.seek(queryset, tasks[-1].rank, tasks[-1].id).exists()
+            before = [
+                before[completed] - sum(task.completed == completed for task in tasks)
+                for completed in (False, True)
+            ]
+        else:
+            if rank is not None:
+                queryset = self.seek(queryset, rank, task_id)
+            tasks = list(queryset[: self.per_page + 1])
+            has_next = len(tasks) > self.per_page
+            tasks = tasks[: self.per_page]
+            has_previous = rank is not None
+
+        after = list(before)
+        for task in tasks:
+            after[task.completed] += 1
+            if self.number_priorities:
+                task.priority_ordinal = after[task.completed]
+
+        next_cursor = previous_cursor = None
+        if has_next and tasks:
+            last = tasks[-1]
+            next_cursor = encode_cursor(
+                {"r": last.rank, "i": last.id, "d": 0, "p": number + 1, "o": after}
+            )
+        if has_previous and tasks:
+            first = tasks[0]
+            previous_cursor = encode_cursor(
+                {
+                    "r": first.rank,
+                    "i": first.id,
+                    "d": 1,
+                    "p": max(number - 1, 1),
+                    "o": before,
+                }
+            )
+        return KeysetPage(tasks, number, next_cursor, previous_cursor, self)
+
+
+class KeysetPaginationMixin:
+    """
+    ListView pagination through ?cursor=. Views provide get_total_count(),
+    ideally from TaskStats rather than a COUNT
+    """
+
+    paginate_by = settings.TASKS_PAGE_SIZE
+
+    def get_total_count(self):
+        return None
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(page_size, count=self.get_total_count())
+        try:
+            page = paginator.page(queryset, self.request.GET.get("cursor"))
+        except InvalidCursor:
+            raise Http404("Invalid cursor")
+        return paginator, page, page.object_list, page.has_other_pages()
+
+
+class TaskCursorPagination(BasePagination):
+    """
+    Keyset pagination for the REST API, with ?cursor= and ?page_size=. Lists
+    narrowed down by filters can't have their priorities numbered from the
+    cursor, their pages are numbered with number_priorities()
+    """
+
+    page_size = settings.TASKS_API_PAGE_SIZE
+    max_page_size = settings.TASKS_API_MAX_PAGE_SIZE
+    page_size_query_param = "page_size"
+    cursor_query_param = "cursor"
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        filterset_class = getattr(view, "filterset_class", None)
+        filtered = filterset_class is not None and any(
+            name in request.query_params for name in filterset_class.base_filters
+        )
+        paginator = KeysetPaginator(
+            self.get_page_size(request), number_priorities=not filtered
+        )
+        try:
+            self.page = paginator.page(
+                queryset, request.query_params.get(self.cursor_query_param)
+            )
+        except InvalidCursor:
+            raise NotFound("Invalid cursor")
+        if filtered:
+            number_priorities(self.page.object_list)
+        self.request = request
+        return list(self.page)
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "next": self.get_link(self.page.next_cursor),
+                "previous": self.get_link(self.page.previous_cursor),
+                "results": data,
+            }
+        )
@@ -0,0 +1,274 @@
+"""
+Keeps the History table small, along with the ReminderClaim and EmailOutbox
+tables that grow by the day, and removes soft deleted tasks for good. Every
+step works through the table in batches of batch_size rows, each in its own
+short transaction, so no lock is held for longer than one batch takes.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from tasks.models import (
+    EmailOutbox,
+    History,
+    HistoryArchive,
+    ReminderClaim,
+    Task,
+    TaskTombstone,
+    expire_changes,
+)
+
+
+def compact_history(before, batch_size):
+    """
+    Collapse each task's transitions of one day, older than `before`, into
+    one summary row going from the day's first prev_status to its last
+    updated_status, so every day a task changed on keeps its row and date.
+    A day that ends where it started leaves no row at all.
+    Works through the tasks in id order, batch_size of them at a time.
+    Returns the number of rows removed
+    """
+    removed = 0
+    last_id = 0
+    old = History.objects.filter(changed_date__lt=before)
+    while True:
+        task_ids = list(
+            old.filter(task_changed__gt=last_id)
+            .order_by("task_changed")
+            .values_list("task_changed", flat=True)
+            .distinct()[:batch_size]
+        )
+        if not task_ids:
+            return removed
+        last_id = task_ids[-1]
+
+        with transaction.atomic():
+            rows = (
+                old.select_for_update()
+                .filter(task_changed__in=task_ids)
+                .order_by("task_changed", "id")
+                .only(
+                    "id", "task_changed", "prev_status", "updated_status", "changed_date", "transitions"
+                )
+            )
+            # Rows in id order, so a task's rows of one day are next to each other
+            runs = {}
+            for row in rows:
+                runs.setdefault((row.task_changed_id, row.changed_date), []).append(row)
+
+            summaries, delete_lst = [], []
+            for run in runs.values():
+                if len(run) == 1:
+                    continue
+                # The last row keeps its updated_status and changed_date
+                summary = run[-1]
+                summary.prev_status = run[0].prev_status
+                summary.transitions = sum(row.transitions for row in run)
+                if summary.prev_status == summary.updated_status:
+                    delete_lst.extend(row.id for row in run)
+                else:
+                    summaries.append(summary)
+                    delete_lst.extend(row.id for row in run[:-1])
+            History.objects.bulk_update(summaries, ["prev_status", "transitions"])
+            History.objects.filter(id__in=delete_lst).delete()
+        removed += len(delete_lst)
+
+
+def archive_history(before, batch_size):
+    """
+    Move History rows older than `before` to HistoryArchive.
+    Returns the number of rows moved
+    """
+    moved = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                History.objects.select_for_update()
+                .filter(changed_date__lt=before, task_changed__isnull=False)
+                .order_by("id")
+                .values(
+                    "id",
+                    "prev_status",
+                    "updated_status",
+                    "changed_date",
+                    "transitions",
+                    "task_changed",
+                    "task_changed__user",
+                )[:batch_size]
+            )
+            if not rows:
+                return moved
+            HistoryArchive.objects.bulk_create(
+                HistoryArchive(
+                    prev_status=row["prev_status"],
+                    updated_status=row["updated_status"],
+                    changed_date=row["changed_date"],
+                    transitions=row["transitions"],
+                    task_id=row["task_changed"],
+                    user_id=row["task_changed__user"],
+                )
+                for row in rows
+            )
+            History.objects.filter(id__in=[row["id"] for row in rows]).delete()
+        moved += len(rows)
+
+
+def purge_history(batch_size):
+    """
+    Delete history, live and archived, left behind by tasks that no longer exist.
+    Returns the number of rows deleted
+    """
+    purged = 0
+    orphans = (
+        (History, History.objects.filter(task_changed__isnull=True)),
+        (
+            HistoryArchive,
+            HistoryArchive.objects.filter(
+                ~Exists(Task.objects.filter(id=OuterRef("task_id")))
+            ),
+        ),
+    )
+    for model, queryset in orphans:
+        while True:
+            ids = list(queryset.order_by("id").values_list("id", flat=True)[:batch_size])
+            if not ids:
+                break
+            purged += model.objects.filter(id__in=ids).delete()[0]
+    return purged
+
+
+def purge_reminder_claims(before, batch_size):
+    """
+    Delete claims on reports due before `before`, those days have long
+    been moved past. Returns the number of rows deleted
+    """
+    purged = 0
+    claims = ReminderClaim.objects.filter(report_date__lt=before).order_by("id")
+    while True:
+        ids = list(claims.values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return purged
+        purged += ReminderClaim.objects.filter(id__in=ids).delete()[0]
+
+
+def purge_sent_emails(before, batch_size):
+    """Delete outbox rows delivered before `before`. Returns the number deleted"""
+    purged = 0
+    emails = EmailOutbox.objects.filter(status="SENT", sent_date__lt=before).order_by("id")
+    while True:
+        ids = list(emails.values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return purged
+        purged += EmailOutbox.objects.filter(id__in=ids).delete()[0]
+
+
+def purge_deleted_tasks(before, batch_size, pause=0, max_seconds=None):
+    """
+    Delete tasks soft deleted before `before` for good, with their history,
+    in id order. Sleeps `pause` seconds between batches and stops starting
+    new ones after max_seconds; a later run carries on where this one
+    stopped, since every batch is committed on its own.
+    Returns the numbers of tasks and history rows deleted
+    """
+    report = {"tasks": 0, "history": 0, "batches": 0}
+    start = time.perf_counter()
+    last_id = 0
+    while max_seconds is None or time.perf_counter() - start < max_seconds:
+        listed = list(
+            Task.objects.filter(deleted=True, deleted_at__lt=before, id__gt=last_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not listed:
+            break
+        with transaction.atomic():
+            # A task restored since it was listed is left alone
+            ids = list(
+                Task.objects.select_for_update()
+                .filter(id__in=listed, deleted=True)
+                .values_list("id", flat=True)
+            )
+            history = History.objects.filter(task_changed__in=ids)
+            history_ids = list(history.values_list("id", flat=True))
+            # Detached first, so deleting them doesn't look their task up
+            # row by row to bump its owner's cache version
+            history.update(task_changed=None)
+            report["history"] += History.objects.filter(id__in=history_ids).delete()[0]
+            report["history"] += HistoryArchive.objects.filter(task_id__in=ids).delete()[0]
+            report["tasks"] += Task.objects.filter(id__in=ids).delete()[1].get("tasks.Task", 0)
+        report["batches"] += 1
+        last_id = listed[-1]
+        if pause:
+            time.sleep(pause)
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def purge_tombstones(before, batch_size):
+    """
+    Delete the tombstones (see tasks.sync) of tasks gone before `before`.
+    Clients that haven't synced them yet start over on their next sync.
+    Returns the number deleted
+    """
+    purged = 0
+    tombstones = TaskTombstone.objects.filter(created_date__lt=before).order_by("id")
+    while True:
+        with transaction.atomic():
+            rows = list(tombstones.values_list("id", "user_id", "change_seq")[:batch_size])
+            if not rows:
+                return purged
+            latest = {}
+            for _, user_id, change_seq in rows:
+                latest[user_id] = max(latest.get(user_id, 0), change_seq)
+            for user_id, change_seq in latest.items():
+                expire_changes(user_id, change_seq)
+            purged += TaskTombstone.objects.filter(id__in=[row[0] for row in rows]).delete()[0]
+
+
+def purge_tasks(after_days=None, batch_size=None, pause=None, max_seconds=None):
+    """
+    purge_deleted_tasks() with the defaults from settings, followed by
+    purge_tombstones() over the same days
+    """
+    if after_days is None:
+        after_days = settings.TASK_PURGE_AFTER_DAYS
+    if pause is None:
+        pause = settings.TASK_PURGE_PAUSE_SECONDS
+    if max_seconds is None:
+        max_seconds = settings.TASK_PURGE_MAX_SECONDS
+    before = timezone.now() - timedelta(days=after_days)
+    batch_size = batch_size or settings.TASK_PURGE_BATCH_SIZE
+    report = purge_deleted_tasks(before, batch_size, pause=pause, max_seconds=max_seconds)
+    report["tombstones"] = purge_tombstones(before, batch_size)
+    return report
+
+
+def apply_retention(
+    compact_after_days=None, archive_after_days=None, batch_size=None
+):
+    """Run every retention step and report how much work each did"""
+    if compact_after_days is None:
+        compact_after_days = settings.HISTORY_COMPACT_AFTER_DAYS
+    if archive_after_days is None:
+        archive_after_days = settings.HISTORY_ARCHIVE_AFTER_DAYS
+    batch_size = batch_size or settings.HISTORY_RETENTION_BATCH_SIZE
+    today = timezone.now().date()
+
+    start = time.perf_counter()
+    report = {
+        "compacted": compact_history(today - timedelta(days=compact_after_days), batch_size),
+        "archived": archive_history(today - timedelta(days=archive_after_days), batch_size),
+        "purged": purge_history(batch_size),
+        "claims_purged": purge_reminder_claims(
+            today - timedelta(days=settings.REMINDER_CLAIM_RETENTION_DAYS), batch_size
+        ),
+        "emails_purged": purge_sent_emails(
+            timezone.now() - timedelta(days=settings.EMAIL_OUTBOX_RETENTION_DAYS), batch_size
+        ),
+    }
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
@@ -0,0 +1,142 @@
+"""
+Full-text search over task titles and descriptions.
+
+On SQLite the index is the contentless FTS5 table tasks_task_fts, kept in
+step with tasks_task by triggers. Its owner column holds a "u<user id>" token
+for tasks that are not deleted, so one MATCH finds a user's live tasks. Django
+rebuilds tables on SQLite when a migration alters them, which drops the
+triggers, so they are (re)installed after every migrate as well.
+
+On PostgreSQL tasks_task has a generated search_vector column with a GIN
+index. Other databases fall back to icontains.
+
+Both indexes are created by migration 0014, which keeps its own copy of the
+SQL here as it was then. Queries are built from the words in the user's
+input only, each matched as a prefix.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = "tasks_task_fts"
+MAX_TERMS = 16
+
+SQLITE_OWNER = "CASE WHEN {row}.deleted THEN NULL ELSE 'u' || {row}.user_id END"
+SQLITE_ROW = "{row}.id, {row}.title, {row}.description, " + SQLITE_OWNER
+SQLITE_INSERT = (
+    f"INSERT INTO {FTS_TABLE}(rowid, title, description, owner) "
+    f"VALUES ({SQLITE_ROW.format(row='new')});"
+)
+SQLITE_DELETE = (
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description, owner) "
+    f"VALUES ('delete', {SQLITE_ROW.format(row='old')});"
+)
+SQLITE_TRIGGERS = (
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON tasks_task "
+    f"BEGIN {SQLITE_INSERT} END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON tasks_task "
+    f"BEGIN {SQLITE_DELETE} END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update "
+    f"AFTER UPDATE OF title, description, user_id, deleted ON tasks_task "
+    f"BEGIN {SQLITE_DELETE} {SQLITE_INSERT} END",
+)
+
+SQLITE_RANK = "bm25(10.0, 1.0, 0.0)"
+
+POSTGRES_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+
+def terms(q):
+    return re.findall(r"\w+", q.lower())[:MAX_TERMS]
+
+
+def sqlite_match(user_id, words):
+    text = " ".join(f'"{word}"*' for word in words)
+    return f'owner:"u{user_id}" AND {{title description}}:({text})'
+
+
+def postgres_query(words):
+    return " & ".join(f"{word}:*" for word in words)
+
+
+def install_triggers(db=connection):
+    """Create the SQLite triggers if they are missing"""
+    if db.vendor != "sqlite":
+        return
+    with db.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE]
+        )
+        if cursor.fetchone() is None:
+            return
+        for sql in SQLITE_TRIGGERS:
+            cursor.execute(sql)
+
+
+def rebuild_index():
+    """Index every task afresh, for SQLite. PostgreSQL's column is generated"""
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')")
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE}(rowid, title, description, owner) "
+            f"SELECT {SQLITE_ROW.format(row='tasks_task')} FROM tasks_task"
+        )
+
+
+def filter_tasks(queryset, user_id, q):
+    """Narrow queryset down to the user's tasks matching q, keeping its order"""
+    words = terms(q)
+    if not words:
+        return queryset.none()
+    if connection.vendor == "sqlite":
+        matches = RawSQL(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+            [sqlite_match(user_id, words)],
+        )
+        return queryset.filter(id__in=matches)
+    if connection.vendor == "postgresql":
+        return queryset.extra(
+            where=["search_vector @@ to_tsquery('english', %s)"],
+            params=[postgres_query(words)],
+        )
+    for word in words:
+        queryset = queryset.filter(Q(title__icontains=word) | Q(description__icontains=word))
+    return queryset
+
+
+def search(user_id, q, limit):
+    """
+    The ids of the user's live tasks matching q, best match first, at most
+    limit of them. Title matches weigh more than description matches
+    """
+    from tasks.models import Task
+
+    words = terms(q)
+    if not words:
+        return []
+    if connection.vendor == "sqlite":
+        sql = (
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+            f"ORDER BY rank LIMIT %s"
+        )
+        params = [sqlite_match(user_id, words), limit]
+    elif connection.vendor == "postgresql":
+        sql = (
+            "SELECT id FROM tasks_task, to_tsquery('english', %s) query "
+            "WHERE user_id = %s AND NOT deleted AND search_vector @@ query "
+            "ORDER BY ts_rank(search_vector, query) DESC, id LIMIT %s"
+        )
+        params = [postgres_query(words), user_id, limit]
+    else:
+        tasks = filter_tasks(Task.objects.filter(user=user_id, deleted=False), user_id, q)
+        return list(tasks.order_by("id").values_list("id", flat=True)[:limit])
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,110 @@
+"""
+The server-sent events stream of a user's task changes, at EVENTS_PATH.
+
+It is a plain ASGI application that task_manager.asgi routes EVENTS_PATH
+to, since Django 4.0 can only stream responses from sync iterators, which
+would tie up the event loop for as long as a client stays connected. Clients
+log in as for the rest of the API (the session cookie) and resume with the
+standard Last-Event-ID header, or ?last_event_id= where they can't set it.
+"""
+import asyncio
+import json
+from importlib import import_module
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+
+from tasks.events import get_broker
+
+EVENTS_PATH = "/api/v1/task/events/"
+
+
+def authenticate(scope):
+    """The id of the user logged in with the request's session, or None"""
+    request = ASGIRequest(scope, BytesIO())
+    engine = import_module(settings.SESSION_ENGINE)
+    request.session = engine.SessionStore(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+    try:
+        user = get_user(request)
+        return user.id if user.is_authenticated else None
+    finally:
+        close_old_connections()
+
+
+def last_event_id(scope):
+    for name, value in scope["headers"]:
+        if name == b"last-event-id":
+            return value.decode("latin1")
+    query = parse_qs(scope.get("query_string", b"").decode("latin1"))
+    return query.get("last_event_id", [None])[0]
+
+
+def format_event(event_id, event, data):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+async def stream_events(user_id, after, send):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                # Keep proxies from buffering the stream
+                (b"x-accel-buffering", b"no"),
+            ],
+        }
+    )
+    # Have clients wait a little before reconnecting after a disconnect
+    await send({"type": "http.response.body", "body": b"retry: 2000\n\n", "more_body": True})
+    messages = get_broker().subscribe(
+        user_id, after, timeout=settings.TASK_EVENTS_HEARTBEAT_SECONDS
+    )
+    try:
+        async for message in messages:
+            # A comment line, to keep the connection open through proxies
+            body = b": keepalive\n\n" if message is None else format_event(*message)
+            # Waits while the client is slow to read, which in turn fills
+            # its queue and ends the stream
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+    finally:
+        await messages.aclose()
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def application(scope, receive, send):
+    if scope["method"] != "GET":
+        await send_json(send, 405, {"detail": f'Method "{scope["method"]}" not allowed.'})
+        return
+    user_id = await sync_to_async(authenticate, thread_sensitive=False)(scope)
+    if user_id is None:
+        await send_json(send, 403, {"detail": "Authentication credentials were not provided."})
+        return
+    stream = asyncio.ensure_future(stream_events(user_id, last_event_id(scope), send))
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    await asyncio.wait((stream, disconnect), return_when=asyncio.FIRST_COMPLETED)
+    for future in (stream, disconnect):
+        future.cancel()
+    await asyncio.gather(stream, disconnect, return_exceptions=True)
+
+
+async def send_json(send, status, data):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": json.dumps(data).encode()})
@@ -0,0 +1,78 @@
+"""
+The changes to a user's tasks since a cursor, for clients that keep their
+own copy of the task list (offline ones, say) and only want what changed.
+
+Every write gives the tasks it touches the next numbers of their owner's
+ChangeSequence, so the tasks changed since a sync are those with a higher
+change_seq, read off the task_change_seq index at a cost that grows with
+the number of changes rather than of tasks. Soft deleted tasks come back
+as they are, tasks deleted outright or given to another user as the
+TaskTombstone rows left in their place. Once a soft deleted task or a
+tombstone is purged, the clients that synced before it have to start over
+with an empty copy ("reset").
+
+A cursor is the number of the last change the client's copy is complete
+up to, "0" for an empty copy. While a sync is paged through, it also
+carries how far the client has got: "<position>:<complete up to>".
+"""
+from tasks.models import ChangeSequence, Task, TaskTombstone
+
+FULL_SYNC = "0"
+
+
+def parse_cursor(cursor):
+    """(position, complete up to) from a cursor, raising ValueError if malformed"""
+    position, _, complete = cursor.partition(":")
+    position = int(position)
+    complete = int(complete) if complete else position
+    if position < 0 or complete < 0:
+        raise ValueError(cursor)
+    return position, complete
+
+
+def format_cursor(position, complete):
+    return str(position) if position == complete else f"{position}:{complete}"
+
+
+def changes_since(user_id, cursor=FULL_SYNC, limit=500):
+    """
+    The user's tasks changed after cursor and the ids of those gone from
+    them, at most limit in all in the order they changed, with the cursor
+    to sync from next, whether there are more changes to fetch with it
+    straight away and whether the client has to drop its copy first
+    """
+    position, complete = parse_cursor(cursor)
+    latest, reset_below = (
+        ChangeSequence.objects.filter(user=user_id)
+        .values_list("value", "reset_below")
+        .first()
+    ) or (0, 0)
+    reset = position > 0 and (complete < reset_below or position > latest)
+    if reset or position == 0:
+        # Start over, from the changes numbered up to now
+        position, complete = 0, latest
+    # Changes committed since latest was read are left for the next sync
+    tasks = Task.objects.filter(
+        user=user_id, change_seq__gt=position, change_seq__lte=latest
+    ).order_by("change_seq")
+    tombstones = TaskTombstone.objects.filter(
+        user_id=user_id, change_seq__gt=position, change_seq__lte=latest
+    ).order_by("change_seq")
+    changes = sorted(
+        [(task.change_seq, task) for task in tasks[: limit + 1]]
+        + list(tombstones.values_list("change_seq", "task_id")[: limit + 1]),
+        key=lambda change: change[0],
+    )
+    more = len(changes) > limit
+    if more:
+        changes = changes[:limit]
+        cursor = format_cursor(changes[-1][0], complete)
+    else:
+        cursor = format_cursor(latest, latest)
+    return {
+        "tasks": [change for _, change in changes if isinstance(change, Task)],
+        "removed": [change for _, change in changes if not isinstance(change, Task)],
+        "cursor": cursor,
+        "more": more,
+        "reset": reset,
+    }
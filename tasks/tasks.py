@@ -1,38 +1,196 @@
+import uuid
+from collections import defaultdict
 from datetime import timedelta
 
 from celery.decorators import periodic_task
-from django.contrib.auth.models import User
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.db.models import Count, F, Q
 from django.utils import timezone
 from task_manager.celery import app
 from django.conf import settings
 
-from tasks.models import STATUS_CHOICES, EmailSettings, Task
+from tasks.models import (
+    STATUS_COUNT_FIELDS,
+    EmailSettings,
+    ReminderClaim,
+    rebalance_ranks,
+)
+from tasks import celerymetrics, outbox
+from tasks.analytics import rollup_history
+from tasks.retention import apply_retention, purge_tasks
 
 
-@periodic_task(run_every=timedelta(seconds=30))
+def due_email_settings(until=None):
+    """EmailSettings due by `until` (now), found by a range scan of next_send_at"""
+    return EmailSettings.objects.filter(
+        next_send_at__lte=until or timezone.now(),
+        email_enable=True,
+        user__isnull=False,
+    )
+
+
+def due_reports(settings_ids):
+    """
+    The due EmailSettings among settings_ids, with their user's email and
+    pending task counts per status, all from one grouped query
+    """
+    pending = Q(user__task__completed=False, user__task__deleted=False)
+    return (
+        due_email_settings()
+        .filter(id__in=settings_ids)
+        .values("id", "email_date", "next_send_at", "user", "user__email")
+        .annotate(
+            **{
+                field: Count("user__task", filter=pending & Q(user__task__status=status))
+                for status, field in STATUS_COUNT_FIELDS.items()
+            }
+        )
+        .order_by("id")
+    )
+
+
+def claim_reports(reports):
+    """
+    Claim the user-day of each report and move the settings on to the next
+    day. Returns the reports this run won, those already claimed by another
+    run are left to it. Must run in a transaction
+    """
+    claim = uuid.uuid4().hex
+    ReminderClaim.objects.bulk_create(
+        (
+            ReminderClaim(
+                user_id=report["user"], report_date=report["email_date"], claim=claim
+            )
+            for report in reports
+        ),
+        ignore_conflicts=True,
+    )
+    won = set(
+        ReminderClaim.objects.filter(claim=claim).values_list("user", "report_date")
+    )
+    # Only rows still on the claimed day move on, in case a concurrent run
+    # moved them already. Rows that fell behind skip to tomorrow, a report
+    # shows the tasks as they are now so missed days are not caught up
+    today = timezone.now().date()
+    ids_by_date = defaultdict(list)
+    for report in reports:
+        ids_by_date[report["email_date"]].append(report["id"])
+    for report_date, ids in ids_by_date.items():
+        days = timedelta(days=(max(report_date, today) - report_date).days + 1)
+        EmailSettings.objects.filter(id__in=ids, email_date=report_date).update(
+            email_date=report_date + days, next_send_at=F("next_send_at") + days
+        )
+    claimed = {}
+    for report in reports:
+        key = (report["user"], report["email_date"])
+        if key in won:
+            claimed.setdefault(key, report)
+    return list(claimed.values())
+
+
+def report_message(report):
+    email_content = "Task Report\nHere's your report for today:\n"
+    for status, field in STATUS_COUNT_FIELDS.items():
+        email_content += f"{status}: {report[field]}\n"
+    return EmailMessage(
+        "Task Report (Breakdown based on task status)",
+        email_content,
+        settings.EMAIL_HOST_USER,
+        [report["user__email"]],
+    )
+
+
+@periodic_task(run_every=timedelta(seconds=settings.EMAIL_REMINDER_LOOKAHEAD_SECONDS))
 def send_email_reminder():
+    """
+    Hand the reports due before the next run out to send_email_reports, in
+    chunks that are each scheduled for the minute their reports are due
+    """
     print("Starting to process email")
-    email_qs = EmailSettings.objects.filter(
-        email_enable=True,
-        email_time__lte=timezone.now(),
-        email_date__lte=timezone.now(),
+    now = timezone.now()
+    until = now + timedelta(seconds=settings.EMAIL_REMINDER_LOOKAHEAD_SECONDS)
+    due = (
+        due_email_settings(until)
+        .order_by("next_send_at", "id")
+        .values_list("id", "next_send_at")
     )
-    for email in email_qs:
-        email_content = "Task Report\nHere's your report for today:\n"
-        user = User.objects.get(id=email.user.id)
-        pending_qs = Task.objects.filter(user=user, completed=False, deleted=False)
-        for status in STATUS_CHOICES:
-            count = pending_qs.filter(status=status[0]).count()
-            email_content += f"{status[0]}: {count}\n"
-
-        send_mail(
-            "Task Report (Breakdown based on task status)",
-            email_content,
-            settings.EMAIL_HOST_USER,
-            [user.email],
+    chunk_size = settings.EMAIL_REMINDER_CHUNK_SIZE
+    chunk, chunk_minute, dispatched, chunks = [], None, 0, 0
+    for settings_id, next_send_at in due.iterator(chunk_size=chunk_size):
+        # Anything overdue goes out in the current minute
+        minute = max(next_send_at, now).replace(second=0, microsecond=0)
+        if chunk and (len(chunk) >= chunk_size or minute != chunk_minute):
+            dispatch_reports(chunk, eta, now)
+            dispatched += len(chunk)
+            chunks += 1
+            chunk = []
+        chunk.append(settings_id)
+        chunk_minute, eta = minute, next_send_at
+    if chunk:
+        dispatch_reports(chunk, eta, now)
+        dispatched += len(chunk)
+        chunks += 1
+    celerymetrics.count(reports=dispatched, chunks=chunks)
+    print("Dispatched reports for", dispatched, "users")
+
+
+def dispatch_reports(settings_ids, eta, now):
+    """eta is when the last of the reports is due"""
+    send_email_reports.apply_async((settings_ids,), eta=eta if eta > now else None)
+
+
+@app.task(rate_limit=settings.EMAIL_REMINDER_RATE_LIMIT)
+def send_email_reports(settings_ids):
+    """Queue the reports in the outbox, delivery happens in deliver_emails"""
+    with transaction.atomic():
+        reports = claim_reports(list(due_reports(settings_ids)))
+        celerymetrics.count(reports=len(reports), skipped=len(settings_ids) - len(reports))
+        if not reports:
+            return
+        # Due at the time each user chose, for the lag observed on delivery
+        outbox.enqueue(
+            (report_message(report) for report in reports),
+            due_at=[report["next_send_at"] for report in reports],
         )
-        print("Completed Processing for User", user.username, user.id)
+        transaction.on_commit(deliver_emails.delay)
+    print("Completed Processing for", len(reports), "users")
+
+
+@periodic_task(run_every=timedelta(seconds=30))
+def deliver_emails():
+    report = outbox.deliver()
+    celerymetrics.count(**report)
+    if report["batches"]:
+        print("Delivered outbox emails", report)
+
+
+@app.task
+def rebalance_task_ranks(user_id):
+    updated = rebalance_ranks(user_id)
+    celerymetrics.count(tasks=updated)
+    print("Rebalanced task ranks for User", user_id, "-", updated, "tasks moved")
+
+
+@periodic_task(run_every=timedelta(days=1))
+def apply_history_retention():
+    report = apply_retention()
+    celerymetrics.count(**report)
+    print("Applied history retention", report)
+
+
+@periodic_task(run_every=timedelta(days=1))
+def purge_deleted_tasks():
+    report = purge_tasks()
+    celerymetrics.count(**report)
+    print("Purged soft deleted tasks", report)
+
 
-        email.email_date += timedelta(days=1)
-        email.save()
+@periodic_task(run_every=timedelta(hours=1))
+def rollup_task_history():
+    # Hourly, so yesterday is rolled up soon after midnight. Runs with no
+    # new day to roll up cost a few indexed queries
+    report = rollup_history()
+    celerymetrics.count(**report)
+    if report["rows"]:
+        print("Rolled up task history", report)
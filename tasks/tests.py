@@ -1,16 +1,75 @@
 from django.contrib.auth.models import User
-from django.test import RequestFactory, TestCase
-from .models import Task, STATUS_CHOICES, History, EmailSettings
+from django.test import (
+    AsyncClient,
+    AsyncRequestFactory,
+    Client,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from .models import (
+    Task,
+    STATUS_CHOICES,
+    History,
+    HistoryArchive,
+    EmailSettings,
+    TaskStats,
+    TaskTombstone,
+    DailyTaskRollup,
+    ChangeSequence,
+    RANK_GAP,
+    ReminderClaim,
+    EmailOutbox,
+    move_tasks,
+    number_priorities,
+    reconcile_task_stats,
+    reorder_tasks,
+)
+from . import cache as page_cache
+from . import outbox
+from . import analytics, asyncviews, celerymetrics, dataset, events, pagination, search, sse, timing
+from .analytics import rollup_history
+from .metrics import collect
+from .retention import apply_retention, purge_deleted_tasks, purge_tasks
 from .views import (
     GenericAllTasksView,
     GenericCompletedTaskView,
     GenericTaskCreateView,
     GenericTaskView,
 )
+from .apiviews import (
+    HistorySerializer, HistoryViewSet, TaskListAPI, TaskSerializer, TaskViewSet,
+)
 from rest_framework.test import APIClient
-from .tasks import send_email_reminder
+from .forms import EmailSettingsForm
+from .tasks import deliver_emails, due_email_settings, send_email_reminder, send_email_reports
+from task_manager.celery import app
 from django.utils import timezone
-from django.core import mail
+from django.utils.http import http_date
+from django.core import mail, signing
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import NotSupportedError, connection, transaction
+from django.db.models import F, Q
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver
+from datetime import timedelta
+import asyncio
+import json
+import os
+import re
+import tempfile
+from io import StringIO
+from smtplib import SMTPRecipientsRefused
+from unittest import mock
+
+from asgiref.sync import sync_to_async
 
 
 class Tests(TestCase):
@@ -186,11 +245,2086 @@ class CeleryTests(TestCase):
         EmailSettings.objects.create(
             user=self.user, email_time=timezone.now(), email_date=timezone.now()
         )
+        # The celery config is read from settings under the CELERY_ namespace
+        eager = {
+            key: app.conf[key]
+            for key in ("CELERY_TASK_ALWAYS_EAGER", "CELERY_TASK_EAGER_PROPAGATES")
+        }
+        app.conf.update({key: True for key in eager})
+        self.addCleanup(app.conf.update, eager)
 
     def test_mail_remainder(self):
-        send_email_reminder()
+        # Reports are delivered from the outbox once their transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            send_email_reminder()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(
             "Task Report\nHere's your report for today:\nPENDING: 1\nIN_PROGRESS: 0\nCOMPLETED: 0\nCANCELLED: 0\n",
             mail.outbox[0].body,
         )
+
+    def add_due_users(self, count):
+        for i in range(count):
+            user = User.objects.create_user(username=f"user{i}", email=f"user{i}@ghv.org")
+            Task.objects.create(title="Task", status="IN_PROGRESS", user=user)
+            Task.objects.create(title="Done", completed=True, user=user)
+            EmailSettings.objects.create(
+                user=user, email_time=timezone.now(), email_date=timezone.now()
+            )
+
+    @override_settings(EMAIL_REMINDER_CHUNK_SIZE=2)
+    def test_mail_reminder_chunks(self):
+        self.add_due_users(4)
+        with mock.patch.object(
+            send_email_reports, "apply_async", wraps=send_email_reports.apply_async
+        ) as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                send_email_reminder()
+        self.assertEqual(
+            [len(call.args[0][0]) for call in apply_async.call_args_list], [2, 2, 1]
+        )
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(
+            "Task Report\nHere's your report for today:\nPENDING: 0\nIN_PROGRESS: 1\nCOMPLETED: 0\nCANCELLED: 0\n",
+            mail.outbox[-1].body,
+        )
+        self.assertEqual(mail.outbox[-1].to, ["user3@ghv.org"])
+        tomorrow = timezone.now().date() + timedelta(days=1)
+        self.assertFalse(EmailSettings.objects.exclude(email_date=tomorrow).exists())
+        for email in EmailSettings.objects.all():
+            self.assertEqual(email.next_send_at, email.get_next_send_at())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            send_email_reminder()
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_reports_are_scheduled_when_due(self):
+        now = timezone.now()
+        EmailSettings.objects.update(email_enable=False)
+        self.add_due_users(4)
+        times = [now - timedelta(days=3), now + timedelta(minutes=2), now + timedelta(minutes=2), now + timedelta(hours=1)]
+        for email, due in zip(EmailSettings.objects.filter(email_enable=True).order_by("id"), times):
+            email.email_date, email.email_time = due.date(), due.time()
+            email.save()
+        with mock.patch.object(send_email_reports, "apply_async") as apply_async:
+            send_email_reminder()
+        calls = [(len(call.args[0][0]), call.kwargs["eta"]) for call in apply_async.call_args_list]
+        self.assertEqual(calls, [(1, None), (2, times[2])])
+
+        # An overdue report moves on to tomorrow, not to the day after it was due
+        overdue = EmailSettings.objects.get(email_enable=True, next_send_at__lt=now)
+        with self.captureOnCommitCallbacks(execute=True):
+            send_email_reports([overdue.id])
+        overdue.refresh_from_db()
+        self.assertEqual(overdue.email_date, now.date() + timedelta(days=1))
+        self.assertEqual(overdue.next_send_at, overdue.get_next_send_at())
+
+    def test_settings_form_updates_next_send_at(self):
+        email = EmailSettings.objects.get(user=self.user)
+        form = EmailSettingsForm({"email_time": "08:30", "email_enable": True}, instance=email)
+        form.save()
+        email.refresh_from_db()
+        self.assertEqual((email.next_send_at.hour, email.next_send_at.minute), (8, 30))
+        form = EmailSettingsForm({"email_time": "08:30"}, instance=email)
+        form.save()
+        email.refresh_from_db()
+        self.assertIsNone(email.next_send_at)
+
+    def test_reports_are_sent_once_per_day(self):
+        self.add_due_users(2)
+        ids = list(EmailSettings.objects.values_list("id", flat=True))
+        with self.captureOnCommitCallbacks(execute=True):
+            send_email_reports(ids)
+        self.assertEqual(len(mail.outbox), 3)
+
+        # A retried or overlapping run that still sees the old email_date
+        EmailSettings.objects.update(email_date=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            send_email_reports(ids)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(ReminderClaim.objects.count(), 3)
+
+    def test_duplicate_settings_send_one_report(self):
+        EmailSettings.objects.create(
+            user=self.user, email_time=timezone.now(), email_date=timezone.now()
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            send_email_reminder()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(EmailSettings.objects.filter(email_date__lte=timezone.now()).count(), 0)
+
+
+class PriorityTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="gokul", email="gokul@ghv.org", password="abcd@123"
+        )
+        self.tasks = [
+            Task.objects.create(
+                title=f"Task{i}", description="Lorem", priority=i, user=self.user
+            )
+            for i in range(1, 6)
+        ]
+
+    def ordered_titles(self):
+        tasks = Task.objects.filter(user=self.user).order_by("rank", "id")
+        return [(task.title, task.priority) for task in number_priorities(list(tasks))]
+
+    def test_insert_at_top_only_writes_new_task(self):
+        ranks = dict(Task.objects.values_list("id", "rank"))
+        Task.objects.create(
+            title="Urgent", description="Lorem", priority=1, user=self.user
+        )
+        for task_id, rank in ranks.items():
+            self.assertEqual(Task.objects.get(id=task_id).rank, rank)
+        self.assertEqual(
+            self.ordered_titles(),
+            [("Urgent", 1), ("Task1", 2), ("Task2", 3), ("Task3", 4), ("Task4", 5), ("Task5", 6)],
+        )
+
+    def test_move_task(self):
+        task = Task.objects.get(title="Task5")
+        task.priority = 2
+        task.save()
+        self.assertEqual(task.priority, 2)
+        self.assertEqual(
+            [title for title, _ in self.ordered_titles()],
+            ["Task1", "Task5", "Task2", "Task3", "Task4"],
+        )
+        task = Task.objects.get(title="Task3")
+        self.assertIsNone(task.priority)
+        self.assertEqual(number_priorities([task])[0].priority, 4)
+
+    def test_priorities_are_numbered_in_one_query_per_list(self):
+        Task.objects.filter(title="Task2").update(completed=True)
+        tasks = list(Task.objects.filter(user=self.user).order_by("id"))
+        with self.assertNumQueries(2):
+            number_priorities(tasks)
+        self.assertEqual([task.priority for task in tasks], [1, 1, 2, 3, 4])
+
+    def test_api_numbers_the_task_it_returns(self):
+        client = APIClient()
+        client.login(username="gokul", password="abcd@123")
+        task = Task.objects.get(title="Task3")
+        self.assertEqual(client.get(f"/api/v1/task/{task.id}/").json()["priority"], 3)
+        response = client.patch(f"/api/v1/task/{task.id}/", {"completed": True}, format="json")
+        self.assertEqual(response.json()["priority"], 1)
+        # Its rank places a task on the other list, it isn't moved to its end
+        first = Task.objects.get(title="Task1")
+        response = client.patch(f"/api/v1/task/{first.id}/", {"completed": True}, format="json")
+        self.assertEqual(response.json()["priority"], 1)
+        self.assertEqual(client.get(f"/api/v1/task/{task.id}/").json()["priority"], 2)
+
+    def test_priority_past_the_end(self):
+        task = Task.objects.create(
+            title="Later", description="Lorem", priority=50, user=self.user
+        )
+        self.assertEqual(task.priority, 6)
+
+    def test_rebalance_when_out_of_gaps(self):
+        Task.objects.filter(title="Task1").update(rank=10)
+        Task.objects.filter(title="Task2").update(rank=11)
+        Task.objects.create(
+            title="Squeezed", description="Lorem", priority=2, user=self.user
+        )
+        self.assertEqual(
+            [title for title, _ in self.ordered_titles()],
+            ["Task1", "Squeezed", "Task2", "Task3", "Task4", "Task5"],
+        )
+        self.assertEqual(Task.objects.get(title="Task1").rank, RANK_GAP)
+
+    def test_update_form_moves_task(self):
+        self.client.login(username="gokul", password="abcd@123")
+        task = Task.objects.get(title="Task4")
+        response = self.client.post(
+            f"/update-task/{task.pk}/",
+            {
+                "title": "Task4",
+                "description": "Lorem",
+                "priority": 1,
+                "completed": False,
+                "status": STATUS_CHOICES[0][0],
+            },
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.ordered_titles()[0], ("Task4", 1))
+
+
+class ReorderAPITests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="gokul", email="gokul@ghv.org", password="abcd@123"
+        )
+        self.client.login(username="gokul", password="abcd@123")
+        self.tasks = [
+            Task.objects.create(
+                title=f"Task{i}", description="Lorem", priority=i, user=self.user
+            )
+            for i in range(1, 5)
+        ]
+
+    def ordered_ids(self):
+        return list(
+            Task.objects.filter(user=self.user)
+            .order_by("rank", "id")
+            .values_list("id", flat=True)
+        )
+
+    def test_reorder_ids(self):
+        ids = [task.id for task in reversed(self.tasks)]
+        with self.assertNumQueries(8):
+            response = self.client.post("/api/v1/task/reorder/", {"ids": ids}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.ordered_ids(), ids)
+
+    def test_reorder_subset(self):
+        first, second, third, fourth = self.tasks
+        response = self.client.post(
+            "/api/v1/task/reorder/", {"ids": [third.id, first.id]}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.ordered_ids(), [third.id, second.id, first.id, fourth.id])
+
+    def test_reorder_moves(self):
+        first, second, third, fourth = self.tasks
+        response = self.client.post(
+            "/api/v1/task/reorder/",
+            {"moves": [{"id": fourth.id, "priority": 1}, {"id": first.id, "priority": 4}]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        expected = [fourth.id, second.id, third.id, first.id]
+        self.assertEqual(response.json()["ids"], expected)
+        self.assertEqual(self.ordered_ids(), expected)
+
+    def test_moved_task_completed_meanwhile(self):
+        first, second, third, fourth = self.tasks
+
+        def complete_first(user_id, moves):
+            # Completed after the request was validated, before the tasks are locked
+            Task.objects.filter(id=first.id).update(completed=True)
+            return move_tasks(user_id, moves)
+
+        with mock.patch("tasks.apiviews.move_tasks", side_effect=complete_first):
+            response = self.client.post(
+                "/api/v1/task/reorder/",
+                {"moves": [{"id": first.id, "priority": 3}, {"id": fourth.id, "priority": 1}]},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["ids"], [fourth.id, second.id, third.id])
+
+    def test_reorder_rejects_other_users_tasks(self):
+        other = User.objects.create_user(username="other", password="abcd@123")
+        task = Task.objects.create(title="Other", description="Lorem", priority=1, user=other)
+        response = self.client.post(
+            "/api/v1/task/reorder/", {"ids": [task.id, self.tasks[0].id]}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/api/v1/task/reorder/", {}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkAPITests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="gokul", email="gokul@ghv.org", password="abcd@123"
+        )
+        self.client.login(username="gokul", password="abcd@123")
+        TaskStats.for_user(self.user)
+        self.tasks = [
+            Task.objects.create(
+                title=f"Task{i}", description="Lorem", priority=i, user=self.user
+            )
+            for i in range(1, 5)
+        ]
+
+    def ordered_titles(self, **filters):
+        return list(
+            Task.objects.filter(user=self.user, deleted=False, **filters)
+            .order_by("rank", "id")
+            .values_list("title", flat=True)
+        )
+
+    def bulk(self, method, data):
+        return getattr(self.client, method)("/api/v1/task/bulk/", data, format="json")
+
+    def new_tasks(self, count, priority=1):
+        return [
+            {"title": f"New{i}", "description": "Lorem", "priority": priority}
+            for i in range(count)
+        ]
+
+    def test_create(self):
+        response = self.bulk(
+            "post",
+            [
+                {"title": "A", "description": "Lorem", "priority": 1},
+                {"title": "B", "description": "Lorem", "priority": 3},
+                {"title": "C", "description": "Lorem", "priority": 99},
+                {"title": "D", "description": "Lorem", "priority": 1, "completed": True},
+            ],
+        )
+        self.assertEqual(response.status_code, 201)
+        results = response.json()["results"]
+        self.assertEqual(
+            [(task["title"], task["priority"]) for task in results],
+            [("A", 1), ("B", 3), ("C", 7), ("D", 1)],
+        )
+        self.assertEqual(
+            self.ordered_titles(completed=False),
+            ["A", "Task1", "B", "Task2", "Task3", "Task4", "C"],
+        )
+        self.assertEqual(results[0]["id"], Task.objects.get(title="A").id)
+        # Existing tasks kept their ranks
+        self.assertEqual(
+            list(Task.objects.filter(title__startswith="Task").values_list("rank", flat=True)),
+            [task.rank for task in self.tasks],
+        )
+        self.assertEqual(reconcile_task_stats([self.user.id]), 0)
+
+    def test_query_count_does_not_grow(self):
+        counts = []
+        for size in (2, 50):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.bulk("post", self.new_tasks(size))
+            self.assertEqual(response.status_code, 201)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_create_spreads_crowded_list(self):
+        for rank, task in enumerate(self.tasks):
+            Task.objects.filter(id=task.id).update(rank=rank)
+        response = self.bulk("post", self.new_tasks(3, priority=2))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            self.ordered_titles(),
+            ["Task1", "New2", "New1", "New0", "Task2", "Task3", "Task4"],
+        )
+        ranks = Task.objects.filter(user=self.user).order_by("rank").values_list("rank", flat=True)
+        self.assertEqual(list(ranks), [i * RANK_GAP for i in range(1, 8)])
+
+    def test_update(self):
+        first, second, third, fourth = self.tasks
+        response = self.bulk(
+            "patch",
+            [
+                {"id": fourth.id, "priority": 1, "status": "IN_PROGRESS"},
+                {"id": first.id, "title": "Renamed"},
+                {"id": second.id, "completed": True},
+            ],
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(task["id"], task["title"], task["priority"]) for task in response.json()["results"]],
+            [(fourth.id, "Task4", 1), (first.id, "Renamed", 2), (second.id, "Task2", 1)],
+        )
+        self.assertEqual(self.ordered_titles(completed=False), ["Task4", "Renamed", "Task3"])
+        history = History.objects.get(task_changed=fourth)
+        self.assertEqual((history.prev_status, history.updated_status), ("PENDING", "IN_PROGRESS"))
+        self.assertEqual(History.objects.count(), 1)
+        self.assertEqual(reconcile_task_stats([self.user.id]), 0)
+
+    def test_delete(self):
+        ids = [self.tasks[0].id, self.tasks[2].id]
+        response = self.bulk("delete", {"ids": ids})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["results"], [{"id": task_id, "deleted": True} for task_id in ids]
+        )
+        self.assertEqual(self.ordered_titles(), ["Task2", "Task4"])
+        self.assertEqual(Task.objects.filter(user=self.user).count(), 4)
+        self.assertEqual(reconcile_task_stats([self.user.id]), 0)
+
+    def test_invalid_payloads_write_nothing(self):
+        other = User.objects.create_user(username="other")
+        theirs = Task.objects.create(title="Theirs", description="", priority=1, user=other)
+        first = self.tasks[0].id
+        payloads = [
+            ("post", []),
+            ("post", [{"title": "A", "description": "Lorem", "priority": 1}, {"title": "B"}]),
+            ("patch", [{"id": first, "title": "A"}, {"title": "B"}]),
+            ("patch", [{"id": first, "title": "A"}, {"id": first, "title": "B"}]),
+            ("patch", [{"id": first, "title": "A"}, {"id": theirs.id, "title": "B"}]),
+            ("patch", [{"id": first, "priority": 0}]),
+            ("delete", {"ids": [first, theirs.id]}),
+            ("delete", {"ids": []}),
+        ]
+        for method, data in payloads:
+            with self.subTest(method=method, data=data):
+                self.assertEqual(self.bulk(method, data).status_code, 400)
+        self.assertEqual(self.ordered_titles(), ["Task1", "Task2", "Task3", "Task4"])
+        with override_settings(TASKS_BULK_MAX_ITEMS=3):
+            self.assertEqual(self.bulk("post", self.new_tasks(4)).status_code, 400)
+
+
+class DirtyFieldTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="gokul", email="gokul@ghv.org", password="abcd@123"
+        )
+        Task.objects.create(
+            title="TaskTest", description="Lorem", priority=1, user=self.user
+        )
+        self.task = Task.objects.get(title="TaskTest")
+
+    def test_unchanged_save_is_skipped(self):
+        with self.assertNumQueries(0):
+            self.task.save()
+
+    def test_save_only_writes_changed_fields(self):
+        self.task.description = "Ipsum"
+        # The update itself, next to numbering the change (see tasks.sync)
+        with self.assertNumQueries(4) as queries:
+            self.task.save()
+        updates = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith('UPDATE "tasks_task"')
+        ]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"title"', updates[0])
+        self.assertEqual(Task.objects.get(id=self.task.id).description, "Ipsum")
+        self.assertEqual(History.objects.count(), 0)
+
+    def test_status_change_writes_history_without_lookups(self):
+        self.task.status = STATUS_CHOICES[1][0]
+        with CaptureQueriesContext(connection) as queries:
+            self.task.save()
+        self.assertFalse(
+            [query for query in queries.captured_queries if query["sql"].startswith("SELECT")]
+        )
+        history = History.objects.get(task_changed=self.task)
+        self.assertEqual(history.prev_status, STATUS_CHOICES[0][0])
+        self.assertEqual(history.updated_status, STATUS_CHOICES[1][0])
+        self.task.save()
+        self.assertEqual(History.objects.count(), 1)
+
+    def test_tracked_update_writes_history(self):
+        Task.objects.create(
+            title="Cancelled", description="Lorem", priority=2, user=self.user,
+            status=STATUS_CHOICES[3][0],
+        )
+        Task.objects.create(
+            title="Done", description="Lorem", priority=3, user=self.user,
+            status=STATUS_CHOICES[2][0],
+        )
+        count = Task.objects.filter(user=self.user).tracked_update(
+            status=STATUS_CHOICES[2][0]
+        )
+        self.assertEqual(count, 3)
+        self.assertEqual(
+            sorted(History.objects.values_list("prev_status", "updated_status")),
+            [("CANCELLED", "COMPLETED"), ("PENDING", "COMPLETED")],
+        )
+
+
+class HistoryRetentionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="gokul", email="gokul@ghv.org", password="abcd@123"
+        )
+        self.task = Task.objects.create(
+            title="TaskTest", description="Lorem", priority=1, user=self.user
+        )
+        for status in ("IN_PROGRESS", "CANCELLED", "PENDING", "COMPLETED"):
+            self.task.status = status
+            self.task.save()
+        self.history = list(History.objects.order_by("id"))
+
+    def age(self, history, days):
+        History.objects.filter(id=history.id).update(
+            changed_date=timezone.now().date() - timedelta(days=days)
+        )
+
+    def test_compact_old_transitions(self):
+        self.age(self.history[0], 41)
+        for history in self.history[1:3]:
+            self.age(history, 40)
+        report = apply_retention(compact_after_days=30, archive_after_days=365, batch_size=1)
+        self.assertEqual(report["compacted"], 1)
+        self.assertEqual(
+            list(History.objects.order_by("id").values_list("prev_status", "updated_status", "transitions")),
+            [("PENDING", "IN_PROGRESS", 1), ("IN_PROGRESS", "PENDING", 2), ("PENDING", "COMPLETED", 1)],
+        )
+        # Every day keeps its date
+        self.assertEqual(History.objects.values("changed_date").distinct().count(), 3)
+
+    def test_compacted_day_back_where_it_started(self):
+        for history in self.history[:3]:
+            self.age(history, 40)
+        report = apply_retention(compact_after_days=30, archive_after_days=365, batch_size=1)
+        self.assertEqual(report["compacted"], 3)
+        self.assertEqual(
+            list(History.objects.values_list("prev_status", "updated_status", "transitions")),
+            [("PENDING", "COMPLETED", 1)],
+        )
+
+    def test_archive_old_rows(self):
+        for history in self.history[:2]:
+            self.age(history, 400)
+        report = apply_retention(compact_after_days=500, archive_after_days=365, batch_size=1)
+        self.assertEqual(report["archived"], 2)
+        self.assertEqual(History.objects.count(), 2)
+        archived = HistoryArchive.objects.order_by("id")
+        self.assertEqual(
+            list(archived.values_list("task_id", "user", "updated_status")),
+            [(self.task.id, self.user.id, "IN_PROGRESS"), (self.task.id, self.user.id, "CANCELLED")],
+        )
+
+    def test_purge_orphaned_history(self):
+        History.objects.filter(id=self.history[0].id).update(task_changed=None)
+        HistoryArchive.objects.create(
+            prev_status="PENDING", updated_status="COMPLETED",
+            changed_date=timezone.now().date(), task_id=self.task.id + 100,
+        )
+        out = StringIO()
+        call_command("prune_history", stdout=out)
+        self.assertIn("purged 2 history rows", out.getvalue())
+        self.assertEqual(History.objects.count(), 3)
+        self.assertEqual(HistoryArchive.objects.count(), 0)
+
+
+class TaskPurgeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="gokul", email="gokul@ghv.org", password="abcd@123"
+        )
+        TaskStats.for_user(self.user)
+        self.tasks = [
+            Task.objects.create(
+                title=f"Task{i}", description="Lorem", priority=i, user=self.user
+            )
+            for i in range(1, 6)
+        ]
+        for task in self.tasks:
+            task.status = "IN_PROGRESS"
+            task.save()
+
+    def delete(self, task, days):
+        task.deleted = True
+        task.save()
+        Task.objects.filter(id=task.id).update(
+            deleted_at=timezone.now() - timedelta(days=days)
+        )
+
+    def test_deleted_at_follows_deleted(self):
+        task = self.tasks[0]
+        task.deleted = True
+        task.save(update_fields=["deleted"])
+        self.assertIsNotNone(Task.objects.get(id=task.id).deleted_at)
+        task.deleted = False
+        task.save()
+        self.assertIsNone(Task.objects.get(id=task.id).deleted_at)
+        Task.objects.filter(id=task.id).tracked_update(deleted=True)
+        self.assertIsNotNone(Task.objects.get(id=task.id).deleted_at)
+
+    def test_purge_after_grace_period(self):
+        first, second, third, fourth, _ = self.tasks
+        for task in (first, second, fourth):
+            self.delete(task, 40)
+        self.delete(third, 10)
+        HistoryArchive.objects.create(
+            prev_status="PENDING", updated_status="COMPLETED",
+            changed_date=timezone.now().date(), task_id=first.id,
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            report = purge_deleted_tasks(
+                timezone.now() - timedelta(days=30), batch_size=2
+            )
+        self.assertEqual(
+            {key: report[key] for key in ("tasks", "history", "batches")},
+            {"tasks": 3, "history": 4, "batches": 2},
+        )
+        self.assertEqual(
+            list(Task.objects.order_by("id").values_list("id", flat=True)),
+            [self.tasks[2].id, self.tasks[4].id],
+        )
+        self.assertEqual(History.objects.count(), 2)
+        self.assertEqual(HistoryArchive.objects.count(), 0)
+        self.assertEqual(reconcile_task_stats([self.user.id]), 0)
+
+    def test_stops_and_resumes(self):
+        for task in self.tasks:
+            self.delete(task, 40)
+        before = timezone.now() - timedelta(days=30)
+        report = purge_deleted_tasks(before, batch_size=2, max_seconds=0)
+        self.assertEqual(report["tasks"], 0)
+        out = StringIO()
+        call_command("purge_deleted_tasks", "--batch-size=2", "--pause=0", stdout=out)
+        self.assertIn("Purged 5 tasks and 5 history rows in 3 batches", out.getvalue())
+        self.assertIn("and 0 tombstones", out.getvalue())
+        self.assertFalse(Task.objects.exists())
+
+
+class QueryPlanTests(TestCase):
+    """Every list view should be answered from an index, without a sort"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username="gokul", email="gokul@ghv.org", password="abcd@123"
+        )
+        for i in range(1, 6):
+            Task.objects.create(
+                title=f"Task{i}", description="Lorem", priority=i, user=self.user,
+                completed=i % 2 == 0,
+            )
+        self.task = Task.objects.filter(user=self.user).first()
+        self.task.status = STATUS_CHOICES[1][0]
+        self.task.save()
+
+    def view_querysets(self):
+        request = self.factory.get("/")
+        request.user = self.user
+        for view_class in (GenericTaskView, GenericAllTasksView, GenericCompletedTaskView):
+            view = view_class()
+            view.setup(request)
+            yield view_class.__name__, view.get_queryset()[:4]
+        yield "KeysetSeek", (
+            Task.objects.filter(user=self.user, deleted=False, completed=False)
+            .filter(rank__gte=RANK_GAP)
+            .filter(Q(rank__gt=RANK_GAP) | Q(id__gt=1))
+            .order_by("rank", "id")[:5]
+        )
+        view = TaskViewSet(request=request, kwargs={}, format_kwarg=None)
+        yield "TaskViewSet", view.get_queryset()
+        view = HistoryViewSet(request=request, kwargs={"task_pk": self.task.pk})
+        yield "HistoryViewSet", view.get_queryset()
+        yield "DueEmailSettings", due_email_settings().order_by("next_send_at")
+        yield "PurgeDeletedTasks", (
+            Task.objects.filter(deleted=True, deleted_at__lt=timezone.now(), id__gt=0)
+            .order_by("id")
+            .values_list("id", flat=True)[:200]
+        )
+        yield "SyncTasks", (
+            Task.objects.filter(user=self.user, change_seq__gt=2, change_seq__lte=10)
+            .order_by("change_seq")[:501]
+        )
+        today = timezone.now().date()
+        yield "HistoryRollupDay", (
+            History.objects.filter(
+                changed_date__gte=today, changed_date__lt=today + timedelta(days=1)
+            ).values_list("task_changed__user", "prev_status", "updated_status")
+        )
+        yield "DailyRollups", DailyTaskRollup.objects.filter(
+            user=self.user, date__gte=today - timedelta(days=30), date__lt=today
+        )
+        yield "SyncTombstones", (
+            TaskTombstone.objects.filter(user_id=self.user.id, change_seq__gt=2, change_seq__lte=10)
+            .order_by("change_seq")
+            .values_list("change_seq", "task_id")[:501]
+        )
+
+    def assertIndexScan(self, queryset):
+        if connection.vendor == "sqlite":
+            plan = queryset.explain()
+            for line in plan.splitlines():
+                self.assertNotIn("TEMP B-TREE", line, plan)
+                if re.search(r"\b(SCAN|SEARCH) (TABLE )?\w+$", line):
+                    self.fail(f"Full table scan:\n{plan}")
+        elif connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = queryset.explain()
+            self.assertNotIn("Seq Scan", plan, plan)
+            self.assertNotIn("Sort", plan, plan)
+        else:
+            self.skipTest(f"No query plan check for {connection.vendor}")
+
+    def test_views_use_indexes(self):
+        for name, queryset in self.view_querysets():
+            with self.subTest(name):
+                self.assertIndexScan(queryset)
+
+
+class TaskStatsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="gokul", email="gokul@ghv.org", password="abcd@123"
+        )
+        self.client.login(username="gokul", password="abcd@123")
+        TaskStats.for_user(self.user)
+        self.tasks = [
+            Task.objects.create(
+                title=f"Task{i}", description="Lorem", priority=i, user=self.user
+            )
+            for i in range(1, 4)
+        ]
+
+    def assertStats(self, **expected):
+        stats = TaskStats.objects.filter(user=self.user).values(*expected).get()
+        self.assertEqual(stats, expected)
+
+    def test_counts_follow_writes(self):
+        self.assertStats(active_count=3, completed_count=0, status_pending=3)
+        self.client.post(f"/complete_task/{self.tasks[0].pk}/")
+        self.assertStats(active_count=3, completed_count=1, status_pending=2)
+        task = Task.objects.get(pk=self.tasks[1].pk)
+        task.status = STATUS_CHOICES[1][0]
+        task.save()
+        self.assertStats(status_pending=1, status_in_progress=1)
+        task.deleted = True
+        task.save()
+        self.assertStats(active_count=2, completed_count=1, status_in_progress=0)
+        self.client.post(f"/delete-task/{self.tasks[2].pk}/")
+        self.assertStats(active_count=1, completed_count=1, status_pending=0)
+
+    def test_progress_reads_one_row(self):
+        response = self.client.get("/tasks/")
+        self.assertEqual(response.context["completed_count"], 0)
+        self.assertEqual(response.context["total_count"], 3)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/tasks/")
+        sql = [query["sql"] for query in queries.captured_queries]
+        self.assertFalse([query for query in sql if "COUNT(" in query])
+        self.assertEqual(sum('FROM "tasks_taskstats"' in query for query in sql), 1)
+
+    def test_reconcile_repairs_drift(self):
+        TaskStats.objects.filter(user=self.user).update(active_count=10, status_pending=0)
+        out = StringIO()
+        call_command("reconcile_task_stats", stdout=out)
+        self.assertIn("Repaired task stats for 1 user", out.getvalue())
+        self.assertStats(active_count=3, status_pending=3)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="gokul", email="gokul@ghv.org", password="abcd@123"
+        )
+        self.client.login(username="gokul", password="abcd@123")
+        for i in range(1, 11):
+            Task.objects.create(
+                title=f"Task{i}", description="Lorem", priority=i, user=self.user
+            )
+        Task.objects.filter(title__in=("Task3", "Task6")).tracked_update(completed=True)
+
+    def page(self, url, cursor=None):
+        response = self.client.get(url, {"cursor": cursor} if cursor else {})
+        self.assertEqual(response.status_code, 200)
+        page = response.context["page_obj"]
+        return page, [(task.title, task.priority) for task in page]
+
+    def test_html_pages(self):
+        page, tasks = self.page("/tasks/")
+        self.assertEqual(tasks, [("Task1", 1), ("Task2", 2), ("Task4", 3), ("Task5", 4)])
+        self.assertEqual((page.number, page.paginator.num_pages), (1, 2))
+        self.assertFalse(page.has_previous())
+        page, tasks = self.page("/tasks/", page.next_cursor)
+        self.assertEqual(tasks, [("Task7", 5), ("Task8", 6), ("Task9", 7), ("Task10", 8)])
+        self.assertFalse(page.has_next())
+        page, tasks = self.page("/tasks/", page.previous_cursor)
+        self.assertEqual(page.number, 1)
+        self.assertEqual(tasks[0], ("Task1", 1))
+
+    def test_html_all_tasks_numbers_each_list(self):
+        page, _ = self.page("/all_tasks/")
+        page, tasks = self.page("/all_tasks/", page.next_cursor)
+        self.assertEqual(tasks, [("Task5", 4), ("Task6", 2), ("Task7", 5), ("Task8", 6)])
+        page, tasks = self.page("/all_tasks/", page.previous_cursor)
+        self.assertEqual(tasks, [("Task1", 1), ("Task2", 2), ("Task3", 1), ("Task4", 3)])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get("/tasks/", {"cursor": "nonsense"}).status_code, 404)
+        self.assertEqual(
+            self.client.get("/api/v1/task/", {"cursor": "nonsense"}).status_code, 404
+        )
+        # A cursor claiming other counts before the page than the server's
+        page, _ = self.page("/tasks/")
+        position = signing.loads(page.next_cursor, salt=pagination.CURSOR_SALT)
+        position["o"] = [100, 0]
+        forged = signing.dumps(position)
+        self.assertEqual(self.client.get("/tasks/", {"cursor": forged}).status_code, 404)
+
+    def test_previous_page_has_next_from_the_data(self):
+        page, _ = self.page("/tasks/")
+        page, _ = self.page("/tasks/", page.next_cursor)
+        cursor = page.previous_cursor
+        # The later page is gone by the time the client goes back from it
+        Task.objects.filter(title__in=("Task7", "Task8", "Task9", "Task10")).tracked_update(
+            completed=True
+        )
+        page, tasks = self.page("/tasks/", cursor)
+        self.assertEqual(tasks[0], ("Task1", 1))
+        self.assertFalse(page.has_next())
+        self.assertIsNone(page.next_cursor)
+
+    def test_api_pages(self):
+        response = self.client.get("/api/v1/task/", {"page_size": 3}).json()
+        self.assertIsNone(response["previous"])
+        seen = []
+        while True:
+            seen += [(task["title"], task["priority"]) for task in response["results"]]
+            if response["next"] is None:
+                break
+            response = self.client.get(response["next"]).json()
+        self.assertEqual(len(seen), 10)
+        self.assertEqual([title for title, _ in seen], [f"Task{i}" for i in range(1, 11)])
+        self.assertEqual(seen[:3], [("Task1", 1), ("Task2", 2), ("Task3", 1)])
+
+    def test_api_filtered_priorities(self):
+        response = self.client.get("/api/v1/task/", {"completed": "false", "page_size": 2})
+        response = self.client.get(response.json()["next"]).json()
+        self.assertEqual(
+            [(task["title"], task["priority"]) for task in response["results"]],
+            [("Task4", 3), ("Task5", 4)],
+        )
+
+    def test_deep_pages_cost_the_same(self):
+        page, _ = self.page("/all_tasks/")
+        with CaptureQueriesContext(connection) as first:
+            self.client.get("/all_tasks/")
+        while page.has_next():
+            cursor = page.next_cursor
+            page, _ = self.page("/all_tasks/", cursor)
+        with CaptureQueriesContext(connection) as last:
+            self.client.get("/all_tasks/", {"cursor": cursor})
+        self.assertEqual(len(first), len(last))
+
+
+class TaskListAPITests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.users = [
+            User.objects.create_user(username=name, first_name=name.title(), password="abcd@123")
+            for name in ("gokul", "ghv")
+        ]
+        for user in self.users:
+            for i in range(1, 4):
+                Task.objects.create(
+                    title=f"Task{i}", description="Lorem", priority=i, user=user
+                )
+        Task.objects.filter(title="Task2").tracked_update(completed=True)
+
+    def get(self, **params):
+        # JSON side-loading streams the users first, from a query of their own
+        queries = 2 if params.get("sideload") and "format" not in params else 1
+        with self.assertNumQueries(queries):
+            response = self.client.get("/taskapi", params)
+            content = b"".join(response.streaming_content)
+        return response, content.decode()
+
+    def test_json(self):
+        response, content = self.get()
+        tasks = json.loads(content)["tasks"]
+        self.assertEqual(len(tasks), 6)
+        self.assertEqual(
+            tasks[:3],
+            [
+                {
+                    "title": "Task1",
+                    "description": "Lorem",
+                    "completed": False,
+                    "priority": 1,
+                    "status": "PENDING",
+                    "user": {"first_name": "Gokul", "last_name": "", "username": "gokul"},
+                },
+                {
+                    "title": "Task2",
+                    "description": "Lorem",
+                    "completed": True,
+                    "priority": 1,
+                    "status": "PENDING",
+                    "user": {"first_name": "Gokul", "last_name": "", "username": "gokul"},
+                },
+                {
+                    "title": "Task3",
+                    "description": "Lorem",
+                    "completed": False,
+                    "priority": 2,
+                    "status": "PENDING",
+                    "user": {"first_name": "Gokul", "last_name": "", "username": "gokul"},
+                },
+            ],
+        )
+
+    def test_json_sideload(self):
+        response, content = self.get(sideload="users")
+        data = json.loads(content)
+        self.assertEqual(
+            data["users"][str(self.users[1].id)],
+            {"first_name": "Ghv", "last_name": "", "username": "ghv"},
+        )
+        self.assertEqual([task["user"] for task in data["tasks"]], [self.users[0].id] * 3 + [self.users[1].id] * 3)
+
+    def test_ndjson(self):
+        response, content = self.get(format="ndjson", sideload="users")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(lines[0], {"users": {str(self.users[0].id): {"first_name": "Gokul", "last_name": "", "username": "gokul"}}})
+        self.assertEqual(lines[1]["user"], self.users[0].id)
+        self.assertIn("users", lines[4])
+
+
+class ReadSerializerTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        self.client.login(username="gokul", password="abcd@123")
+        self.task = Task.objects.create(title="Task", description="Lorem", user=self.user)
+        for status in ("IN_PROGRESS", "COMPLETED", "CANCELLED", "PENDING"):
+            self.task.status = status
+            self.task.save()
+        for i in range(5):
+            Task.objects.create(title=f"Other{i}", user=self.user)
+
+    def test_history_list_matches_model_serializer(self):
+        response = self.client.get(f"/api/v1/task/{self.task.id}/history/")
+        history = list(
+            History.objects.filter(task_changed=self.task).select_related("task_changed").order_by("id")
+        )
+        number_priorities([row.task_changed for row in history])
+        expected = HistorySerializer(history, many=True).data
+        self.assertEqual(response.json(), json.loads(json.dumps(expected)))
+        self.assertEqual(response.json()[0]["task_changed"]["user"]["username"], "gokul")
+
+    def test_task_list_matches_model_serializer(self):
+        response = self.client.get("/api/v1/task/")
+        tasks = Task.objects.filter(user=self.user).order_by("rank", "id")
+        expected = TaskSerializer(number_priorities(list(tasks)), many=True).data
+        self.assertEqual(response.json()["results"], json.loads(json.dumps(expected)))
+
+    def assertConstantQueries(self, url, add_rows):
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+        add_rows()
+        with self.assertNumQueries(len(before)):
+            self.client.get(url)
+
+    def test_history_list_queries(self):
+        def add_rows():
+            for status in ("IN_PROGRESS", "COMPLETED") * 10:
+                self.task.status = status
+                self.task.save()
+
+        self.assertConstantQueries(f"/api/v1/task/{self.task.id}/history/", add_rows)
+
+    def test_task_list_queries(self):
+        def add_rows():
+            for i in range(20):
+                Task.objects.create(title=f"More{i}", user=self.user)
+
+        self.assertConstantQueries("/api/v1/task/", add_rows)
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """
+    Refuses recipients whose address starts with "bounce", and fails to
+    encode those starting with "invalid", as the SMTP backend does domains
+    that aren't valid IDNA
+    """
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.to[0].startswith("bounce"):
+                raise SMTPRecipientsRefused({message.to[0]: (550, b"No such user")})
+            if message.to[0].startswith("invalid"):
+                raise UnicodeError("label too long")
+        return super().send_messages(messages)
+
+
+@override_settings(
+    EMAIL_BACKEND="tasks.tests.FlakyEmailBackend",
+    EMAIL_OUTBOX_MAX_ATTEMPTS=3,
+    EMAIL_OUTBOX_BACKOFF_SECONDS=60,
+)
+class EmailOutboxTests(TestCase):
+    def setUp(self):
+        outbox.enqueue(
+            EmailMessage("Report", "Body", "from@ghv.org", [to])
+            for to in ("a@ghv.org", "bounce@ghv.org", "b@ghv.org")
+        )
+
+    def make_due(self):
+        EmailOutbox.objects.filter(status="PENDING").update(next_attempt_at=timezone.now())
+
+    def test_deliver_in_batches(self):
+        report = outbox.deliver(batch_size=2)
+        self.assertEqual((report["batches"], report["sent"], report["failed"]), (2, 2, 1))
+        self.assertEqual([message.to for message in mail.outbox], [["a@ghv.org"], ["b@ghv.org"]])
+        self.assertEqual(EmailOutbox.objects.filter(status="SENT", attempts=1).count(), 2)
+
+        # Nothing is due again until the backoff has passed
+        self.assertEqual(outbox.deliver()["batches"], 0)
+
+    def test_backoff_and_dead_letter(self):
+        outbox.deliver()
+        failed = EmailOutbox.objects.get(to="bounce@ghv.org")
+        self.assertEqual((failed.status, failed.attempts), ("PENDING", 1))
+        self.assertIn("SMTPRecipientsRefused", failed.last_error)
+        delay = failed.next_attempt_at - timezone.now()
+        self.assertTrue(timedelta(seconds=55) < delay <= timedelta(seconds=60))
+
+        self.make_due()
+        outbox.deliver()
+        failed.refresh_from_db()
+        delay = failed.next_attempt_at - timezone.now()
+        self.assertTrue(timedelta(seconds=115) < delay <= timedelta(seconds=120))
+
+        self.make_due()
+        outbox.deliver()
+        failed.refresh_from_db()
+        self.assertEqual((failed.status, failed.attempts), ("DEAD", 3))
+        self.make_due()
+        self.assertEqual(outbox.deliver()["batches"], 0)
+
+        self.assertEqual(outbox.requeue_dead(), 1)
+        self.assertEqual(outbox.deliver()["failed"], 1)
+
+    def test_other_errors_fail_only_their_message(self):
+        EmailOutbox.objects.all().delete()
+        outbox.enqueue(
+            EmailMessage("Report", "Body", "from@ghv.org", [to])
+            for to in ("a@ghv.org", "invalid@ghv.org", "b@ghv.org")
+        )
+        report = outbox.deliver()
+        self.assertEqual((report["sent"], report["failed"]), (2, 1))
+        self.assertEqual([message.to for message in mail.outbox], [["a@ghv.org"], ["b@ghv.org"]])
+        failed = EmailOutbox.objects.get(to="invalid@ghv.org")
+        self.assertEqual((failed.status, failed.attempts), ("PENDING", 1))
+        self.assertIn("UnicodeError", failed.last_error)
+        self.assertEqual(EmailOutbox.objects.filter(status="SENT").count(), 2)
+
+    def test_sent_messages_are_saved_when_the_batch_breaks_off(self):
+        with mock.patch.object(
+            FlakyEmailBackend, "close", side_effect=KeyboardInterrupt
+        ), self.assertRaises(KeyboardInterrupt):
+            outbox.deliver()
+        self.assertEqual(
+            sorted(EmailOutbox.objects.filter(status="SENT").values_list("to", flat=True)),
+            ["a@ghv.org", "b@ghv.org"],
+        )
+        self.assertEqual(EmailOutbox.objects.get(to="bounce@ghv.org").attempts, 1)
+
+    def test_leased_rows_are_skipped(self):
+        leased = outbox.lease_batch(2)
+        self.assertEqual(len(leased), 2)
+        self.assertEqual([row.to for row in outbox.lease_batch(10)], ["b@ghv.org"])
+        self.assertEqual(outbox.lease_batch(10), [])
+
+    def test_lag_is_observed_on_delivery(self):
+        cache.clear()
+        due_at = timezone.now() - timedelta(hours=1)
+        outbox.enqueue(
+            [EmailMessage("Report", "Body", "from@ghv.org", ["c@ghv.org", "bounce@ghv.org"])],
+            due_at=[due_at],
+        )
+        self.assertEqual(celerymetrics.snapshot("schedule_lag", [()]), {})
+        outbox.deliver()
+        # Of the messages that had a due time, only the one sent
+        _, total, count = celerymetrics.snapshot("schedule_lag", [()])[()]
+        self.assertEqual(count, 1)
+        self.assertGreaterEqual(total, 3600)
+
+    def test_metrics(self):
+        outbox.deliver()
+        metrics = {name: samples for name, _, _, samples in collect()}
+        self.assertEqual(
+            metrics["email_outbox_messages"],
+            {(("status", "PENDING"),): 1, (("status", "SENT"),): 2, (("status", "DEAD"),): 0},
+        )
+        self.assertEqual(metrics["email_outbox_sent_last_minute"], {(): 2})
+        self.assertGreaterEqual(metrics["email_outbox_oldest_pending_seconds"][()], 0)
+
+        out = StringIO()
+        call_command("email_outbox", stdout=out)
+        self.assertIn("email_outbox_messages{status=SENT} 2", out.getvalue())
+
+
+@override_settings(TASKS_PAGE_CACHE=True)
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        self.client.login(username="gokul", password="abcd@123")
+        # Pages are only cached once the client holds a CSRF cookie
+        self.client.get("/user/login/")
+        self.tasks = [
+            Task.objects.create(title=f"Task{i}", description="Lorem", user=self.user)
+            for i in range(1, 4)
+        ]
+
+    def test_hot_page_is_served_from_cache(self):
+        for url in ("/tasks/", "/all_tasks/", "/completed_tasks/", f"/detail-task/{self.tasks[0].id}/"):
+            with self.subTest(url):
+                first = self.client.get(url)
+                # Only the session and its user are loaded
+                with self.assertNumQueries(2):
+                    second = self.client.get(url)
+                self.assertEqual(first.content, second.content)
+        self.assertEqual(page_cache.counters(), {"hit": 4, "miss": 4})
+
+    def test_writes_invalidate_pages(self):
+        self.client.get("/tasks/")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/complete_task/{self.tasks[0].id}/")
+        response = self.client.get("/tasks/")
+        self.assertNotContains(response, "Task1")
+        self.assertContains(response, "1 of 3 tasks completed")
+
+        self.tasks[1].title = "Renamed"
+        self.tasks[1].save()
+        self.assertContains(self.client.get("/tasks/"), "Renamed")
+
+        Task.objects.filter(id=self.tasks[2].id).tracked_update(title="Bulk")
+        self.assertContains(self.client.get("/tasks/"), "Bulk")
+
+        reorder_tasks(self.user.id, [self.tasks[2].id, self.tasks[1].id])
+        content = self.client.get("/tasks/").content.decode()
+        self.assertLess(content.index("Bulk"), content.index("Renamed"))
+        self.assertEqual(page_cache.counters(), {"hit": 0, "miss": 5})
+
+    def test_pages_are_per_user_and_per_csrf_cookie(self):
+        self.client.get("/tasks/")
+        other = User.objects.create_user(username="ghv", password="abcd@123")
+        Task.objects.create(title="Theirs", user=other)
+        client = Client()
+        client.login(username="ghv", password="abcd@123")
+        client.get("/user/login/")
+        self.assertContains(client.get("/tasks/"), "Theirs")
+
+        # As after logging in again, which rotates the CSRF cookie
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = "a" * 32
+        self.client.get("/tasks/")
+        self.assertEqual(page_cache.counters(), {"hit": 0, "miss": 3})
+
+    @override_settings(TASKS_PAGE_CACHE=False)
+    def test_off_without_a_shared_cache(self):
+        self.client.get("/tasks/")
+        self.assertContains(self.client.get("/tasks/"), "Task1")
+        self.assertEqual(page_cache.counters(), {"hit": 0, "miss": 0})
+        response = self.client.get("/api/v1/task/")
+        self.assertFalse(response.has_header("ETag"))
+        self.assertEqual(
+            self.client.get("/api/v1/task/", HTTP_IF_MODIFIED_SINCE=http_date()).status_code, 200
+        )
+
+    def test_locmem_cache_is_warned_about(self):
+        self.assertEqual([error.id for error in page_cache.check()], ["tasks.W001"])
+        with override_settings(TASKS_PAGE_CACHE=False):
+            self.assertEqual(page_cache.check(), [])
+
+
+@override_settings(TASKS_PAGE_CACHE=True)
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        self.client.login(username="gokul", password="abcd@123")
+        self.task = Task.objects.create(title="Task1", description="Lorem", user=self.user)
+        self.task.status = "IN_PROGRESS"
+        self.task.save()
+
+    def urls(self):
+        return (
+            "/api/v1/task/",
+            "/api/v1/task/?completed=false",
+            "/api/v1/task/search/?q=task1",
+            f"/api/v1/task/{self.task.id}/",
+            f"/api/v1/task/{self.task.id}/history/",
+        )
+
+    def test_if_none_match(self):
+        etags = set()
+        for url in self.urls():
+            with self.subTest(url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                etag = response["ETag"]
+                self.assertTrue(etag.startswith('W/"'))
+                etags.add(etag)
+                # Only the session and its user are loaded
+                with self.assertNumQueries(2):
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response["ETag"], etag)
+        self.assertEqual(len(etags), len(self.urls()))
+
+        self.client.patch(f"/api/v1/task/{self.task.id}/", {"title": "Renamed"})
+        for url in self.urls():
+            with self.subTest(url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=", ".join(etags))
+                self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        response = self.client.get("/api/v1/task/")
+        last_modified = response["Last-Modified"]
+        response = self.client.get("/api/v1/task/", HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # Bulk writes bump the version too
+        Task.objects.filter(id=self.task.id).tracked_update(status="COMPLETED")
+        version = page_cache.get_version(self.user.id)
+        response = self.client.get(
+            "/api/v1/task/", HTTP_IF_MODIFIED_SINCE=http_date(version // 10**9 - 1)
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_versions_are_per_user(self):
+        etag = self.client.get("/api/v1/task/")["ETag"]
+        other = User.objects.create_user(username="ghv")
+        Task.objects.create(title="Theirs", user=other)
+        response = self.client.get("/api/v1/task/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        self.client.login(username="gokul", password="abcd@123")
+        self.invoice = Task.objects.create(
+            title="Send invoices", description="Monthly billing", user=self.user
+        )
+        self.report = Task.objects.create(
+            title="Quarterly report", description="Attach the invoice totals", user=self.user
+        )
+        self.other = Task.objects.create(title="Groceries", description="Milk", user=self.user)
+
+    def search(self, q, **params):
+        response = self.client.get("/api/v1/task/search/", {"q": q, **params})
+        self.assertEqual(response.status_code, 200)
+        return [task["title"] for task in response.json()["results"]]
+
+    def test_ranked_prefix_search(self):
+        # Title matches rank above description matches, words match as prefixes
+        self.assertEqual(self.search("invoice"), ["Send invoices", "Quarterly report"])
+        self.assertEqual(self.search("invo"), ["Send invoices", "Quarterly report"])
+        self.assertEqual(self.search("invoice totals"), ["Quarterly report"])
+        self.assertEqual(self.search("invoice", limit=1), ["Send invoices"])
+        self.assertEqual(self.search('"bill" OR milk*'), [])
+
+    def test_invalid_queries(self):
+        for params in ({}, {"q": "  !? "}, {"q": "invoice", "limit": 500}):
+            with self.subTest(params):
+                response = self.client.get("/api/v1/task/search/", params)
+                self.assertEqual(response.status_code, 400)
+
+    def test_index_follows_writes(self):
+        self.invoice.title = "Pay rent"
+        self.invoice.save()
+        self.assertEqual(self.search("invoice"), ["Quarterly report"])
+        self.assertEqual(self.search("rent"), ["Pay rent"])
+
+        Task.objects.filter(id=self.report.id).tracked_update(deleted=True)
+        self.assertEqual(self.search("invoice"), [])
+        Task.objects.filter(id=self.report.id).tracked_update(deleted=False)
+        self.assertEqual(self.search("invoice"), ["Quarterly report"])
+
+        self.report.delete()
+        self.assertEqual(self.search("invoice"), [])
+
+    def test_other_users_tasks(self):
+        other = User.objects.create_user(username="ghv")
+        theirs = Task.objects.create(title="Their invoices", description="", user=other)
+        self.assertEqual(self.search("invoice"), ["Send invoices", "Quarterly report"])
+        self.assertEqual(search.search(other.id, "invoice", 10), [theirs.id])
+
+    def test_filter(self):
+        Task.objects.create(title="Old invoice", description="", user=self.user, completed=True)
+        response = self.client.get("/api/v1/task/", {"q": "invoice", "completed": "false"})
+        results = response.json()["results"]
+        self.assertEqual(
+            [(task["title"], task["priority"]) for task in results],
+            [("Send invoices", 1), ("Quarterly report", 2)],
+        )
+
+    def test_triggers_reinstalled_after_migrate(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite only")
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TRIGGER {search.FTS_TABLE}_insert")
+        call_command("migrate", verbosity=0)
+        Task.objects.create(title="Renew passport", description="", user=self.user)
+        self.assertEqual(self.search("passport"), ["Renew passport"])
+
+
+@override_settings(TASKS_PAGE_CACHE=True)
+class AsyncAPITests(TransactionTestCase):
+    """The async views run on pool threads, with connections of their own"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        self.task = Task.objects.create(
+            title="Task1", description="Lorem", priority=1, user=self.user
+        )
+        self.task.status = "IN_PROGRESS"
+        self.task.save()
+        self.client = AsyncClient()
+        self.sync_client = APIClient()
+        self.sync_client.login(username="gokul", password="abcd@123")
+
+    async def login(self):
+        await sync_to_async(self.client.force_login)(self.user)
+
+    async def test_same_responses_as_sync_views(self):
+        await self.login()
+        for path in (
+            "/api/v1/task/",
+            "/api/v1/task/?completed=false",
+            f"/api/v1/task/{self.task.id}/",
+            f"/api/v1/task/{self.task.id}/history/",
+        ):
+            with self.subTest(path):
+                response = await self.client.get(path.replace("/api/", "/api/async/"))
+                self.assertEqual(response.status_code, 200)
+                expected = await sync_to_async(self.sync_client.get)(path)
+                self.assertEqual(
+                    json.loads(response.content.replace(b"/api/async/", b"/api/")),
+                    expected.json(),
+                )
+                etag = response["ETag"]
+                # AsyncClient takes headers by their HTTP names in Django 4.0
+                response = await self.client.get(
+                    path.replace("/api/", "/api/async/"), **{"if-none-match": etag}
+                )
+                self.assertEqual(response.status_code, 304)
+
+    def sync_stream(self):
+        response = self.sync_client.get("/taskapi", HTTP_ACCEPT="application/x-ndjson")
+        return b"".join(response.streaming_content)
+
+    async def test_stream(self):
+        await self.login()
+        response = await self.client.get("/async/taskapi", accept="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        content = await sync_to_async(b"".join)(response.streaming_content)
+        self.assertEqual(content, await sync_to_async(self.sync_stream)())
+
+    async def test_stream_is_sent_as_it_is_produced(self):
+        for i in range(5):
+            await sync_to_async(Task.objects.create)(title=f"Task{i}", user=self.user)
+        request = AsyncRequestFactory().get("/async/taskapi", {"format": "ndjson"})
+        request.user = self.user
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        with mock.patch.object(TaskListAPI, "chunk_size", 2):
+            response = await asyncviews.task_stream(request)
+            self.assertIsInstance(response, asyncviews.ExecutorStreamingHttpResponse)
+            await asyncviews.StreamingASGIHandler().send_response(response, send)
+            expected = await sync_to_async(self.sync_stream)()
+        self.assertEqual(messages[0]["status"], 200)
+        bodies = [message.get("body", b"") for message in messages[1:]]
+        # Six tasks, two lines a chunk
+        self.assertGreaterEqual(len(bodies), 4)
+        self.assertEqual(b"".join(bodies), expected)
+
+    async def test_requires_login(self):
+        response = await self.client.get("/api/async/v1/task/")
+        self.assertEqual(response.status_code, 403)
+
+
+class TaskEventTests(TestCase):
+    def setUp(self):
+        events.get_broker.cache_clear()
+        self.addCleanup(events.get_broker.cache_clear)
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        self.client.login(username="gokul", password="abcd@123")
+        # Replay is only kept for users that subscribed
+        events.get_broker().track(self.user.id)
+
+    def published(self):
+        return [message[1:] for message in events.get_broker().history[self.user.id]]
+
+    def test_writes_publish_events(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            task = Task.objects.create(
+                title="Task1", description="Lorem", priority=1, user=self.user
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            task.title = "Renamed"
+            task.save()
+            task.status = "IN_PROGRESS"
+            task.save()
+            task.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                "/api/v1/task/bulk/",
+                [{"title": "Task2", "description": "Lorem", "priority": 1}],
+                format="json",
+            )
+            other = Task.objects.get(title="Task2")
+            other_id = other.id
+            Task.objects.filter(id=task.id).tracked_update(completed=True)
+            self.client.delete("/api/v1/task/bulk/", {"ids": [task.id]}, format="json")
+            other.delete()
+        fields = {"title": "Task1", "description": "Lorem", "completed": False, "status": "PENDING"}
+        self.assertEqual(
+            self.published(),
+            [
+                ("created", {"id": task.id, **fields}),
+                ("updated", {"id": task.id, "title": "Renamed"}),
+                ("status_changed", {"id": task.id, "status": "IN_PROGRESS"}),
+                ("created", {"id": other_id, **fields, "title": "Task2"}),
+                ("updated", {"id": task.id, "completed": True}),
+                ("deleted", {"id": task.id}),
+                ("deleted", {"id": other_id}),
+            ],
+        )
+
+    def test_nothing_published_on_rollback(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Task.objects.create(title="Task1", description="Lorem", user=self.user)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(self.published(), [])
+
+
+class EventBrokerTests(SimpleTestCase):
+    async def collect(self, messages, count):
+        return [await messages.__anext__() for _ in range(count)]
+
+    async def test_slow_subscriber_is_dropped_and_resumes(self):
+        broker = events.InProcessBroker(replay=5, queue_size=2)
+        messages = broker.subscribe(1, timeout=0.01)
+        self.assertIsNone(await messages.__anext__())
+        broker.publish([(1, "updated", {"id": i}) for i in range(1, 5)])
+        broker.publish([(2, "updated", {"id": 99})])
+        self.assertEqual(
+            await self.collect(messages, 2),
+            [("1", "updated", {"id": 1}), ("2", "updated", {"id": 2})],
+        )
+        with self.assertRaises(StopAsyncIteration):
+            await messages.__anext__()
+        self.assertEqual(broker.subscriptions, {})
+
+        messages = broker.subscribe(1, last_event_id="2", timeout=0.01)
+        self.assertEqual(
+            await self.collect(messages, 3),
+            [("3", "updated", {"id": 3}), ("4", "updated", {"id": 4}), None],
+        )
+        await messages.aclose()
+
+    async def subscribed(self, broker, user_id):
+        """Subscribe user_id and disconnect, as a client between reconnects"""
+        messages = broker.subscribe(user_id, timeout=0.01)
+        self.assertIsNone(await messages.__anext__())
+        await messages.aclose()
+
+    async def test_reset_when_replay_is_gone(self):
+        broker = events.InProcessBroker(replay=2, queue_size=2)
+        await self.subscribed(broker, 1)
+        broker.publish([(1, "updated", {"id": i}) for i in range(1, 5)])
+        messages = broker.subscribe(1, last_event_id="1", timeout=0.01)
+        self.assertEqual(await self.collect(messages, 2), [("4", "reset", {}), None])
+        await messages.aclose()
+        for last_event_id in ("4", "garbage", None):
+            messages = broker.subscribe(1, last_event_id=last_event_id, timeout=0.01)
+            self.assertIsNone(await messages.__anext__())
+            await messages.aclose()
+
+        # An id of an earlier process, past the latest one here
+        messages = broker.subscribe(1, last_event_id="9", timeout=0.01)
+        self.assertEqual(await self.collect(messages, 2), [("4", "reset", {}), None])
+        await messages.aclose()
+
+    async def test_replay_is_kept_for_recent_subscribers_only(self):
+        broker = events.InProcessBroker(replay=5, queue_size=2, replay_users=2)
+        broker.publish([(1, "updated", {"id": 1})])
+        self.assertEqual(broker.history, {})
+
+        messages = broker.subscribe(1, timeout=0.01)
+        self.assertIsNone(await messages.__anext__())
+        for user_id in (2, 3):
+            await self.subscribed(broker, user_id)
+        # User 1 is still subscribed, user 2 subscribed longest ago
+        self.assertEqual(list(broker.history), [1, 3])
+        await messages.aclose()
+        await self.subscribed(broker, 4)
+        self.assertEqual(list(broker.history), [3, 4])
+
+
+class EventStreamTests(TransactionTestCase):
+    def setUp(self):
+        events.get_broker.cache_clear()
+        self.addCleanup(events.get_broker.cache_clear)
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        client = Client()
+        client.force_login(self.user)
+        self.cookie = f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}"
+
+    def scope(self, *headers, method="GET"):
+        return {
+            "type": "http",
+            "method": method,
+            "path": sse.EVENTS_PATH,
+            "query_string": b"",
+            "headers": [(b"cookie", self.cookie.encode()), *headers],
+        }
+
+    async def start(self, scope):
+        """Run the stream, returning its sent messages and a way to disconnect"""
+        sent = asyncio.Queue()
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        app = asyncio.ensure_future(sse.application(scope, receive, sent.put))
+        return app, sent, disconnected
+
+    async def body(self, sent):
+        return (await asyncio.wait_for(sent.get(), 5))["body"]
+
+    async def test_stream_and_resume(self):
+        app, sent, disconnected = await self.start(self.scope())
+        start = await asyncio.wait_for(sent.get(), 5)
+        self.assertEqual(start["status"], 200)
+        self.assertIn((b"content-type", b"text/event-stream"), start["headers"])
+        self.assertEqual(await self.body(sent), b"retry: 2000\n\n")
+
+        task = await sync_to_async(Task.objects.create)(
+            title="Task1", description="Lorem", user=self.user
+        )
+        body = await self.body(sent)
+        self.assertTrue(body.startswith(b"id: 1\nevent: created\ndata: {"), body)
+        self.assertEqual(json.loads(body.split(b"data: ")[1])["id"], task.id)
+        disconnected.set()
+        await asyncio.wait_for(app, 5)
+
+        task.status = "COMPLETED"
+        await sync_to_async(task.save)()
+        app, sent, disconnected = await self.start(self.scope((b"last-event-id", b"1")))
+        await sent.get()
+        await sent.get()
+        self.assertTrue((await self.body(sent)).startswith(b"id: 2\nevent: status_changed\n"))
+        disconnected.set()
+        await asyncio.wait_for(app, 5)
+
+    async def test_requires_login(self):
+        self.cookie = ""
+        app, sent, _ = await self.start(self.scope())
+        self.assertEqual((await sent.get())["status"], 403)
+        await asyncio.wait_for(app, 5)
+        app, sent, _ = await self.start(self.scope(method="POST"))
+        self.assertEqual((await sent.get())["status"], 405)
+
+
+class SyncAPITests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        self.client.login(username="gokul", password="abcd@123")
+        self.tasks = [
+            Task.objects.create(
+                title=f"Task{i}", description="Lorem", priority=i, user=self.user
+            )
+            for i in range(1, 5)
+        ]
+
+    def sync(self, since="0", user=None, **params):
+        client = self.client
+        if user is not None:
+            client = APIClient()
+            client.force_authenticate(user)
+        response = client.get("/api/v1/sync/", {"since": since, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_full_then_incremental_sync(self):
+        full = self.sync()
+        self.assertEqual(
+            [task["title"] for task in full["changed"]], ["Task1", "Task2", "Task3", "Task4"]
+        )
+        self.assertEqual(full["changed"][0]["rank"], self.tasks[0].rank)
+        self.assertEqual((full["deleted"], full["more"], full["reset"]), ([], False, False))
+        self.assertEqual(self.sync(full["cursor"])["changed"], [])
+
+        first, second, third, fourth = self.tasks
+        first.title = "Renamed"
+        first.save()
+        self.client.post(f"/complete_task/{second.id}/")
+        self.client.patch(
+            "/api/v1/task/bulk/", [{"id": third.id, "status": "COMPLETED"}], format="json"
+        )
+        self.client.delete("/api/v1/task/bulk/", {"ids": [fourth.id]}, format="json")
+        changes = self.sync(full["cursor"])
+        self.assertEqual(
+            [(task["id"], task["title"]) for task in changes["changed"]],
+            [(first.id, "Renamed"), (second.id, "Task2"), (third.id, "Task3")],
+        )
+        self.assertTrue(changes["changed"][1]["completed"])
+        self.assertEqual(changes["changed"][2]["status"], "COMPLETED")
+        self.assertEqual(changes["deleted"], [fourth.id])
+
+        reorder_tasks(self.user.id, [third.id, first.id])
+        changes = self.sync(changes["cursor"])
+        self.assertEqual({task["id"] for task in changes["changed"]}, {first.id, third.id})
+        ranks = {task["id"]: task["rank"] for task in changes["changed"]}
+        self.assertLess(ranks[third.id], ranks[first.id])
+
+    def test_paging(self):
+        cursor, seen = "0", []
+        while True:
+            changes = self.sync(cursor, limit=3)
+            seen += [task["title"] for task in changes["changed"]]
+            cursor = changes["cursor"]
+            if not changes["more"]:
+                break
+        self.assertEqual(seen, ["Task1", "Task2", "Task3", "Task4"])
+        self.assertEqual(self.sync(cursor)["changed"], [])
+
+    def test_cost_follows_changes(self):
+        cursor = self.sync()["cursor"]
+        self.tasks[0].title = "Renamed"
+        self.tasks[0].save()
+        with self.assertNumQueries(5):
+            small = self.sync(cursor)
+        Task.objects.bulk_create(
+            Task(title="Old", description="Lorem", user=self.user) for _ in range(100)
+        )
+        with self.assertNumQueries(5):
+            self.assertEqual(self.sync(cursor), small)
+
+    def test_tasks_gone_for_good(self):
+        cursor = self.sync()["cursor"]
+        first, second, third, _ = self.tasks
+        self.client.delete(f"/api/v1/task/{first.id}/")
+        second.user = User.objects.create_user(username="other")
+        second.save()
+        Task.objects.filter(id=third.id).tracked_update(user=second.user)
+        changes = self.sync(cursor)
+        self.assertEqual(changes["deleted"], [first.id, second.id, third.id])
+        self.assertEqual(changes["changed"], [])
+        self.assertEqual(
+            [task["id"] for task in self.sync(user=second.user)["changed"]], [second.id, third.id]
+        )
+        # Given back, the task is deleted then changed in the same sync
+        third = Task.objects.get(id=third.id)
+        third.user = self.user
+        third.save()
+        changes = self.sync(cursor)
+        self.assertEqual(changes["deleted"], [first.id, second.id, third.id])
+        self.assertEqual([task["id"] for task in changes["changed"]], [third.id])
+
+    def test_reset_once_changes_are_purged(self):
+        cursor = self.sync()["cursor"]
+        self.tasks[0].deleted = True
+        self.tasks[0].save()
+        removed = self.tasks[1].id
+        self.tasks[1].delete()
+        deleted = self.sync(cursor)
+        self.assertEqual(deleted["deleted"], [removed, self.tasks[0].id])
+        report = purge_tasks(after_days=-1, pause=0)
+        self.assertEqual((report["tasks"], report["tombstones"]), (1, 1))
+        # Clients that synced the deletes carry on, the others start over
+        self.assertFalse(self.sync(deleted["cursor"])["reset"])
+        changes = self.sync(cursor)
+        self.assertTrue(changes["reset"])
+        self.assertEqual(len(changes["changed"]), 2)
+        self.assertFalse(self.sync(changes["cursor"])["reset"])
+
+        # Paging through a full sync resets too if the copy goes stale
+        page = self.sync(limit=1)
+        self.tasks[2].deleted = True
+        self.tasks[2].save()
+        purge_tasks(after_days=-1, pause=0)
+        self.assertTrue(self.sync(page["cursor"], limit=1)["reset"])
+
+    def test_invalid_cursor(self):
+        for since in ("abc", "-1", "1:x"):
+            with self.subTest(since):
+                response = self.client.get("/api/v1/sync/", {"since": since})
+                self.assertEqual(response.status_code, 400)
+        self.assertTrue(self.sync("1000")["reset"])
+        self.client.logout()
+        self.assertEqual(self.client.get("/api/v1/sync/").status_code, 403)
+
+
+class TaskAnalyticsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        self.client.login(username="gokul", password="abcd@123")
+        self.today = timezone.now().date()
+        self.task = self.make_history(
+            self.user, [(10, "IN_PROGRESS"), (7, "COMPLETED"), (5, "PENDING"), (0, "CANCELLED")]
+        )
+        other = User.objects.create_user(username="other")
+        self.make_history(other, [(7, "COMPLETED")])
+
+    def make_history(self, user, changes):
+        """Status changes to a new task of user's, (days ago, status) each"""
+        task = Task.objects.create(title="Task", description="Lorem", user=user)
+        for days, status in changes:
+            task.status = status
+            task.save()
+            History.objects.filter(id=History.objects.latest("id").id).update(
+                changed_date=self.today - timedelta(days=days)
+            )
+        return task
+
+    def stats(self, kind, **params):
+        response = self.client.get(f"/api/v1/stats/{kind}/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_rollups_match_history(self):
+        start = str(self.today - timedelta(days=12))
+        live = self.stats("summary", start=start), self.stats("daily", start=start)
+        self.assertEqual(rollup_history(), {"days": 10, "rows": 4})
+        # Days without history are rolled up once, like any other
+        self.assertEqual(rollup_history(), {"days": 0, "rows": 0})
+        self.assertEqual(DailyTaskRollup.objects.filter(user=self.user).count(), 3)
+        self.assertEqual((self.stats("summary", start=start), self.stats("daily", start=start)), live)
+
+        summary = live[0]
+        self.assertEqual(
+            (summary["completed"], summary["closed"], summary["reopened"]), (1, 2, 1)
+        )
+        self.assertEqual(
+            summary["status_time"],
+            {
+                "PENDING": {"stints": 1, "days": 5, "average_days": 5.0},
+                "IN_PROGRESS": {"stints": 1, "days": 3, "average_days": 3.0},
+                "COMPLETED": {"stints": 1, "days": 2, "average_days": 2.0},
+                "CANCELLED": {"stints": 0, "days": 0, "average_days": None},
+            },
+        )
+        days = live[1]["days"]
+        self.assertEqual(len(days), 13)
+        self.assertEqual(days[5], {
+            "date": str(self.today - timedelta(days=7)), "completed": 1, "closed": 1, "reopened": 0,
+        })
+        self.assertEqual(days[-1]["closed"], 1)
+
+    def test_backfilled_history_is_rolled_up(self):
+        rollup_history()
+        dataset.generate(users=1, tasks=3, history=2, days=20)
+        user_id = dataset.dataset_users("synthetic").get().id
+        first = History.objects.filter(task_changed__user=user_id).earliest("changed_date")
+        # The days from the first one with the new history on, again
+        self.assertEqual(rollup_history()["days"], (self.today - first.changed_date).days)
+        live = analytics.roll_up(analytics.transitions(first.changed_date, self.today, user_id))
+        self.assertEqual(DailyTaskRollup.objects.filter(user=user_id).count(), len(live))
+        self.assertEqual(analytics.rolled_up_until(), self.today)
+
+    def test_archived_history_is_rolled_up(self):
+        History.objects.filter(task_changed=self.task).update(
+            changed_date=F("changed_date") - timedelta(days=400)
+        )
+        apply_retention(compact_after_days=1000, archive_after_days=365, batch_size=10)
+        self.assertEqual(HistoryArchive.objects.filter(user=self.user).count(), 4)
+        out = StringIO()
+        call_command("backfill_task_rollups", stdout=out)
+        self.assertIn("Rolled up 410 days into 5 rows", out.getvalue())
+        summary = self.stats("summary", start=str(self.today - timedelta(days=412)))
+        self.assertEqual((summary["completed"], summary["closed"]), (1, 2))
+        self.assertEqual(summary["status_time"]["PENDING"]["days"], 5)
+
+    def test_reads_cost_the_same_for_any_range(self):
+        rollup_history()
+        for days in (30, 3000):
+            start = str(self.today - timedelta(days=days))
+            with self.subTest(days), self.assertNumQueries(6):
+                self.stats("summary", start=start)
+
+    def test_invalid_ranges(self):
+        for params in (
+            {"start": "2026-02-30"},
+            {"start": "2026-03-02", "end": "2026-03-01"},
+            {"start": "2000-01-01", "end": "2026-01-01"},
+        ):
+            with self.subTest(params):
+                response = self.client.get("/api/v1/stats/daily/", params)
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.stats("daily")["days"]), 30)
+
+
+class DatasetTests(TestCase):
+    def test_generated_data_is_consistent(self):
+        out = StringIO()
+        call_command(
+            "generate_dataset", "--users=3", "--tasks=5", "--history=2", "--batch-size=4", stdout=out
+        )
+        self.assertIn("Created 3 users, 15 tasks and 30 history rows", out.getvalue())
+        users = dataset.dataset_users("synthetic")
+        self.assertEqual(EmailSettings.objects.filter(user__in=users).count(), 3)
+        # TaskStats match the tasks already
+        self.assertEqual(reconcile_task_stats(), 0)
+        today = timezone.now().date()
+        for task in Task.objects.filter(user__in=users):
+            rows = list(History.objects.filter(task_changed=task).order_by("id"))
+            self.assertEqual(rows[-1].updated_status, task.status)
+            self.assertEqual(rows[0].updated_status, rows[1].prev_status)
+            self.assertTrue(today - timedelta(days=90) < rows[0].changed_date <= rows[1].changed_date)
+        self.assertEqual(
+            sorted(Task.objects.filter(user=users[0]).values_list("change_seq", flat=True)),
+            [1, 2, 3, 4, 5],
+        )
+
+        with self.assertRaises(CommandError):
+            call_command("generate_dataset", stdout=out)
+        # What the users' activity leaves around them besides their tasks
+        user = users[0]
+        TaskTombstone.objects.create(user_id=user.id, task_id=0, change_seq=6)
+        rollup_history()
+        self.assertTrue(DailyTaskRollup.objects.filter(user=user).exists())
+        outbox.enqueue([EmailMessage("Report", "Body", "from@ghv.org", [user.email])])
+        ReminderClaim.objects.create(user=user, report_date=today, claim="x")
+        other = User.objects.create_user(username="gokul", email="gokul@ghv.org")
+        Task.objects.create(title="Theirs", user=other)
+        call_command("generate_dataset", "--delete", stdout=out)
+        self.assertIn("Deleted 3 users", out.getvalue())
+        for model in (
+            Task, History, TaskTombstone, ChangeSequence, TaskStats, DailyTaskRollup,
+            EmailSettings, EmailOutbox, ReminderClaim,
+        ):
+            with self.subTest(model.__name__):
+                self.assertFalse(model.objects.exclude(**self.owned_by(model, other)).exists())
+        self.assertEqual(Task.objects.get().title, "Theirs")
+
+    def owned_by(self, model, user):
+        if model is History:
+            return {"task_changed__user": user}
+        if model is TaskTombstone:
+            return {"user_id": user.id}
+        if model is EmailOutbox:
+            return {"to": user.email}
+        return {"user": user}
+
+    def test_deleting_in_batches(self):
+        dataset.generate(users=3, tasks=2, history=1)
+        kept = User.objects.create_user(username="gokul")
+        Task.objects.create(title="Theirs", user=kept)
+        self.assertEqual(dataset.delete(batch_size=2), 3)
+        self.assertEqual(list(Task.objects.values_list("title", flat=True)), ["Theirs"])
+        self.assertEqual(History.objects.count(), 0)
+
+    def test_needs_ids_of_bulk_inserts(self):
+        with mock.patch.object(
+            type(connection.features),
+            "can_return_rows_from_bulk_insert",
+            new_callable=mock.PropertyMock,
+            return_value=False,
+        ), self.assertRaises(NotSupportedError):
+            dataset.generate(users=1, tasks=1, history=1)
+        self.assertFalse(User.objects.exists())
+
+    def test_deleting_a_user_with_tasks(self):
+        user = User.objects.create_user(username="gokul")
+        Task.objects.create(title="Task1", description="Lorem", user=user)
+        user.delete()
+        self.assertFalse(Task.objects.exists() or TaskTombstone.objects.exists())
+
+
+class LoadTestTests(TransactionTestCase):
+    """The async views query from threads of their own, so the data is committed"""
+
+    def test_every_route_is_measured(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "loadtest.json")
+        out, err = StringIO(), StringIO()
+        call_command(
+            "loadtest", "--users=2", "--tasks=3", "--history=1", "--requests=2",
+            "--concurrency=1", f"--output={path}", stdout=out, stderr=err,
+        )
+        with open(path) as file:
+            results = json.load(file)
+        self.assertEqual(results, json.loads(out.getvalue()))
+        self.assertEqual(results["dataset"], {"users": 2, "tasks": 6, "history": 6})
+        routes = results["routes"]
+        self.assertEqual(len(routes), len(get_resolver().url_patterns) - 1)
+        self.assertNotIn("GET /user/logout/", routes)
+        for name, levels in routes.items():
+            with self.subTest(name):
+                self.assertEqual(levels["1"]["errors"], 0)
+                self.assertEqual(levels["1"]["requests"], 2)
+        self.assertEqual(routes["GET /api/v1/task/"]["1"]["queries"], 3)
+        self.assertEqual(routes["POST /complete_task/<pk>/"]["1"]["statuses"], {"302": 2})
+        # The generated dataset is gone again
+        self.assertFalse(User.objects.exists())
+
+        baseline = json.loads(out.getvalue())
+        baseline["routes"]["GET /api/v1/task/"]["1"]["queries"] -= 1
+        with open(path, "w") as file:
+            json.dump(baseline, file)
+        with self.assertRaisesMessage(CommandError, "1 regression(s)"):
+            call_command(
+                "loadtest", "--users=2", "--tasks=3", "--history=1", "--requests=2",
+                "--concurrency=1", "--route", "GET /api/v1/task/", f"--baseline={path}",
+                "--max-regression=1000", stdout=StringIO(), stderr=err,
+            )
+        self.assertIn("GET /api/v1/task/ @1: p95", err.getvalue())
+
+
+class RequestTimingTests(TestCase):
+    def setUp(self):
+        timing.reset()
+        self.addCleanup(timing.reset)
+        self.user = User.objects.create_user(username="gokul", password="abcd@123")
+        Task.objects.create(title="Task1", description="Lorem", user=self.user)
+        self.client.login(username="gokul", password="abcd@123")
+
+    def server_timing(self, response):
+        """{metric: milliseconds} of the Server-Timing header, sql as (ms, queries)"""
+        metrics = {}
+        for metric in response["Server-Timing"].split(", "):
+            match = re.fullmatch(r'(\w+);dur=([\d.]+)(?:;desc="(\d+) queries")?', metric)
+            name, duration, queries = match.groups()
+            metrics[name] = (float(duration), int(queries)) if queries else float(duration)
+        return metrics
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/v1/task/")
+        metrics = self.server_timing(response)
+        self.assertEqual(set(metrics), {"total", "view", "sql", "template"})
+        self.assertEqual(metrics["sql"][1], len(queries))
+        self.assertEqual(metrics["template"], 0)
+
+        response = self.client.get("/all_tasks/")
+        self.assertGreater(self.server_timing(response)["template"], 0)
+        self.assertIn("Server-Timing", self.client.get("/no/such/page/"))
+
+    def test_metrics_endpoint(self):
+        self.client.get("/api/v1/task/")
+        self.client.get("/api/v1/task/")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        labels = 'route="/api/v1/task/",method="GET"'
+        self.assertIn(f"http_request_duration_seconds_count{{{labels}}} 2", body)
+        self.assertIn(f'http_request_queries_bucket{{{labels},le="+Inf"}} 2', body)
+        self.assertIn("# TYPE http_request_sql_seconds histogram", body)
+        self.assertIn('email_outbox_messages{status="PENDING"} 0', body)
+
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.2").status_code, 404)
+
+    @override_settings(REQUEST_TIMING_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_only_counted(self):
+        response = self.client.get("/api/v1/task/")
+        self.assertNotIn("Server-Timing", response)
+        route = (("route", "/api/v1/task/"), ("method", "GET"))
+        self.assertEqual(timing.snapshot("duration")[route][2], 1)
+        self.assertNotIn(route, timing.snapshot("sql"))
+
+    def test_requests_are_logged(self):
+        with self.assertLogs("tasks.timing", "INFO") as logs:
+            self.client.get("/api/v1/task/?completed=false")
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["route"], "/api/v1/task/")
+        self.assertEqual(record["path"], "/api/v1/task/")
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(logs.records[0].timing, record)
+        self.assertGreater(record["queries"], 0)
+
+
+class CeleryMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for i in range(2):
+            user = User.objects.create_user(username=f"user{i}", email=f"user{i}@ghv.org")
+            Task.objects.create(title="Task", user=user)
+            EmailSettings.objects.create(
+                user=user,
+                email_time=timezone.now() - timedelta(minutes=10),
+                email_date=timezone.now(),
+            )
+        eager = {
+            key: app.conf[key]
+            for key in ("CELERY_TASK_ALWAYS_EAGER", "CELERY_TASK_EAGER_PROPAGATES")
+        }
+        app.conf.update({key: True for key in eager})
+        self.addCleanup(app.conf.update, eager)
+
+    def metrics(self):
+        return {name: samples for name, _, _, samples in collect()}
+
+    def test_runs_are_recorded(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            send_email_reminder.apply()
+        self.assertEqual(len(mail.outbox), 2)
+        metrics = self.metrics()
+        runs = {
+            labels[0][1]: value
+            for labels, value in metrics["celery_task_runs_total"].items()
+            if labels[1] == ("state", "SUCCESS")
+        }
+        self.assertEqual(runs["tasks.tasks.send_email_reminder"], 1)
+        self.assertEqual(runs["tasks.tasks.send_email_reports"], 1)
+        self.assertEqual(runs["tasks.tasks.deliver_emails"], 1)
+        self.assertEqual(runs["tasks.tasks.purge_deleted_tasks"], 0)
+
+        items = metrics["celery_task_items_total"]
+        for task, item, value in (
+            ("send_email_reminder", "reports", 2),
+            ("send_email_reminder", "chunks", 1),
+            ("send_email_reports", "reports", 2),
+            ("send_email_reports", "skipped", 0),
+            ("deliver_emails", "sent", 2),
+        ):
+            with self.subTest(task=task, item=item):
+                self.assertEqual(items[(("task", f"tasks.tasks.{task}"), ("item", item))], value)
+
+        durations = metrics["celery_task_duration_seconds"]
+        _, _, count = durations[(("task", "tasks.tasks.send_email_reports"),)]
+        self.assertEqual(count, 1)
+        self.assertNotIn((("task", "tasks.tasks.purge_deleted_tasks"),), durations)
+        # Eager runs are not published, they don't wait in a queue
+        self.assertEqual(metrics["celery_task_queue_wait_seconds"], {})
+
+        buckets, total, count = metrics["email_report_schedule_lag_seconds"][()]
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(total, 2 * 600)
+        self.assertEqual(dict(buckets)[300], 0)
+        self.assertEqual(dict(buckets)[900], 2)
+
+    def test_failed_runs(self):
+        with mock.patch.object(outbox, "deliver", side_effect=RuntimeError):
+            result = deliver_emails.apply(throw=False)
+        self.assertEqual(result.state, "FAILURE")
+        runs = self.metrics()["celery_task_runs_total"]
+        self.assertEqual(runs[(("task", "tasks.tasks.deliver_emails"), ("state", "FAILURE"))], 1)
+        self.assertEqual(runs[(("task", "tasks.tasks.deliver_emails"), ("state", "SUCCESS"))], 0)
+
+    def test_queue_wait(self):
+        headers = {}
+        celerymetrics.stamp_published(sender="tasks.tasks.deliver_emails", headers=headers)
+        headers[celerymetrics.PUBLISHED_HEADER] -= 20
+        deliver_emails.apply(headers=headers)
+        buckets, total, count = self.metrics()["celery_task_queue_wait_seconds"][
+            (("task", "tasks.tasks.deliver_emails"),)
+        ]
+        self.assertEqual(count, 1)
+        self.assertGreaterEqual(total, 20)
+        self.assertEqual(dict(buckets)[10], 0)
+
+        # Other tasks' messages are left alone
+        headers = {}
+        celerymetrics.stamp_published(sender="celery.backend_cleanup", headers=headers)
+        self.assertEqual(headers, {})
+
+    def test_calls_outside_a_run_are_not_counted(self):
+        deliver_emails()
+        items = self.metrics()["celery_task_items_total"]
+        self.assertEqual(items[(("task", "tasks.tasks.deliver_emails"), ("item", "sent"))], 0)
+
+    def test_metrics_endpoint(self):
+        deliver_emails.apply()
+        body = self.client.get("/metrics").content.decode()
+        self.assertIn(
+            'celery_task_runs_total{task="tasks.tasks.deliver_emails",state="SUCCESS"} 1', body
+        )
+        self.assertIn(
+            'celery_task_duration_seconds_count{task="tasks.tasks.deliver_emails"} 1', body
+        )
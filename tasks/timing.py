@@ -0,0 +1,258 @@
+"""
+Per request timings: how long each request took and, of that, how long went
+to SQL (and how many queries there were), to rendering templates and to the
+view.
+
+RequestTimingMiddleware times every request into the per route
+http_request_duration_seconds histogram. A REQUEST_TIMING_SAMPLE_RATE share
+of them is also broken down: queries are timed by an execute wrapper put on
+every connection as it opens, templates by the TimedDjangoTemplates backend,
+and both are credited to the request through a context variable, so the
+queries the async views make on their thread pool count too. Sampled
+requests get a Server-Timing header (unless REQUEST_TIMING_HEADER is off),
+are logged to the tasks.timing logger as a JSON object each and go into the
+breakdown histograms.
+
+Histograms are kept in memory, per process, and served with the other
+metrics by /metrics (see tasks.metrics). An unsampled request costs two clock
+reads and a histogram update, and each of its queries a context variable
+lookup. Times stop when the response is returned, before any streaming.
+"""
+import asyncio
+import json
+import logging
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+# The buckets of each histogram, all labelled by route and method
+HISTOGRAMS = {
+    "duration": SECONDS_BUCKETS,
+    "view": SECONDS_BUCKETS,
+    "sql": SECONDS_BUCKETS,
+    "queries": QUERY_BUCKETS,
+    "template": SECONDS_BUCKETS,
+}
+# Others are labelled "OTHER", labels mustn't take any value a client sends
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+_current = ContextVar("request_timing", default=None)
+_histograms = {name: {} for name in HISTOGRAMS}
+_lock = threading.Lock()
+
+
+class Histogram:
+    """Counts of observations per bucket, each bucket an upper bound"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        """([(upper bound, observations up to it), ..., (inf, all)], sum, count)"""
+        buckets, count = [], 0
+        for bound, observations in zip((*self.buckets, float("inf")), self.counts):
+            count += observations
+            buckets.append((bound, count))
+        return buckets, self.sum, count
+
+
+def observe(labels, values):
+    """Add {histogram name: value} observations for labels"""
+    with _lock:
+        for name, value in values.items():
+            histogram = _histograms[name].get(labels)
+            if histogram is None:
+                histogram = _histograms[name][labels] = Histogram(HISTOGRAMS[name])
+            histogram.observe(value)
+
+
+def snapshot(name):
+    """{labels: Histogram.snapshot()} of a histogram"""
+    with _lock:
+        return {labels: histogram.snapshot() for labels, histogram in _histograms[name].items()}
+
+
+def reset():
+    with _lock:
+        for histograms in _histograms.values():
+            histograms.clear()
+
+
+def route_name(route):
+    """A URL pattern as a path, "^task/(?P<pk>[^/.]+)/$" as "/task/<pk>/" """
+    return "/" + re.sub(r"[\^$]", "", re.sub(r"\(\?P<(\w+)>[^)]*\)", r"<\1>", route))
+
+
+class Timing:
+    __slots__ = ("sql", "queries", "template", "rendering", "view_start")
+
+    def __init__(self):
+        self.sql = 0.0
+        self.queries = 0
+        self.template = 0.0
+        self.rendering = False
+        self.view_start = None
+
+
+def _view_started():
+    timing = _current.get()
+    if timing is not None:
+        timing.view_start = time.perf_counter()
+
+
+def time_query(execute, sql, params, many, context):
+    timing = _current.get()
+    if timing is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timing.sql += time.perf_counter() - start
+        timing.queries += 1
+
+
+def install(sender, connection, **kwargs):
+    """connection_created receiver putting time_query on every connection"""
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+class TimedTemplate:
+    """A template that credits the time it takes to render to the request"""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        timing = _current.get()
+        if timing is None or timing.rendering:
+            # Templates rendered by templates are timed with them
+            return self.template.render(context, request)
+        timing.rendering = True
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            timing.template += time.perf_counter() - start
+            timing.rendering = False
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class RequestTimingMiddleware:
+    """First in MIDDLEWARE, so that the time spent in the others counts too"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Both mark the middleware as async to Django, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        timing, token = self.start()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                _current.reset(token)
+        self.finish(request, response, timing, start)
+        return response
+
+    async def __acall__(self, request):
+        timing, token = self.start()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                _current.reset(token)
+        self.finish(request, response, timing, start)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _view_started()
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        _view_started()
+
+    def start(self):
+        rate = settings.REQUEST_TIMING_SAMPLE_RATE
+        if rate < 1 and random.random() >= rate:
+            return None, None
+        timing = Timing()
+        return timing, _current.set(timing)
+
+    def finish(self, request, response, timing, start):
+        end = time.perf_counter()
+        match = request.resolver_match
+        route = route_name(match.route) if match else "unmatched"
+        method = request.method if request.method in METHODS else "OTHER"
+        values = {"duration": end - start}
+        if timing is not None:
+            values.update(sql=timing.sql, queries=timing.queries, template=timing.template)
+            if timing.view_start is not None:
+                # Inner middleware and the template rendered after the view
+                # returned are left out
+                values["view"] = max(end - timing.view_start - timing.template, 0)
+        observe((("route", route), ("method", method)), values)
+        if timing is None:
+            return
+
+        if settings.REQUEST_TIMING_HEADER:
+            metrics = [f"total;dur={values['duration'] * 1000:.1f}"]
+            if "view" in values:
+                metrics.append(f"view;dur={values['view'] * 1000:.1f}")
+            metrics.append(f'sql;dur={timing.sql * 1000:.1f};desc="{timing.queries} queries"')
+            metrics.append(f"template;dur={timing.template * 1000:.1f}")
+            if response.has_header("Server-Timing"):
+                metrics.insert(0, response["Server-Timing"])
+            response["Server-Timing"] = ", ".join(metrics)
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        record = {
+            "method": request.method,
+            "path": request.path,
+            "route": route,
+            "status": response.status_code,
+            **{
+                f"{name}_ms": round(values[name] * 1000, 2)
+                for name in ("duration", "view", "sql", "template")
+                if name in values
+            },
+            "queries": timing.queries,
+        }
+        logger.info(json.dumps(record), extra={"timing": record})
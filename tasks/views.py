@@ -5,7 +5,8 @@ from django.contrib.auth.views import LoginView
 from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.forms import ModelForm
-from django.http import HttpResponseRedirect
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
 from django.views import View
 from django.views.generic.base import RedirectView, TemplateView
@@ -15,21 +16,50 @@ from django.views.generic.list import ListView
 from django.core.mail import send_mail
 from django.conf import settings
 
+from tasks import cache as page_cache
+from tasks import metrics
 from tasks.forms import *
-from tasks.models import Task, EmailSettings
+from tasks.models import Task, TaskStats, EmailSettings, number_priorities
+from tasks.pagination import KeysetPaginationMixin
 
 
 class TaskCompletedCount:
+    _task_stats = None
+
+    def get_task_stats(self):
+        if self._task_stats is None:
+            self._task_stats = TaskStats.for_user(self.request.user)
+        return self._task_stats
+
     def get_context_data(self, *args, **kwargs):
-        base_qs = Task.objects.filter(user=self.request.user)
-        active_tasks = base_qs.filter(deleted=False)
-        completed_tasks = active_tasks.filter(completed=True)
+        stats = self.get_task_stats()
         context = super().get_context_data(*args, **kwargs)
-        context["completed_count"] = completed_tasks.count()
-        context["total_count"] = active_tasks.count()
+        context["completed_count"] = stats.completed_count
+        context["total_count"] = stats.active_count
         return context
 
 
+class CachedPageMixin:
+    """
+    Serve the page from the cache of rendered pages while the user's tasks
+    are unchanged, see tasks.cache
+    """
+
+    def get(self, request, *args, **kwargs):
+        key = page_cache.page_cache_key(request)
+        if key is not None:
+            content = cache.get(key)
+            if content is not None:
+                page_cache.count("hit")
+                return HttpResponse(content)
+        response = super().get(request, *args, **kwargs)
+        if key is not None and response.status_code == 200:
+            response.render()
+            cache.set(key, response.content, settings.TASKS_PAGE_CACHE_TIMEOUT)
+            page_cache.count("miss")
+        return response
+
+
 class RedirectRootToTasks(RedirectView):
     url = "/tasks"
 
@@ -37,7 +67,7 @@ class RedirectRootToTasks(RedirectView):
 class AuthorisedTaskManager(LoginRequiredMixin):
     def get_queryset(self):
         return Task.objects.filter(deleted=False, user=self.request.user).order_by(
-            "priority"
+            "rank", "id"
         )
 
 
@@ -70,16 +100,24 @@ class GenericCompleteTaskView(AuthorisedTaskManager, View, SingleObjectMixin):
 
     def post(self, request, *args, **kwargs):
         self.object = self.get_object()
-        Task.objects.filter(id=self.object.id, user=self.request.user).update(
-            completed=True
-        )
+        Task.objects.filter(
+            id=self.object.id, user=self.request.user
+        ).tracked_update(completed=True)
         return HttpResponseRedirect(self.success_url)
 
 
-class GenericAllTasksView(TaskCompletedCount, AuthorisedTaskManager, ListView):
+class GenericAllTasksView(
+    CachedPageMixin,
+    TaskCompletedCount,
+    KeysetPaginationMixin,
+    AuthorisedTaskManager,
+    ListView,
+):
     template_name = "all_tasks.html"
     context_object_name = "tasks"
-    paginate_by = 4
+
+    def get_total_count(self):
+        return self.get_task_stats().active_count
 
 
 class GenericTaskDeleteView(AuthorisedTaskManager, DeleteView):
@@ -88,50 +126,15 @@ class GenericTaskDeleteView(AuthorisedTaskManager, DeleteView):
     success_url = "/tasks"
 
 
-class GenericTaskDetailView(AuthorisedTaskManager, DetailView):
+class GenericTaskDetailView(CachedPageMixin, AuthorisedTaskManager, DetailView):
     model = Task
     template_name = "task_detail.html"
 
 
-@transaction.atomic
-def task_priority_check(priority, user):
-    """
-    A function to check if any two tasks have the same priority
-    if so, then cascade update the priorities such that no two tasks have the same priority
-    """
-
-    task_lst = (
-        Task.objects.select_for_update()
-        .filter(
-            deleted=False,
-            user=user,
-            completed=False,
-            priority__gte=priority,
-        )
-        .order_by("priority")
-    )
-
-    update_lst = []
-
-    for task in task_lst:
-        if task.priority != priority:
-            break
-        task.priority += 1
-        priority += 1
-        update_lst.append(task)
-
-    Task.objects.bulk_update(update_lst, ["priority"])
-
-
 class TaskFormValidMixin:
     def form_valid(self, form):
-        priority = form.cleaned_data["priority"]
-        if form.cleaned_data["completed"] == False:
-            if form.has_changed() and "priority" in form.changed_data:
-                task_priority_check(priority, self.request.user)
+        form.instance.user = self.request.user
         self.object = form.save()
-        self.object.user = self.request.user
-        self.object.save()
         return HttpResponseRedirect(self.get_success_url())
 
 
@@ -147,26 +150,58 @@ class GenericTaskUpdateView(TaskFormValidMixin, AuthorisedTaskManager, UpdateVie
     template_name = "task_update.html"
     success_url = "/tasks"
 
+    def get_object(self, queryset=None):
+        # The form starts from the task's priority
+        return number_priorities([super().get_object(queryset)])[0]
+
 
-class GenericCompletedTaskView(TaskCompletedCount, LoginRequiredMixin, ListView):
+class GenericCompletedTaskView(
+    CachedPageMixin,
+    TaskCompletedCount,
+    KeysetPaginationMixin,
+    LoginRequiredMixin,
+    ListView,
+):
     template_name = "completed.html"
     context_object_name = "tasks"
-    paginate_by = 4
 
-    def get_queryset(self):
-        return Task.objects.filter(completed=True, user=self.request.user).order_by(
-            "priority"
-        )
+    def get_total_count(self):
+        return self.get_task_stats().completed_count
 
-
-class GenericTaskView(TaskCompletedCount, LoginRequiredMixin, ListView):
+    def get_queryset(self):
+        return Task.objects.filter(
+            completed=True, deleted=False, user=self.request.user
+        ).order_by("rank", "id")
+
+
+class GenericTaskView(
+    CachedPageMixin,
+    TaskCompletedCount,
+    KeysetPaginationMixin,
+    LoginRequiredMixin,
+    ListView,
+):
     template_name = "tasks.html"
     context_object_name = "tasks"
-    paginate_by = 4
+
+    def get_total_count(self):
+        stats = self.get_task_stats()
+        return stats.active_count - stats.completed_count
 
     def get_queryset(self):
         base_qs = Task.objects.filter(user=self.request.user)
         active_tasks = base_qs.filter(deleted=False, completed=False).order_by(
-            "priority"
+            "rank", "id"
         )
         return active_tasks
+
+
+class MetricsView(View):
+    """The metrics of this process for Prometheus, to scrapers on the same host"""
+
+    def get(self, request):
+        if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+            raise Http404
+        return HttpResponse(
+            metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )